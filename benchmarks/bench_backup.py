@@ -0,0 +1,527 @@
+"""Benchmark full backup, incremental backup, purge and inode scan.
+
+A synthetic ``oc_filecache`` is generated in SQLite (or in a local
+PostgreSQL schema using ``--pg-dsn``) and its S3 objects are written in a
+local directory standing for the bucket. Each phase runs in its own
+process so its peak RSS and syscalls are measured separately, results
+are written as JSON so runs can be compared::
+
+    python benchmarks/bench_backup.py --rows 100000 --output after.json
+    python benchmarks/bench_backup.py --rows 100000 --compare before.json
+
+Phases:
+
+* ``full_backup``: first snapshot of every row
+* ``incremental_backup``: second snapshot once ``--change-ratio`` of rows
+  changed (using ``--delta`` unless ``--no-delta``)
+* ``inode_scan``: walk the second snapshot tree for its inodes
+* ``purge``: purge the repository once the first snapshot is removed
+
+Syscalls are read/write syscalls counted by linux in ``/proc/self/io``.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import math
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import sqlite3
+import subprocess  # nosec
+import tempfile
+from os import stat_result
+from pathlib import Path
+from time import perf_counter
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from nc_s3_backup.api.aio import AsyncNextcloudS3Backup
+from nc_s3_backup.api.backup import (
+    MB,
+    REPOSITORY_DIRNAME,
+    SNAPSHOT_DIRNAME,
+    NextcloudS3Backup,
+)
+from nc_s3_backup.api.config import NextcloudDirectoryConfig, NextCloudS3BackupConfig
+from nc_s3_backup.api.db import DaoNextcloudFiles, NextcloudFile, path_prefix_pattern
+from nc_s3_backup.api.metrics import registry
+from nc_s3_backup.api.profiling import profiler
+
+STORAGE_ID = 2
+PG_SCHEMA = "nc_s3_backup_bench"
+FULL, INCREMENTAL = "full", "incremental"
+SCHEMA = """
+CREATE TABLE oc_filecache (
+    fileid BIGINT PRIMARY KEY,
+    storage BIGINT NOT NULL,
+    path TEXT NOT NULL,
+    checksum TEXT NOT NULL,
+    size BIGINT NOT NULL,
+    mtime BIGINT NOT NULL,
+    etag TEXT NOT NULL,
+    mimetype BIGINT NOT NULL,
+    mimepart BIGINT NOT NULL
+)
+"""
+# fake S3 objects statistics of the current process
+downloads = dict(count=0, bytes=0)
+
+
+class SqliteNextcloudFiles:
+    """Stand-in of ``DaoNextcloudFiles`` reading ``oc_filecache`` from a
+    SQLite database using the same case sensitive path prefix filter
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    def get_nc_subtree(
+        self,
+        storage_id: int,
+        root_path: str,
+        excluded_mimetype: List[int],
+        mimetypes: Sequence[int] = (),
+        mimeparts: Sequence[int] = (),
+    ) -> Iterator[NextcloudFile]:
+        query = (
+            "SELECT fileid, storage, path, checksum, size, mtime, etag "
+            "FROM oc_filecache WHERE storage = ? AND path LIKE ? ESCAPE '\\'"
+        )
+        params = [storage_id, path_prefix_pattern(root_path)]
+        if excluded_mimetype:
+            query += f" AND mimetype NOT IN ({', '.join('?' * len(excluded_mimetype))})"
+            params.extend(excluded_mimetype)
+        included = [f"mimetype = {int(mimetype)}" for mimetype in mimetypes]
+        included.extend(f"mimepart = {int(mimepart)}" for mimepart in mimeparts)
+        if included:
+            query += f" AND ({' OR '.join(included)})"
+        cnx = sqlite3.connect(str(self.path))
+        try:
+            cnx.execute("PRAGMA case_sensitive_like = ON")
+            for row in cnx.execute(query, params):
+                yield NextcloudFile(*row)
+        finally:
+            cnx.close()
+
+    def get_nc_subtrees(
+        self,
+        subtrees: Sequence[Tuple[int, str]],
+        excluded_mimetype: List[int],
+        mimetypes: Sequence[int] = (),
+        mimeparts: Sequence[int] = (),
+    ) -> Iterator[Tuple[int, NextcloudFile]]:
+        for index, (storage_id, root_path) in enumerate(subtrees):
+            for nc_file in self.get_nc_subtree(
+                storage_id, root_path, excluded_mimetype, mimetypes, mimeparts
+            ):
+                yield index, nc_file
+
+
+def install_fake_s3():
+    """Local files stand for S3 objects: ``copy`` download them and their
+    etag is made of their inode and size (objects of the same content are
+    hard linked so they share the same etag, as md5 etags on S3).
+    """
+
+    def copy(self, destination):
+        shutil.copyfile(self, destination)
+        downloads["count"] += 1
+        downloads["bytes"] += os.stat(destination).st_size
+
+    @property
+    def etag(self):
+        return f"{self.st_ino:016x}{self.st_size:016x}"
+
+    Path.copy = copy
+    stat_result.etag = etag
+
+
+def content(content_id: int, size: int) -> bytes:
+    header = f"content {content_id}\n".encode()
+    return header[:size] + bytes(max(0, size - len(header)))
+
+
+def file_size(rand: random.Random, arguments) -> int:
+    if rand.random() < arguments.empty_ratio:
+        return 0
+    size = rand.lognormvariate(math.log(arguments.median_size_kb * 1024), 1.5)
+    return min(int(size), arguments.max_size_mb * MB)
+
+
+def generate_rows(arguments, bucket: Path) -> List[tuple]:
+    """Build ``oc_filecache`` rows and write their S3 objects in ``bucket``,
+    duplicated rows are copies (other fileids) of a previous content.
+    """
+    rand = random.Random(arguments.seed)
+    rows, contents = [], []
+    for fileid in range(1, arguments.rows + 1):
+        if contents and rand.random() < arguments.duplicate_ratio:
+            content_fileid, checksum, size = rand.choice(contents)
+            os.link(bucket / f"urn:oid:{content_fileid}", bucket / f"urn:oid:{fileid}")
+        else:
+            size = file_size(rand, arguments)
+            data = content(fileid, size)
+            (bucket / f"urn:oid:{fileid}").write_bytes(data)
+            checksum = f"SHA1:{sha1_hex(data)}"
+            contents.append((fileid, checksum, size))
+        rows.append(
+            (
+                fileid,
+                STORAGE_ID,
+                f"files/dir-{fileid % arguments.directories}/file-{fileid}.bin",
+                "" if rand.random() < arguments.no_sha1_ratio else checksum,
+                size,
+                1640342159,
+                f"etag{fileid}",
+                0,
+                0,
+            )
+        )
+    return rows
+
+
+def change_rows(arguments, rows: List[tuple], bucket: Path) -> List[tuple]:
+    """Update content of ``--change-ratio`` of rows"""
+    rand = random.Random(arguments.seed + 1)
+    changed = []
+    for row in rand.sample(rows, int(len(rows) * arguments.change_ratio)):
+        fileid, size = row[0], row[4]
+        data = content(-fileid, size)
+        (bucket / f"urn:oid:{fileid}").unlink()
+        (bucket / f"urn:oid:{fileid}").write_bytes(data)
+        checksum = f"SHA1:{sha1_hex(data)}" if row[3] else ""
+        changed.append(
+            row[:3] + (checksum, size, row[5] + 1, f"etag{fileid}-2") + row[7:]
+        )
+    return changed
+
+
+def sha1_hex(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()  # nosec
+
+
+def connect(settings: dict):
+    if settings["pg_dsn"]:
+        import psycopg2
+
+        cnx = psycopg2.connect(settings["pg_dsn"])
+        cnx.cursor().execute(f"SET search_path TO {PG_SCHEMA}")
+        return cnx, "%s"
+    return sqlite3.connect(settings["sqlite"]), "?"
+
+
+def load_rows(settings: dict, rows: List[tuple]):
+    cnx, param = connect(settings)
+    cursor = cnx.cursor()
+    if settings["pg_dsn"]:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {PG_SCHEMA} CASCADE")
+        cursor.execute(f"CREATE SCHEMA {PG_SCHEMA}")
+        cursor.execute(f"SET search_path TO {PG_SCHEMA}")
+    cursor.execute(SCHEMA)
+    cursor.executemany(
+        f"INSERT INTO oc_filecache VALUES ({', '.join([param] * 9)})", rows
+    )
+    if settings["pg_dsn"]:
+        cursor.execute("CREATE INDEX ON oc_filecache (storage, path text_pattern_ops)")
+        cursor.execute("ANALYZE oc_filecache")
+    else:
+        cursor.execute("CREATE INDEX oc_filecache_path ON oc_filecache (storage, path)")
+    cnx.commit()
+    cnx.close()
+
+
+def update_rows(settings: dict, rows: List[tuple]):
+    cnx, param = connect(settings)
+    cnx.cursor().executemany(
+        f"UPDATE oc_filecache SET checksum = {param}, mtime = {param}, "
+        f"etag = {param} WHERE fileid = {param}",
+        [(row[3], row[5], row[6], row[0]) for row in rows],
+    )
+    cnx.commit()
+    cnx.close()
+
+
+def make_backup(settings: dict, snapshot: str, **params) -> NextcloudS3Backup:
+    root = Path(settings["directory"])
+    if settings["pg_dsn"]:
+        dao = DaoNextcloudFiles(settings["pg_dsn"], schema=PG_SCHEMA)
+    else:
+        dao = SqliteNextcloudFiles(Path(settings["sqlite"]))
+    config = NextCloudS3BackupConfig(
+        # no strftime directive: the snapshot is named after the phase
+        backup_date_format=snapshot,
+        mapping=[
+            NextcloudDirectoryConfig(
+                storage_id=STORAGE_ID,
+                user_name="bench",
+                bucket=root / "bucket",
+                nextcloud_path="files/",
+                backup_root_path=root / "backup",
+            )
+        ],
+    )
+    backup_class = NextcloudS3Backup
+    if settings["transfer_engine"] == "asyncio":
+        backup_class = AsyncNextcloudS3Backup
+    return backup_class(
+        dao,
+        config,
+        workers=settings["workers"],
+        download_plan=settings["download_plan"],
+        profile=settings["profile"],
+        **params,
+    )
+
+
+def count_files(directory: Path) -> int:
+    return sum(len(files) for _, _, files in os.walk(directory))
+
+
+def full_backup(settings: dict) -> Dict[str, int]:
+    # with --delta, the full backup writes the manifest of the next one
+    make_backup(settings, FULL, delta=settings["delta"]).backup()
+    return dict(files=settings["rows"], bytes=downloads["bytes"])
+
+
+def incremental_backup(settings: dict) -> Dict[str, int]:
+    make_backup(settings, INCREMENTAL, delta=settings["delta"]).backup()
+    return dict(files=settings["rows"], bytes=downloads["bytes"])
+
+
+def inode_scan(settings: dict) -> Dict[str, int]:
+    snapshot = Path(settings["directory"]) / "backup" / SNAPSHOT_DIRNAME / INCREMENTAL
+    inodes = make_backup(settings, INCREMENTAL)._get_inodes(snapshot)
+    return dict(files=count_files(snapshot), bytes=0, inodes=len(inodes))
+
+
+def purge(settings: dict) -> Dict[str, int]:
+    root = Path(settings["directory"]) / "backup"
+    shutil.rmtree(root / SNAPSHOT_DIRNAME / FULL)
+    repository_files = count_files(root / REPOSITORY_DIRNAME)
+    make_backup(settings, INCREMENTAL).purge()
+    return dict(
+        files=repository_files,
+        bytes=0,
+        purged=repository_files - count_files(root / REPOSITORY_DIRNAME),
+    )
+
+
+PHASES = dict(
+    full_backup=full_backup,
+    incremental_backup=incremental_backup,
+    inode_scan=inode_scan,
+    purge=purge,
+)
+
+
+def proc_io() -> Dict[str, int]:
+    try:
+        with open("/proc/self/io") as io:
+            return {
+                key: int(value)
+                for key, value in (line.split(": ") for line in io.read().splitlines())
+            }
+    except OSError:
+        return {}
+
+
+def run_phase(phase: str, settings: dict) -> dict:
+    """Run a phase in the current (fresh) process and measure it"""
+    logging.basicConfig(level=settings["logging_level"])
+    install_fake_s3()
+    io_before, usage_before = proc_io(), resource.getrusage(resource.RUSAGE_SELF)
+    start = perf_counter()
+    result = PHASES[phase](settings)
+    seconds = perf_counter() - start
+    io_after, usage_after = proc_io(), resource.getrusage(resource.RUSAGE_SELF)
+    # kB on linux, bytes on macOS
+    peak_rss = usage_after.ru_maxrss * (1 if platform.system() == "Darwin" else 1024)
+    result.update(
+        seconds=seconds,
+        files_per_s=result["files"] / seconds,
+        mb_per_s=result["bytes"] / MB / seconds,
+        downloads=downloads["count"],
+        peak_rss_mb=peak_rss / MB,
+        syscalls=dict(
+            read=io_after.get("syscr", 0) - io_before.get("syscr", 0),
+            write=io_after.get("syscw", 0) - io_before.get("syscw", 0),
+        ),
+        block_io=dict(
+            read=usage_after.ru_inblock - usage_before.ru_inblock,
+            write=usage_after.ru_oublock - usage_before.ru_oublock,
+        ),
+        context_switches=dict(
+            voluntary=usage_after.ru_nvcsw - usage_before.ru_nvcsw,
+            involuntary=usage_after.ru_nivcsw - usage_before.ru_nivcsw,
+        ),
+        operations=dict(registry.summaries()),
+    )
+    if settings["profile"] and phase.endswith("_backup"):
+        result["profile"] = profiler.summary()
+    return result
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(  # nosec
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).parent,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict, baseline: dict):
+    print(f"{'phase':<20} {'files/s':>12} {'baseline':>12} {'ratio':>7}")
+    for phase, result in results["phases"].items():
+        base = baseline["phases"].get(phase)
+        if not base:
+            continue
+        print(
+            f"{phase:<20} {result['files_per_s']:>12,.0f} "
+            f"{base['files_per_s']:>12,.0f} "
+            f"{result['files_per_s'] / base['files_per_s']:>6.2f}x"
+        )
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    data = parser.add_argument_group("Synthetic oc_filecache")
+    data.add_argument("--rows", type=int, default=10_000)
+    data.add_argument("--seed", type=int, default=42)
+    data.add_argument("--directories", type=int, default=100)
+    data.add_argument(
+        "--median-size-kb",
+        type=float,
+        default=32,
+        help="Median of the log-normal files size distribution",
+    )
+    data.add_argument("--max-size-mb", type=int, default=64)
+    data.add_argument("--empty-ratio", type=float, default=0.05)
+    data.add_argument(
+        "--duplicate-ratio",
+        type=float,
+        default=0.2,
+        help="Rows copying the content of a previous row (other fileid)",
+    )
+    data.add_argument(
+        "--no-sha1-ratio",
+        type=float,
+        default=0.3,
+        help="Rows without SHA1 checksum (backup-ed through their S3 etag)",
+    )
+    data.add_argument(
+        "--change-ratio",
+        type=float,
+        default=0.01,
+        help="Rows changed before the incremental backup",
+    )
+    data.add_argument(
+        "--pg-dsn",
+        help=(
+            f"Load oc_filecache in the {PG_SCHEMA} schema (dropped first) of "
+            "this local PostgreSQL database instead of SQLite"
+        ),
+    )
+    backup = parser.add_argument_group("Backup")
+    backup.add_argument("-w", "--workers", type=int, default=1)
+    backup.add_argument(
+        "--transfer-engine", default="threads", choices=("threads", "asyncio")
+    )
+    backup.add_argument("--download-plan", action="store_true")
+    backup.add_argument(
+        "--no-delta",
+        dest="delta",
+        action="store_false",
+        help="Incremental backup without --delta",
+    )
+    backup.add_argument(
+        "--profile",
+        action="store_true",
+        help="Profile backups phases (to measure the profiling overhead too)",
+    )
+    parser.add_argument("--directory", type=Path, help="Parent of the work directory")
+    parser.add_argument("--keep", action="store_true", help="Keep the work directory")
+    parser.add_argument("--output", type=Path, help="Write results to this JSON file")
+    parser.add_argument(
+        "--compare", type=Path, help="Compare files/s with a previous results file"
+    )
+    parser.add_argument("-l", "--logging-level", default="WARNING")
+    arguments = parser.parse_args()
+    if arguments.download_plan and arguments.delta:
+        parser.error("--download-plan can't be used with --delta, add --no-delta")
+    return arguments
+
+
+def main():
+    arguments = parse_arguments()
+    work_directory = Path(tempfile.mkdtemp(dir=arguments.directory))
+    settings = dict(
+        directory=str(work_directory),
+        sqlite=str(work_directory / "oc_filecache.sqlite"),
+        pg_dsn=arguments.pg_dsn,
+        rows=arguments.rows,
+        workers=arguments.workers,
+        transfer_engine=arguments.transfer_engine,
+        download_plan=arguments.download_plan,
+        delta=arguments.delta,
+        profile=arguments.profile,
+        logging_level=arguments.logging_level.upper(),
+    )
+    results = dict(
+        arguments={
+            key: str(value) if isinstance(value, Path) else value
+            for key, value in vars(arguments).items()
+        },
+        environment=dict(
+            python=platform.python_version(),
+            platform=platform.platform(),
+            cpus=os.cpu_count(),
+            revision=git_revision(),
+        ),
+        phases={},
+    )
+    # fresh process per phase: peak RSS and counters of one phase only
+    context = multiprocessing.get_context("spawn")
+    try:
+        bucket = work_directory / "bucket"
+        bucket.mkdir()
+        start = perf_counter()
+        rows = generate_rows(arguments, bucket)
+        load_rows(settings, rows)
+        print(f"{len(rows):,} rows generated in {perf_counter() - start:.1f}s")
+        for phase in PHASES:
+            if phase == "incremental_backup":
+                update_rows(settings, change_rows(arguments, rows, bucket))
+            with context.Pool(1) as pool:
+                result = pool.apply(run_phase, (phase, settings))
+            results["phases"][phase] = result
+            print(
+                f"{phase:<20} {result['seconds']:>8.2f}s - "
+                f"{result['files_per_s']:>10,.0f} files/s - "
+                f"{result['mb_per_s']:>8.1f} MB/s - "
+                f"peak RSS {result['peak_rss_mb']:>7.1f} MB - "
+                f"syscalls r/w {result['syscalls']['read']:,}"
+                f"/{result['syscalls']['write']:,}"
+            )
+    finally:
+        if arguments.keep:
+            print(f"Work directory kept: {work_directory}")
+        else:
+            shutil.rmtree(work_directory)
+    if arguments.output:
+        arguments.output.write_text(json.dumps(results, indent=2, sort_keys=True))
+    if arguments.compare:
+        compare(results, json.loads(arguments.compare.read_text()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Micro-benchmark NextcloudFile memory usage and construction speed.
+
+Compare the current slotted ``NextcloudFile`` with the previous plain
+dataclass implementation on a synthetic ``oc_filecache`` result set::
+
+    python benchmarks/bench_nextcloud_file.py --rows 1000000
+"""
+import argparse
+import gc
+import tracemalloc
+from dataclasses import dataclass
+from pathlib import PurePath
+from time import perf_counter
+
+from nc_s3_backup.api.db import NextcloudFile
+
+
+@dataclass
+class DataclassNextcloudFile:
+    """NextcloudFile implementation before using slots"""
+
+    fileid: int
+    storage: int
+    path: str
+    checksum: str
+    size: int
+
+    @property
+    def hash_path(self):
+        method, hash_value = self.checksum.lower().split(":", 1)
+        return PurePath(method, hash_value[:2], hash_value[2:])
+
+
+def synthetic_rows(count):
+    return [
+        (
+            fileid,
+            2,
+            f"files/directory-{fileid % 1000}/file-{fileid}.txt",
+            f"SHA1:{fileid:040x}",
+            fileid % 100000,
+        )
+        for fileid in range(count)
+    ]
+
+
+def measure(cls, rows):
+    gc.collect()
+    start = perf_counter()
+    files = [cls(*row) for row in rows]
+    construction = perf_counter() - start
+
+    start = perf_counter()
+    for nc_file in files:
+        nc_file.hash_path
+        nc_file.hash_path
+    hash_path = perf_counter() - start
+    del files
+
+    gc.collect()
+    tracemalloc.start()
+    files = [cls(*row) for row in rows]
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del files
+    return {
+        "bytes/row": memory / len(rows),
+        "rows/s": len(rows) / construction,
+        "hash_path x2 rows/s": len(rows) / hash_path,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    arguments = parser.parse_args()
+    rows = synthetic_rows(arguments.rows)
+    for name, cls in [
+        ("dataclass (before)", DataclassNextcloudFile),
+        ("slots (after)", NextcloudFile),
+    ]:
+        result = measure(cls, rows)
+        print(
+            f"{name:<20} "
+            + " - ".join(f"{key}: {value:,.0f}" for key, value in result.items())
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Benchmark inode scan of a snapshot like tree made of hard links.
+
+Compare the previous recursive ``Path.iterdir`` / ``Path.stat`` walk with
+the ``os.scandir`` based ``walk_files``::
+
+    python benchmarks/bench_walk.py --links 1000000 --directory /tmp/bench
+"""
+import argparse
+import os
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+from nc_s3_backup.api.walk import walk_files
+
+
+def iterdir_inodes(directory, inodes=None):
+    """Inode scan as done before using walk_files"""
+    if not inodes:
+        inodes = set()
+    for child in directory.iterdir():
+        if child.is_dir():
+            inodes = iterdir_inodes(child, inodes=inodes)
+        else:
+            inodes |= {child.stat().st_ino}
+    return inodes
+
+
+def scandir_inodes(directory):
+    return {entry.inode() for entry in walk_files(directory)}
+
+
+def make_tree(root, links, files_per_directory, blobs):
+    repository = root / "blobs"
+    repository.mkdir()
+    for blob in range(blobs):
+        (repository / str(blob)).write_bytes(b"")
+    for index in range(links):
+        directory = root / "snapshot" / str(index // files_per_directory)
+        if not index % files_per_directory:
+            directory.mkdir(parents=True)
+        os.link(repository / str(index % blobs), directory / str(index))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--links", type=int, default=1_000_000)
+    parser.add_argument("--files-per-directory", type=int, default=1000)
+    parser.add_argument(
+        "--blobs",
+        type=int,
+        default=50_000,
+        help="Distinct files hard linked, keep it under file system link limit",
+    )
+    parser.add_argument("--directory", type=Path, default=None)
+    arguments = parser.parse_args()
+    with tempfile.TemporaryDirectory(dir=arguments.directory) as tmp:
+        root = Path(tmp)
+        start = perf_counter()
+        make_tree(root, arguments.links, arguments.files_per_directory, arguments.blobs)
+        print(
+            f"tree with {arguments.links:,} links created in {perf_counter() - start:.1f}s"
+        )
+        for name, func in [
+            ("Path.iterdir (before)", iterdir_inodes),
+            ("os.scandir (after)", scandir_inodes),
+        ]:
+            start = perf_counter()
+            inodes = func(root / "snapshot")
+            print(f"{name:<22} {perf_counter() - start:.2f}s - {len(inodes):,} inodes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,564 @@
+import asyncio
+import hashlib
+import logging
+from asyncio import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from functools import partial
+from itertools import chain, islice
+from operator import attrgetter
+from pathlib import Path
+from time import perf_counter
+from typing import (
+    Any,
+    AsyncIterator,
+    BinaryIO,
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
+
+from botocore.exceptions import ClientError
+
+from nc_s3_backup.api.backup import REPOSITORY_DIRNAME, NextcloudS3Backup
+from nc_s3_backup.api.config import NextcloudDirectoryConfig
+from nc_s3_backup.api.db import NextcloudFile
+from nc_s3_backup.api.listing import bucket_and_key
+from nc_s3_backup.api.manifest import ManifestEntry, SnapshotManifest
+from nc_s3_backup.api.plan import Blob
+from nc_s3_backup.api.profiling import WAIT_PHASE, profiler
+from nc_s3_backup.api.s3 import head_object, object_not_found
+
+try:
+    from aiobotocore.config import AioConfig
+    from aiobotocore.session import get_session
+except ImportError:  # pragma: no cover
+    get_session = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 64
+DEFAULT_WRITE_WORKERS = 4
+# items (ie: database rows) read at once out of the event loop
+READ_BATCH_SIZE = 1000
+
+
+def aio_config(config) -> Any:
+    """aiobotocore counterpart of a botocore client ``Config``"""
+    return AioConfig(
+        signature_version=config.signature_version,
+        max_pool_connections=config.max_pool_connections,
+        retries=config.retries,
+        connect_timeout=config.connect_timeout,
+        read_timeout=config.read_timeout,
+        tcp_keepalive=config.tcp_keepalive,
+    )
+
+
+class AsyncSingleFlight:
+    """``SingleFlight`` counterpart for coroutines running in the same event
+    loop.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+        self.executed = 0
+        self.shared = 0
+
+    async def do(self, key: Hashable, func: Callable, *args) -> Tuple[Any, bool]:
+        """Return ``await func(*args)`` result and whether it was shared"""
+        future = self._calls.get(key)
+        if future is not None:
+            self.shared += 1
+            # shield: a cancelled follower must not cancel the leader call
+            return await asyncio.shield(future), True
+        future = self._calls[key] = asyncio.get_running_loop().create_future()
+        self.executed += 1
+        try:
+            result = await func(*args)
+        except BaseException as error:
+            future.set_exception(error)
+            # retrieved or not by followers
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            del self._calls[key]
+
+
+@dataclass
+class AsyncNextcloudS3Backup(NextcloudS3Backup):
+    """Backup files from one event loop, keeping up to ``concurrency`` S3
+    GET/HEAD requests in flight (lane ``workers`` downloads per lane if
+    ``lanes`` are set).
+
+    Mostly useful for small files where request latency matters more than
+    bandwidth: waiting for S3 doesn't hold a thread. Requests are sent
+    using aiobotocore if installed (``s3_client_params`` are the
+    ``create_client`` parameters), otherwise the sync S3 operations are run
+    in a ``concurrency`` threads pool.
+
+    Downloaded chunks are hashed and written to disk by ``write_workers``
+    threads, the next chunk of a file is read only once the previous one
+    is written so slow disks slow down downloads instead of filling the
+    memory. Repository layout is the same as ``NextcloudS3Backup``.
+    """
+
+    concurrency: int = DEFAULT_CONCURRENCY
+    write_workers: int = DEFAULT_WRITE_WORKERS
+    s3_client_params: Dict[str, Any] = field(default_factory=dict)
+
+    _aio_client: Any = None
+    _requests: asyncio.Semaphore = None
+    # downloads in flight per lane when lanes are set
+    _lane_requests: List[asyncio.Semaphore] = None
+    _async_flights: AsyncSingleFlight = None
+    _executor: ThreadPoolExecutor = None
+    _write_executor: ThreadPoolExecutor = None
+
+    def _backup_mappings(self):
+        asyncio.run(self._backup_mappings_async())
+
+    async def _backup_mappings_async(self):
+        """``_backup_mappings`` counterpart, all mappings share the same event
+        loop, S3 client and executors
+        """
+        async with self._transfer_context():
+            if self.download_plan:
+                for storage_id, dir_configs in self.mappings_per_storage().items():
+                    for dir_config in dir_configs:
+                        await self._run_blocking(self._prepare_mapping, dir_config)
+                    await self._backup_storage_async(storage_id, dir_configs)
+            else:
+                for dir_config in self.config.mapping:
+                    await self._run_blocking(self._prepare_mapping, dir_config)
+                    await self._backup_directory_async(dir_config)
+
+    async def _backup_directory_async(self, dir_config: NextcloudDirectoryConfig):
+        """``_backup_directory`` counterpart"""
+        logger.info(
+            "Backup-ing %s - %s ...", dir_config.user_name, dir_config.nextcloud_path
+        )
+        nc_files = profiler.iterate(
+            "db",
+            self.dao.get_nc_subtree(
+                dir_config.storage_id,
+                dir_config.nextcloud_path,
+                self.config.excluded_mimetype_ids,
+                mimetypes=self.config.included_mimetype_ids,
+                mimeparts=self.config.included_mimepart_ids,
+            ),
+        )
+        if self.delta:
+            await self._backup_directory_delta_async(dir_config, nc_files)
+            return
+        await self._run_async(
+            partial(self._backup_file_async, dir_config=dir_config),
+            self._not_journaled(dir_config, nc_files),
+            size=attrgetter("size"),
+        )
+
+    async def _backup_storage_async(
+        self, storage_id: int, dir_configs: List[NextcloudDirectoryConfig]
+    ):
+        """``_backup_storage`` counterpart"""
+        plan = await self._run_blocking(self.plan_storage, storage_id, dir_configs)
+        await self._run_async(
+            self._fetch_blob_async, plan.missing_blobs(), size=attrgetter("size")
+        )
+        await self._run_blocking(self._link_plan, plan)
+
+    async def _fetch_blob_async(self, blob: Blob):
+        """``_fetch_blob`` counterpart"""
+        for dir_config, nc_file, _ in blob.fileid_rows():
+            repo_file = await self._resolve_repo_file_async(
+                nc_file, dir_config, dir_config.bucket / f"urn:oid:{nc_file.fileid}"
+            )
+            if not repo_file:
+                continue
+            if blob.checksum is None or nc_file.checksum.lower() == blob.checksum:
+                blob.repo_file = repo_file
+                return
+            blob.repo_files[nc_file.fileid] = repo_file
+
+    @asynccontextmanager
+    async def _transfer_context(self):
+        """Setup S3 client, executors and locks bound to the running loop,
+        once per backup
+        """
+        self._requests = asyncio.Semaphore(self.concurrency)
+        self._lane_requests = [asyncio.Semaphore(lane.workers) for lane in self.lanes]
+        self._async_flights = AsyncSingleFlight()
+        self._write_executor = ThreadPoolExecutor(
+            max_workers=self.write_workers, thread_name_prefix="nc-s3-backup-write"
+        )
+        # sync S3 operations: all of them without aiobotocore, lanes
+        # multipart downloads otherwise
+        self._executor = ThreadPoolExecutor(
+            max_workers=max([self.concurrency] + [lane.workers for lane in self.lanes]),
+            thread_name_prefix="nc-s3-backup",
+        )
+        try:
+            if get_session is not None and self.s3_client_params:
+                params = dict(self.s3_client_params)
+                if params.get("config") is not None:
+                    params["config"] = aio_config(params["config"])
+                async with get_session().create_client("s3", **params) as client:
+                    self._aio_client = client
+                    yield
+            else:
+                yield
+        finally:
+            self._flights.executed += self._async_flights.executed
+            self._flights.shared += self._async_flights.shared
+            self._aio_client = None
+            self._executor.shutdown()
+            self._write_executor.shutdown()
+
+    async def _run_async(
+        self,
+        func: Callable,
+        items: Iterable,
+        size: Optional[Callable[[Any], int]] = None,
+    ):
+        """Await ``func(item)`` for each item, ``_run_concurrently``
+        counterpart: at most ``concurrency * 2`` items (or lane
+        ``max_queued`` items per lane) are pending and the first exception
+        cancel pending items and is raised again here.
+        """
+        max_pending = [lane.max_queued for lane in self.lanes]
+        if not max_pending or size is None:
+            max_pending = [self.concurrency * 2]
+        pending = [set() for _ in max_pending]
+        try:
+            async for item in self._iterate_blocking(items):
+                index = self._lane_index(size(item)) if len(pending) > 1 else 0
+                if len(pending[index]) >= max_pending[index]:
+                    # only this coroutine waits within a phase, phases
+                    # of other coroutines don't span an ``await``
+                    with profiler.phase(WAIT_PHASE):
+                        done, pending[index] = await asyncio.wait(
+                            pending[index], return_when=FIRST_COMPLETED
+                        )
+                    for task in done:
+                        task.result()
+                pending[index].add(asyncio.ensure_future(func(item)))
+            with profiler.phase(WAIT_PHASE):
+                for task in chain.from_iterable(pending):
+                    await task
+        except BaseException:
+            for task in chain.from_iterable(pending):
+                task.cancel()
+            raise
+
+    async def _iterate_blocking(self, items: Iterable) -> AsyncIterator:
+        """Yield ``items`` read by batches of ``READ_BATCH_SIZE`` in the write
+        executor, so a slow database cursor doesn't block the event loop
+        """
+        iterator = iter(items)
+        while True:
+            batch = await self._run_blocking(list, islice(iterator, READ_BATCH_SIZE))
+            if not batch:
+                return
+            for item in batch:
+                yield item
+
+    async def _backup_directory_delta_async(
+        self, dir_config: NextcloudDirectoryConfig, nc_files: Iterable[NextcloudFile]
+    ):
+        mapping = self._mapping_key(dir_config)
+        manifest, previous_manifest = self._get_manifests(dir_config.backup_root_path)
+        previous_entries = (
+            previous_manifest.entries(mapping) if previous_manifest else {}
+        )
+        stats = dict(added=0, changed=0, unchanged=0)
+        await self._run_async(
+            partial(
+                self._backup_file_delta_async,
+                dir_config=dir_config,
+                manifest=manifest,
+                mapping=mapping,
+            ),
+            self._delta_items(dir_config, nc_files, previous_entries, stats),
+            size=lambda item: item[0].size,
+        )
+        self._log_delta_stats(dir_config, stats, len(previous_entries))
+
+    async def _backup_file_delta_async(
+        self,
+        item: Tuple[NextcloudFile, Optional[ManifestEntry]],
+        dir_config: NextcloudDirectoryConfig,
+        manifest: SnapshotManifest,
+        mapping: str,
+    ):
+        nc_file, previous_entry = item
+        checksum = nc_file.checksum
+        local_file = None
+        if previous_entry:
+            local_file = await self._run_blocking(
+                self._link_unchanged_file, nc_file, dir_config, previous_entry.sha1
+            )
+        if not local_file:
+            local_file = await self._backup_file_async(nc_file, dir_config)
+        if not local_file:
+            return
+        await self._run_blocking(
+            self._add_manifest_entry, manifest, mapping, nc_file, checksum
+        )
+        return local_file
+
+    async def _backup_file_async(
+        self, nc_file: NextcloudFile, dir_config: NextcloudDirectoryConfig
+    ) -> Optional[Path]:
+        if nc_file.size == 0:
+            return await self._run_blocking(
+                self._commit_local_file, nc_file, dir_config, None
+            )
+        s3_path = dir_config.bucket / f"urn:oid:{nc_file.fileid}"
+        cached_file, repo_file = await self._run_blocking(
+            self._repo_file_from_cache, nc_file, dir_config
+        )
+        if not repo_file:
+            repo_file = await self._resolve_repo_file_async(
+                nc_file, dir_config, s3_path
+            )
+            if not repo_file:
+                return
+            await self._run_blocking(
+                self._update_cache, nc_file, dir_config, cached_file
+            )
+        return await self._run_blocking(
+            self._commit_local_file, nc_file, dir_config, repo_file
+        )
+
+    def _commit_local_file(
+        self,
+        nc_file: NextcloudFile,
+        dir_config: NextcloudDirectoryConfig,
+        repo_file: Optional[Path],
+    ) -> Path:
+        """Link ``nc_file`` snapshot file to ``repo_file`` (touch it if
+        None) and journal it, run by the write executor
+        """
+        local_file = self._local_file(nc_file, dir_config)
+        if repo_file is None:
+            local_file = self._touch_empty_file(local_file)
+        else:
+            local_file = self._link_repo_file(repo_file, local_file, dir_config)
+        return self._journal_file(nc_file, dir_config, local_file)
+
+    async def _run_blocking(self, func: Callable, *args) -> Any:
+        """Await ``func(*args)`` run by the write executor: file system and
+        sqlite calls must not block the event loop
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            self._write_executor, func, *args
+        )
+
+    async def _resolve_repo_file_async(
+        self,
+        nc_file: NextcloudFile,
+        dir_config: NextcloudDirectoryConfig,
+        s3_path: Path,
+    ) -> Optional[Path]:
+        if nc_file.checksum and nc_file.checksum.lower().startswith("sha1"):
+            return await self._backup_file_with_sha1_async(nc_file, dir_config, s3_path)
+        return await self._backup_file_without_sha1_async(nc_file, dir_config, s3_path)
+
+    async def _backup_file_with_sha1_async(
+        self,
+        nc_file: NextcloudFile,
+        dir_config: NextcloudDirectoryConfig,
+        s3_path: Path,
+    ) -> Optional[Path]:
+        repo_file = dir_config.backup_root_path / REPOSITORY_DIRNAME / nc_file.hash_path
+        if await self._run_blocking(repo_file.exists):
+            return repo_file
+        while True:
+            flight_repo_file, shared = await self._async_flights.do(
+                repo_file,
+                self._download_sha1_file_async,
+                nc_file,
+                dir_config,
+                s3_path,
+                repo_file,
+            )
+            if not shared or flight_repo_file == repo_file:
+                return flight_repo_file
+            # S3 object of the flight leader is missing or its content doesn't
+            # match nextcloud checksum, try with ours
+
+    async def _download_sha1_file_async(
+        self,
+        nc_file: NextcloudFile,
+        dir_config: NextcloudDirectoryConfig,
+        s3_path: Path,
+        repo_file: Path,
+    ) -> Optional[Path]:
+        if await self._run_blocking(repo_file.exists):
+            # published by a flight which just landed
+            return repo_file
+        if await self._s3_object_etag_async(nc_file, dir_config, s3_path) is None:
+            self._warn_missing_s3_file(nc_file, s3_path)
+            return
+        downloading_path = repo_file.with_suffix(".downloading")
+        await self._run_blocking(self._start_download, dir_config, downloading_path)
+        sha1 = await self._fetch_s3_file_async(s3_path, downloading_path, nc_file.size)
+        return await self._run_blocking(
+            self._publish_repo_file,
+            dir_config,
+            downloading_path,
+            self._downloaded_repo_file(nc_file, dir_config, sha1, repo_file),
+        )
+
+    async def _backup_file_without_sha1_async(
+        self,
+        nc_file: NextcloudFile,
+        dir_config: NextcloudDirectoryConfig,
+        s3_path: Path,
+    ) -> Optional[Path]:
+        etag = await self._s3_object_etag_async(nc_file, dir_config, s3_path)
+        if etag is None:
+            self._warn_missing_s3_file(nc_file, s3_path)
+            return
+        nc_file.checksum = f"ETAG:{etag}"
+        etag_repo_file = (
+            dir_config.backup_root_path / REPOSITORY_DIRNAME / nc_file.hash_path
+        )
+        if await self._run_blocking(etag_repo_file.exists):
+            return await self._run_blocking(
+                self._resolve_etag_file, nc_file, dir_config, etag_repo_file
+            )
+        repo_file, shared = await self._async_flights.do(
+            etag_repo_file,
+            self._fetch_etag_file_async,
+            nc_file,
+            dir_config,
+            s3_path,
+            etag_repo_file,
+        )
+        return self._shared_repo_file(nc_file, repo_file) if shared else repo_file
+
+    async def _fetch_etag_file_async(
+        self,
+        nc_file: NextcloudFile,
+        dir_config: NextcloudDirectoryConfig,
+        s3_path: Path,
+        etag_repo_file: Path,
+    ) -> Path:
+        if await self._run_blocking(etag_repo_file.exists):
+            # published by a flight which just landed
+            return await self._run_blocking(
+                self._resolve_etag_file, nc_file, dir_config, etag_repo_file
+            )
+        downloading_path = etag_repo_file.with_suffix(".downloading")
+        await self._run_blocking(self._start_download, dir_config, downloading_path)
+        nc_file.checksum = await self._fetch_s3_file_async(
+            s3_path, downloading_path, nc_file.size
+        )
+        return await self._run_blocking(
+            self._publish_etag_file,
+            nc_file,
+            dir_config,
+            downloading_path,
+            etag_repo_file,
+        )
+
+    async def _s3_object_etag_async(
+        self,
+        nc_file: NextcloudFile,
+        dir_config: NextcloudDirectoryConfig,
+        s3_path: Path,
+    ) -> Optional[str]:
+        """S3 object etag, None if the object doesn't exist"""
+        listing = self._bucket_listings.get(str(dir_config.bucket))
+        listed = listing.get(nc_file.fileid) if listing is not None else None
+        if listed is not None:
+            return listed.etag
+        # not listed: out of the listed fileid range or uploaded since
+        async with self._requests:
+            if self._aio_client is None:
+                return await asyncio.get_running_loop().run_in_executor(
+                    self._executor, self._s3_object_etag_or_none, s3_path
+                )
+            bucket, key = bucket_and_key(s3_path)
+            start = perf_counter()
+            try:
+                response = await self._aio_client.head_object(Bucket=bucket, Key=key)
+            except ClientError as error:
+                if object_not_found(error):
+                    return None
+                raise
+            finally:
+                profiler.add("s3_head", perf_counter() - start)
+            return response["ETag"].strip('"')
+
+    def _s3_object_etag_or_none(self, s3_path: Path) -> Optional[str]:
+        with profiler.phase("s3_head"):
+            if self.s3_client is not None:
+                response = head_object(self.s3_client, s3_path)
+                return response["ETag"].strip('"') if response else None
+            if not s3_path.exists():
+                return None
+            return s3_path.stat().etag
+
+    async def _fetch_s3_file_async(
+        self, s3_path: Path, download_path: Path, size: Optional[int] = None
+    ) -> str:
+        """Download ``s3_path`` to ``download_path`` and return its SHA1.
+
+        With lanes, downloads in flight are bounded by the lane ``workers``
+        and lanes with a ``transfer_config`` download with threads (multipart
+        ranged GETs).
+        """
+        loop = asyncio.get_running_loop()
+        lane = self._lane(size)
+        requests = (
+            self._lane_requests[self._lane_index(size)] if lane else self._requests
+        )
+        async with requests:
+            if self._aio_client is None or (lane and lane.transfer_config):
+                return await loop.run_in_executor(
+                    self._executor, self._fetch_s3_file, s3_path, download_path, size
+                )
+            bucket, key = bucket_and_key(s3_path)
+            start = perf_counter()
+            response = await self._aio_client.get_object(Bucket=bucket, Key=key)
+            profiler.add("s3_get", perf_counter() - start)
+            sha1 = hashlib.sha1()  # nosec
+            destination = await self._run_blocking(download_path.open, "wb")
+            try:
+                async with response["Body"] as body:
+                    start = perf_counter()
+                    chunk = await body.read(self.hash_buffer_size)
+                    profiler.add("s3_get", perf_counter() - start, len(chunk))
+                    while chunk:
+                        # backpressure: next chunk is read once this one is
+                        # written
+                        await loop.run_in_executor(
+                            self._write_executor,
+                            self._write_chunk,
+                            sha1,
+                            destination,
+                            chunk,
+                        )
+                        start = perf_counter()
+                        chunk = await body.read(self.hash_buffer_size)
+                        profiler.add("s3_get", perf_counter() - start, len(chunk))
+            finally:
+                await self._run_blocking(destination.close)
+        return f"SHA1:{sha1.hexdigest()}"
+
+    @staticmethod
+    def _write_chunk(sha1, destination: BinaryIO, chunk: bytes):
+        with profiler.phase("hash", len(chunk)):
+            sha1.update(chunk)
+        with profiler.phase("write", len(chunk)):
+            destination.write(chunk)
@@ -1,39 +1,197 @@
+import errno
 import hashlib
 import logging
 import os
-import statistics
+import shutil
+import threading
 from collections import namedtuple
-from dataclasses import dataclass
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass, field
 from datetime import datetime
+from functools import partial
+from itertools import chain, count
+from operator import attrgetter
 from pathlib import Path
 from time import perf_counter
-from typing import Dict, List, Set
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
 
 from nc_s3_backup.api.config import NextcloudDirectoryConfig, NextCloudS3BackupConfig
 from nc_s3_backup.api.db import DaoNextcloudFiles, NextcloudFile
+from nc_s3_backup.api.index import (
+    CachedFile,
+    RepositoryIndex,
+    hash_from_path,
+    original_path,
+    replica_number,
+    replica_path,
+)
+from nc_s3_backup.api.listing import ObjectInfo, bucket_and_key, list_bucket
+from nc_s3_backup.api.manifest import (
+    ManifestEntry,
+    SnapshotJournal,
+    SnapshotManifest,
+    latest_completion_time,
+    remove_inodes_manifest,
+    update_from_inodes_manifest,
+    write_inodes_manifest,
+)
+from nc_s3_backup.api.metrics import registry, timer
+from nc_s3_backup.api.plan import Blob, DownloadPlan
+from nc_s3_backup.api.profiling import WAIT_PHASE, profiler
+from nc_s3_backup.api.s3 import connection_stats, head_object
+from nc_s3_backup.api.walk import split_tree, walk_files
 
 logger = logging.getLogger(__name__)
 
 
 REPOSITORY_DIRNAME = ".data"
 SNAPSHOT_DIRNAME = "snapshots"
-GB = 1024 * 1024 * 1024
-time_reports = {}
+MB = 1024 * 1024
+GB = 1024 * MB
+DEFAULT_HASH_BUFFER_SIZE = MB
+# hard links per file if the file system doesn't tell (ext4 limit)
+DEFAULT_MAX_LINKS = 65000
+_thread_local = threading.local()
 
-PurgedFile = namedtuple("PurgedFile", ["size"])
+PurgedFile = namedtuple("PurgedFile", ["size", "path"])
+# Files up to ``max_size`` bytes (no limit if None) are backup-ed by their
+# own ``workers`` threads, at most ``max_queued`` files wait for a worker.
+# Without ``transfer_config`` files are downloaded using a single GET
+# request, otherwise using multipart ranged GET requests.
+SizeLane = namedtuple(
+    "SizeLane", ["max_size", "workers", "transfer_config", "max_queued"]
+)
 
 
-def timer(func):
-    def wrap_func(*args, **kwargs):
-        t1 = perf_counter()
-        result = func(*args, **kwargs)
-        t2 = perf_counter()
-        if func.__name__ not in time_reports.keys():
-            time_reports[func.__name__] = []
-        time_reports[func.__name__].append(t2 - t1)
-        return result
+def _get_buffer(size: int) -> bytearray:
+    """Return a buffer of ``size`` bytes allocated once per thread"""
+    buffer = getattr(_thread_local, "buffer", None)
+    if buffer is None or len(buffer) != size:
+        buffer = _thread_local.buffer = bytearray(size)
+    return buffer
 
-    return wrap_func
+
+def make_directory(directory: Path):
+    with profiler.phase("mkdir"):
+        directory.mkdir(parents=True, exist_ok=True)
+
+
+def sha1_stream(
+    source: BinaryIO,
+    buffer_size: int = DEFAULT_HASH_BUFFER_SIZE,
+    destination: BinaryIO = None,
+    read_phase: str = "read",
+) -> str:
+    """Compute sha1 hex digest of a binary stream with constant memory usage.
+
+    Stream is read by chunks in the same pre-allocated buffer, so hashing
+    a 40 GB file doesn't require more than ``buffer_size`` bytes. If
+    ``destination`` is given, chunks are written in it as they are hashed.
+    Reading chunks is profiled as ``read_phase``.
+    """
+    sha1 = hashlib.sha1()  # nosec
+    buffer = _get_buffer(buffer_size)
+    view = memoryview(buffer)
+    while True:
+        with profiler.phase(read_phase) as phase:
+            size = source.readinto(buffer)
+            phase.nbytes = size or 0
+        if not size:
+            break
+        chunk = view[:size]
+        with profiler.phase("hash", size):
+            sha1.update(chunk)
+        if destination is not None:
+            with profiler.phase("write", size):
+                destination.write(chunk)
+    return sha1.hexdigest()
+
+
+def sha1_file(file: Path, buffer_size: int = DEFAULT_HASH_BUFFER_SIZE) -> str:
+    """Compute file sha1 hex digest with constant memory usage"""
+    with file.open("rb", buffering=0) as f:
+        return sha1_stream(f, buffer_size=buffer_size)
+
+
+class KeyedLock:
+    """Serialize work done on the same key (ie: a repository file) across
+    threads while letting work on other keys run concurrently.
+
+    Locks are released from memory once nobody is using them anymore.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks: Dict[Hashable, list] = {}
+
+    @contextmanager
+    def __call__(self, key: Hashable):
+        with self._lock:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        entry[0].acquire()
+        try:
+            yield
+        finally:
+            entry[0].release()
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+
+class SingleFlight:
+    """Run a call once per key among concurrent callers (ie: download a
+    repository file once): the first caller runs it, callers arriving
+    meanwhile wait for it and share its result or exception.
+
+    ``executed`` counts calls run, ``shared`` counts callers which got the
+    result of an other caller's call.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, Future] = {}
+        self.executed = 0
+        self.shared = 0
+
+    def do(self, key: Hashable, func: Callable, *args) -> Tuple[Any, bool]:
+        """Return ``func(*args)`` result and whether it was shared"""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is None:
+                future = self._calls[key] = Future()
+                self.executed += 1
+                leader = True
+            else:
+                self.shared += 1
+                leader = False
+        if not leader:
+            return future.result(), True
+        try:
+            result = func(*args)
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                del self._calls[key]
 
 
 @dataclass
@@ -42,33 +200,128 @@ class NextcloudS3Backup:
 
     dao: DaoNextcloudFiles
     config: NextCloudS3BackupConfig
+    workers: int = 1
+    hash_buffer_size: int = DEFAULT_HASH_BUFFER_SIZE
+    stream_download: bool = False
+    delta: bool = False
+    # link files whose oc_filecache etag, mtime and size didn't change to
+    # the repository file resolved by a previous run, without S3 request
+    metadata_cache: bool = False
+    # group files of all mappings of a storage by content, download unique
+    # contents first then link snapshot files
+    download_plan: bool = False
+    # list buckets once using ListObjectsV2 instead of requesting each object
+    # (using ``s3_client``), listings are kept in memory for the whole run
+    s3_listing: bool = False
+    s3_listing_fileid_range: Optional[Tuple[int, int]] = None
+    # boto3 client shared by all workers (clients are thread safe, unlike
+    # the boto3 resource used by s3path), S3 paths are read using s3path if
+    # None
+    s3_client: Any = None
+    # boto3 TransferConfig of files downloaded using ``s3_client``
+    transfer_config: Any = None
+    # ordered by max_size, files are backup-ed by the first matching lane
+    lanes: List[SizeLane] = field(default_factory=list)
+    # hard links per repository file before linking to one of its replicas,
+    # the repository file system limit if None
+    max_links: Optional[int] = None
+    # operations durations are written in this file once done, as JSON if
+    # it ends with ``.json``, as a prometheus text file otherwise
+    metrics_file: Optional[Path] = None
+    # continue the latest snapshot left incomplete by an interrupted run
+    # instead of starting a new one
+    resume: bool = False
+    # attribute time and bytes to phases (db, s3_head, s3_get, hash, link,
+    # mkdir...) and log them ranked once done, cProfile statistics and a
+    # tracemalloc snapshot are written to these files if set
+    profile: bool = False
+    profile_cprofile_file: Optional[Path] = None
+    profile_tracemalloc_file: Optional[Path] = None
 
     _current_backup_formatted_date: datetime = None
 
-    _sha1_file_per_inode: Dict[int, Path] = None
+    # backup_root_path => inode => sha1 hash value, loaded once per
+    # backup_root_path and kept up to date for the whole run
+    _sha1_file_per_inode: Dict[Path, Dict[int, str]] = field(default_factory=dict)
+    _indexes: Dict[Path, RepositoryIndex] = field(default_factory=dict)
+    # backup_root_path => files manifest of the current and previous snapshot
+    _manifests: Dict[Path, SnapshotManifest] = field(default_factory=dict)
+    _previous_manifests: Dict[Path, SnapshotManifest] = field(default_factory=dict)
+    _created_directories: Set[Path] = field(default_factory=set)
+    # backup_root_path => repository inodes linked in the current snapshot
+    _snapshot_inodes: Dict[Path, Set[int]] = field(default_factory=dict)
+    # bucket => fileid => object size and etag, when s3_listing is enabled
+    _bucket_listings: Dict[str, Dict[int, ObjectInfo]] = field(default_factory=dict)
+    # repository files are downloaded once per flight, rows of the same
+    # content arriving meanwhile link to the file downloaded by the flight
+    _flights: SingleFlight = field(default_factory=SingleFlight)
+    # "fetch" keys are held while downloading or resolving an etag entry,
+    # "commit" keys only while publishing a file in the repository
+    _locks: KeyedLock = field(default_factory=KeyedLock)
+    # repository file => first replica which may have spare link capacity
+    _replicas: Dict[Path, int] = field(default_factory=dict)
+    _repository_max_links: Dict[Path, int] = field(default_factory=dict)
+    # backup_root_path => journal of files linked in the current snapshot
+    _journals: Dict[Path, SnapshotJournal] = field(default_factory=dict)
+    _journal_skipped: int = 0
+
+    def __post_init__(self):
+        if self.s3_listing and self.s3_client is None:
+            # a default client would ignore the endpoint and credentials
+            # of the S3 operations
+            raise ValueError("s3_listing requires the s3_client to list buckets")
+
+    def get_index(self, backup_root_path: Path) -> RepositoryIndex:
+        if backup_root_path not in self._indexes:
+            self._indexes[backup_root_path] = RepositoryIndex(
+                backup_root_path / REPOSITORY_DIRNAME
+            )
+        return self._indexes[backup_root_path]
+
+    def close_indexes(self):
+        for index in self._indexes.values():
+            index.close()
 
     @timer
     def populate_sha1_file_per_inode(self, dir_config: NextcloudDirectoryConfig):
-        sha1_dir = dir_config.backup_root_path / REPOSITORY_DIRNAME / "sha1"
-        if sha1_dir.exists():
-            self._sha1_file_per_inode = self._populate_sha1_file_per_inode(
-                dir_config.backup_root_path / REPOSITORY_DIRNAME / "sha1", {}
-            )
-        else:
-            self._sha1_file_per_inode = {}
+        """Load sha1 files per inode map of the mapping ``backup_root_path``,
+        mappings sharing the same ``backup_root_path`` share the same map.
+        """
+        root_path = dir_config.backup_root_path
+        if root_path in self._sha1_file_per_inode:
+            return
+        start = perf_counter()
+        index = self.get_index(root_path)
+        sha1_dir = root_path / REPOSITORY_DIRNAME / "sha1"
+        if not index.built and sha1_dir.exists():
+            logger.info("Indexing repository %s...", index.repository_path)
+            index.rebuild()
+        self._sha1_file_per_inode[root_path] = index.sha1_per_inode()
+        logger.info(
+            "Repository %s: %d sha1 file(s) loaded in %.1fs",
+            root_path,
+            len(self._sha1_file_per_inode[root_path]),
+            perf_counter() - start,
+        )
 
-    def _populate_sha1_file_per_inode(
-        self, directory: Path, inodes: Dict[int, Path] = None
-    ) -> Set[int]:
-        for child in directory.iterdir():
-            if child.is_dir():
-                inodes = self._populate_sha1_file_per_inode(child, inodes=inodes)
+    def _ensure_sha1_file_per_inode_exists(
+        self,
+        repo_file: Path,
+        dir_config: NextcloudDirectoryConfig,
+        stat: Optional[os.stat_result] = None,
+    ) -> int:
+        if stat is None:
+            stat = repo_file.stat()
+        sha1_file_per_inode = self._sha1_file_per_inode[dir_config.backup_root_path]
+        if stat.st_ino not in sha1_file_per_inode:
+            sha1 = hash_from_path(repo_file)
+            sha1_file_per_inode[stat.st_ino] = sha1
+            index = self.get_index(dir_config.backup_root_path)
+            if replica_number(repo_file):
+                index.add_replica(sha1, stat.st_ino, stat.st_size)
             else:
-                inodes[child.stat().st_ino] = child
-        return inodes
-
-    def _ensure_sha1_file_per_inode_exists(self, repo_file):
-        self._sha1_file_per_inode[repo_file.stat().st_ino] = repo_file
+                index.add_blob(sha1, stat.st_ino, stat.st_size)
+        return stat.st_ino
 
     @property
     def current_backup_formatted_date(self):
@@ -78,28 +331,323 @@ class NextcloudS3Backup:
             )
         return self._current_backup_formatted_date
 
+    def snapshot_directory(self, backup_root_path: Path) -> Path:
+        return backup_root_path / SNAPSHOT_DIRNAME / self.current_backup_formatted_date
+
     def backup(self):
+        if self.profile:
+            profiler.start(
+                cprofile_file=self.profile_cprofile_file,
+                tracemalloc_file=self.profile_tracemalloc_file,
+            )
+        try:
+            self._backup()
+        finally:
+            if self.profile:
+                profiler.stop()
+                self.print_profile_info()
+
+    def _backup(self):
         logger.info("%s mapping to backup", len(self.config.mapping))
-        for dir_config in self.config.mapping:
-            self.populate_sha1_file_per_inode(dir_config)
-            self._backup_directory(dir_config)
+        if self.resume:
+            self._resume_latest_snapshot()
+        # a snapshot directory already exists if it is resumed or if a
+        # previous run used the same date: its manifest is stale as soon as
+        # new files are linked, it is removed until the snapshot is walked
+        # once done
+        existing_snapshots = [
+            root_path
+            for root_path in self.distinct_backup_root_paths
+            if self.snapshot_directory(root_path).exists()
+        ]
+        new_snapshots = [
+            root_path
+            for root_path in self.distinct_backup_root_paths
+            if root_path not in existing_snapshots
+        ]
+        for root_path in existing_snapshots:
+            if remove_inodes_manifest(self.snapshot_directory(root_path)):
+                logger.info(
+                    "Snapshot %s already exists, its inodes manifest is removed",
+                    self.snapshot_directory(root_path),
+                )
+        self._open_journals()
+        try:
+            if self.resume:
+                for root_path in self.distinct_backup_root_paths:
+                    self._clean_stale_downloads(root_path)
+            self._backup_mappings()
+        finally:
+            self.close_indexes()
+            for manifest in self._manifests.values():
+                manifest.close()
+            for journal in self._journals.values():
+                journal.close()
+        self._write_inodes_manifests(new_snapshots)
+        self._write_inodes_manifests(existing_snapshots, walk=True)
+        # snapshots are complete
+        for journal in self._journals.values():
+            journal.remove()
+        if self.resume:
+            logger.info(
+                "Resumed snapshot %s: %d file(s) linked by previous run(s) skipped",
+                self.current_backup_formatted_date,
+                self._journal_skipped,
+            )
 
         self.print_timer_info()
+        self.print_connection_info()
+        self.print_flights_info()
         logger.info("Backup done")
 
+    def _backup_mappings(self):
+        if self.download_plan:
+            for storage_id, dir_configs in self.mappings_per_storage().items():
+                for dir_config in dir_configs:
+                    self._prepare_mapping(dir_config)
+                self._backup_storage(storage_id, dir_configs)
+        else:
+            for dir_config in self.config.mapping:
+                self._prepare_mapping(dir_config)
+                self._backup_directory(dir_config)
+
+    def _prepare_mapping(self, dir_config: NextcloudDirectoryConfig):
+        self.populate_sha1_file_per_inode(dir_config)
+        if self.s3_listing:
+            self.list_bucket(dir_config)
+
+    def _resume_latest_snapshot(self):
+        """Continue the latest incomplete snapshot (among all
+        ``backup_root_path``) if any, start a new one otherwise or if a
+        later run completed a snapshot since it was interrupted: database
+        state of today doesn't belong to that snapshot.
+        """
+        journals = [
+            journal
+            for root_path in self.distinct_backup_root_paths
+            for journal in SnapshotJournal.incomplete(root_path / SNAPSHOT_DIRNAME)
+        ]
+        if not journals:
+            logger.info("No incomplete snapshot to resume, starting a new one")
+            return
+        latest = max(journals, key=lambda journal: journal.path.stat().st_mtime)
+        completion_times = [
+            completion_time
+            for completion_time in (
+                latest_completion_time(root_path / SNAPSHOT_DIRNAME)
+                for root_path in self.distinct_backup_root_paths
+            )
+            if completion_time is not None
+        ]
+        if completion_times and max(completion_times) > latest.path.stat().st_mtime:
+            logger.warning(
+                "Incomplete snapshot %s is older than the latest complete "
+                "snapshot, it is not resumed, starting a new one (remove %s "
+                "once checked)",
+                latest.snapshot_directory.name,
+                latest.snapshot_directory,
+            )
+            return
+        self._current_backup_formatted_date = latest.snapshot_directory.name
+        logger.info("Resuming snapshot %s", self._current_backup_formatted_date)
+
+    def _open_journals(self):
+        for root_path in self.distinct_backup_root_paths:
+            journal = SnapshotJournal(self.snapshot_directory(root_path))
+            journal.open(load=self.resume)
+            self._journals[root_path] = journal
+            if journal.recorded:
+                logger.info(
+                    "Snapshot %s: %d file(s) already linked by previous run(s)",
+                    journal.snapshot_directory,
+                    journal.recorded,
+                )
+
+    def _journal_key(
+        self, nc_file: NextcloudFile, dir_config: NextcloudDirectoryConfig
+    ) -> int:
+        return SnapshotJournal.key(
+            self._mapping_key(dir_config), nc_file.path, nc_file.fileid
+        )
+
+    def _journaled(
+        self, nc_file: NextcloudFile, dir_config: NextcloudDirectoryConfig
+    ) -> bool:
+        """True if the file was linked by a previous run of the resumed
+        snapshot
+        """
+        journal = self._journals.get(dir_config.backup_root_path)
+        if not journal or not journal.recorded:
+            return False
+        if self._journal_key(nc_file, dir_config) in journal:
+            self._journal_skipped += 1
+            return True
+        return False
+
+    def _not_journaled(
+        self, dir_config: NextcloudDirectoryConfig, nc_files: Iterable[NextcloudFile]
+    ) -> Iterator[NextcloudFile]:
+        return (
+            nc_file for nc_file in nc_files if not self._journaled(nc_file, dir_config)
+        )
+
+    def _journal_file(
+        self,
+        nc_file: NextcloudFile,
+        dir_config: NextcloudDirectoryConfig,
+        local_file: Path,
+    ) -> Path:
+        """Record ``local_file`` as linked in the snapshot journal"""
+        journal = self._journals.get(dir_config.backup_root_path)
+        if journal is not None:
+            journal.add(self._journal_key(nc_file, dir_config))
+        return local_file
+
+    @timer
+    def _clean_stale_downloads(self, root_path: Path):
+        """Handle ``.downloading`` files recorded in the repository index by
+        an interrupted run: complete sha1 downloads (their content matches
+        their name) are published, other ones are removed.
+        """
+        repository = root_path / REPOSITORY_DIRNAME
+        index = self.get_index(root_path)
+        reused = removed = 0
+        for path in index.downloads():
+            repo_file = original_path(path)
+            sha1 = hash_from_path(repo_file)
+            if not path.exists():
+                # published (or dropped) after the last index commit
+                pass
+            elif (
+                path.relative_to(repository).parts[0] == "sha1"
+                and path.name == f"{repo_file.name}.downloading"
+                and not repo_file.exists()
+                and sha1_file(path, buffer_size=self.hash_buffer_size) == sha1
+            ):
+                path.rename(repo_file)
+                stat = repo_file.stat()
+                index.add_blob(sha1, stat.st_ino, stat.st_size)
+                reused += 1
+            else:
+                path.unlink()
+                removed += 1
+            index.remove_download(path)
+        logger.info(
+            "Repository %s: %d stale download(s) reused - %d removed",
+            root_path,
+            reused,
+            removed,
+        )
+
+    @timer
+    def list_bucket(self, dir_config: NextcloudDirectoryConfig):
+        """List the mapping bucket objects once, mappings sharing the same
+        bucket share the same listing.
+        """
+        bucket = str(dir_config.bucket)
+        if bucket in self._bucket_listings:
+            return
+        start = perf_counter()
+        with profiler.phase("s3_list"):
+            self._bucket_listings[bucket] = list_bucket(
+                self.s3_client,
+                dir_config.bucket,
+                fileid_range=self.s3_listing_fileid_range,
+                map_func=self._map_concurrently,
+            )
+        logger.info(
+            "Bucket %s: %d object(s) listed in %.1fs",
+            bucket,
+            len(self._bucket_listings[bucket]),
+            perf_counter() - start,
+        )
+
+    def _s3_object_exists(
+        self,
+        nc_file: NextcloudFile,
+        dir_config: NextcloudDirectoryConfig,
+        s3_path: Path,
+    ) -> bool:
+        listing = self._bucket_listings.get(str(dir_config.bucket))
+        if listing is not None and nc_file.fileid in listing:
+            return True
+        # not listed: out of the listed fileid range or uploaded since
+        with profiler.phase("s3_head"):
+            if self.s3_client is None:
+                return s3_path.exists()
+            return head_object(self.s3_client, s3_path) is not None
+
+    def _s3_object_etag(
+        self,
+        nc_file: NextcloudFile,
+        dir_config: NextcloudDirectoryConfig,
+        s3_path: Path,
+    ) -> str:
+        listing = self._bucket_listings.get(str(dir_config.bucket))
+        listed = listing.get(nc_file.fileid) if listing is not None else None
+        if listed is not None:
+            return listed.etag
+        with profiler.phase("s3_head"):
+            if self.s3_client is None:
+                return s3_path.stat().etag
+            return head_object(self.s3_client, s3_path)["ETag"].strip('"')
+
+    @timer
+    def _write_inodes_manifests(self, root_paths: List[Path], walk: bool = False):
+        """Save inodes used by the snapshot, so purge doesn't need to
+        walk it anymore. if ``walk`` (ie: the snapshot was resumed or
+        already existed) inodes linked by previous runs are unknown and the
+        snapshot is walked.
+        """
+        for root_path in root_paths:
+            snapshot_directory = self.snapshot_directory(root_path)
+            if not snapshot_directory.exists():
+                continue
+            if walk:
+                inodes = self._get_inodes(snapshot_directory)
+            else:
+                inodes = self._snapshot_inodes.get(root_path, ())
+            write_inodes_manifest(
+                snapshot_directory, inodes, root_path / REPOSITORY_DIRNAME
+            )
+
+    def mappings_per_storage(self) -> Dict[int, List[NextcloudDirectoryConfig]]:
+        mappings = {}
+        for dir_config in self.config.mapping:
+            mappings.setdefault(dir_config.storage_id, []).append(dir_config)
+        return mappings
+
     @property
     def distinct_backup_root_paths(self):
         return list({conf.backup_root_path for conf in self.config.mapping})
 
+    @timer
+    def reindex(self):
+        for root_path in self.distinct_backup_root_paths:
+            index = self.get_index(root_path)
+            sha1_count, etag_count = index.rebuild()
+            index.close()
+            logger.info(
+                "Directory %s indexed: %d sha1 file(s) - %d etag file(s)",
+                root_path,
+                sha1_count,
+                etag_count,
+            )
+        self.print_timer_info()
+
     @timer
     def purge(self):
         purged = []
         logger.info("Purging %d directories", len(self.distinct_backup_root_paths))
         for root_path in self.distinct_backup_root_paths:
-            snapshots_inodes = self._get_inodes(root_path / SNAPSHOT_DIRNAME)
-            repo_purged = self._purge_directory(
+            index = self.get_index(root_path)
+            snapshots_inodes = self._get_snapshots_inodes(
+                root_path / SNAPSHOT_DIRNAME, root_path / REPOSITORY_DIRNAME
+            )
+            repo_purged = self._purge_repository(
                 root_path / REPOSITORY_DIRNAME / "sha1", snapshots_inodes
             )
+            self._compact_replicas(index, repo_purged)
             logger.info(
                 "**SHA1** Directory: %s - %d file(s) removed that represent %.3f GB",
                 root_path,
@@ -111,9 +659,12 @@ class NextcloudS3Backup:
             # * sha1 and etags are hard linked to and we just purge sha1
             #   files that are not present in snapshots
             # * we don't want to sum etag and sha1 file size
-            etag_purged = self._purge_directory(
+            etag_purged = self._purge_repository(
                 root_path / REPOSITORY_DIRNAME / "etag", snapshots_inodes
             )
+            for purged_file in etag_purged:
+                index.remove_etag(hash_from_path(purged_file.path))
+            index.close()
             logger.info(
                 "**Etag** Directory: %s - %d file(s) removed that represent %.3f GB",
                 root_path,
@@ -128,83 +679,599 @@ class NextcloudS3Backup:
         )
 
     @timer
-    def _get_inodes(self, directory: Path, inodes: Set[int] = None) -> Set[int]:
-        if not inodes:
-            inodes = set()
-        for child in directory.iterdir():
-            if child.is_dir():
-                inodes = self._get_inodes(child, inodes=inodes)
-            else:
-                inodes |= {child.stat().st_ino}
+    def _get_snapshots_inodes(
+        self, snapshots_directory: Path, repository: Path
+    ) -> Set[int]:
+        """Inodes of all snapshots files.
+
+        Inodes are read from snapshot manifest when present and written for
+        this ``repository``, otherwise each ``<snapshot>/<user>`` directory
+        is scanned separately using ``workers`` threads.
+        """
+        snapshots, files = split_tree(snapshots_directory, 1)
+        inodes = {entry.inode() for entry in files}
+        directories = []
+        for snapshot in snapshots:
+            if update_from_inodes_manifest(inodes, snapshot, repository):
+                continue
+            logger.info(
+                "No inodes manifest of this repository found in %s, walking it",
+                snapshot,
+            )
+            snapshot_directories, snapshot_files = split_tree(snapshot, 1)
+            inodes.update(entry.inode() for entry in snapshot_files)
+            directories.extend(snapshot_directories)
+        for directory_inodes in self._map_concurrently(self._get_inodes, directories):
+            inodes |= directory_inodes
         return inodes
 
+    @timer
+    def _purge_repository(
+        self, repo_directory: Path, snapshots_inodes: Set[int]
+    ) -> List[PurgedFile]:
+        """Remove repository files not used in snapshots, each two chars
+        hash bucket is purged separately using ``workers`` threads
+        """
+        buckets, files = split_tree(repo_directory, 1)
+        purged = []
+        for entry in files:
+            purged.extend(self._purge_file(entry, snapshots_inodes))
+        for bucket_purged in self._map_concurrently(
+            partial(self._purge_directory, snapshots_inodes=snapshots_inodes), buckets
+        ):
+            purged.extend(bucket_purged)
+        return purged
+
+    @timer
+    def _compact_replicas(self, index: RepositoryIndex, purged: List[PurgedFile]):
+        """Remove purged sha1 files from the index and rename replicas kept
+        so replicas of a content are still numbered from 0 without gap.
+
+        Renamed replicas keep their inode, snapshots files and inodes
+        manifests are left untouched.
+        """
+        purged_numbers: Dict[Path, Set[int]] = {}
+        for purged_file in purged:
+            purged_numbers.setdefault(original_path(purged_file.path), set()).add(
+                replica_number(purged_file.path)
+            )
+        for repo_file, numbers in purged_numbers.items():
+            sha1 = hash_from_path(repo_file)
+            index.remove_blob(sha1)
+            kept = 0
+            for number in count():
+                replica = replica_path(repo_file, number)
+                if not replica.exists():
+                    if number in numbers:
+                        continue
+                    break
+                if number != kept:
+                    replica.rename(replica_path(repo_file, kept))
+                    replica = replica_path(repo_file, kept)
+                stat = replica.stat()
+                if kept:
+                    index.add_replica(sha1, stat.st_ino, stat.st_size)
+                else:
+                    index.add_blob(sha1, stat.st_ino, stat.st_size)
+                kept += 1
+
+    @timer
+    def _get_inodes(self, directory: Path) -> Set[int]:
+        return {entry.inode() for entry in walk_files(directory)}
+
     @timer
     def _purge_directory(
         self, repo_directory: Path, snapshots_inodes: Set[int]
     ) -> List[PurgedFile]:
         purged = []
-        for child in repo_directory.iterdir():
-            if child.is_dir():
-                purged.extend(self._purge_directory(child, snapshots_inodes))
-            else:
-                purged.extend(self._purge_file(child, snapshots_inodes))
+        for entry in walk_files(repo_directory):
+            purged.extend(self._purge_file(entry, snapshots_inodes))
         return purged
 
     @timer
     def _purge_file(
-        self, repo_file: Path, snapshots_inodes: Set[int]
+        self, entry: os.DirEntry, snapshots_inodes: Set[int]
     ) -> List[PurgedFile]:
         unlink_file_stat = []
-        if repo_file.stat().st_ino not in snapshots_inodes:
-            unlink_file_stat.append(PurgedFile(size=repo_file.stat().st_size / GB))
-            repo_file.unlink()
+        if entry.inode() not in snapshots_inodes:
+            unlink_file_stat.append(
+                PurgedFile(
+                    size=entry.stat(follow_symlinks=False).st_size / GB,
+                    path=Path(entry.path),
+                )
+            )
+            os.unlink(entry.path)
         return unlink_file_stat
 
     def print_timer_info(self):
         logger.info("Timmer info...")
-        for method_name, times in time_reports.items():
+        for method_name, summary in registry.summaries():
             logger.info(
-                "Method %s - Calls count: %d - Total time: %.1f - AVG: %.5f - MEDIAN: %.5f",
+                "Method %s - Calls count: %d - Total time: %.1f - AVG: %.5f - "
+                "MIN: %.5f - P50: %.5f - P95: %.5f - P99: %.5f - MAX: %.5f",
                 method_name,
-                len(times),
-                sum(times),
-                statistics.mean(times),
-                statistics.median(times),
+                summary["count"],
+                summary["sum"],
+                summary["sum"] / summary["count"],
+                summary["min"],
+                summary["p50"],
+                summary["p95"],
+                summary["p99"],
+                summary["max"],
             )
+        if self.metrics_file:
+            registry.write(self.metrics_file)
+            logger.info("Metrics written to %s", self.metrics_file)
+
+    def print_profile_info(self):
+        for line in profiler.report():
+            logger.info(line)
+
+    def print_connection_info(self):
+        if self.s3_client is None:
+            return
+        stats = connection_stats(self.s3_client)
+        logger.info(
+            "S3 connections info - Requests: %d - Connections opened: %d - "
+            "Connections reused: %d",
+            stats.requests,
+            stats.opened,
+            stats.reused,
+        )
+
+    def print_flights_info(self):
+        logger.info(
+            "Downloads info - Flights: %d - Rows sharing an other row flight "
+            "(download saved): %d",
+            self._flights.executed,
+            self._flights.shared,
+        )
 
     def _backup_directory(self, dir_config: NextcloudDirectoryConfig):
         logger.info(
             "Backup-ing %s - %s ...", dir_config.user_name, dir_config.nextcloud_path
         )
-        for nc_file in self.dao.get_nc_subtree(
-            dir_config.storage_id,
-            dir_config.nextcloud_path,
-            self.config.excluded_mimetype_ids,
+        nc_files = profiler.iterate(
+            "db",
+            self.dao.get_nc_subtree(
+                dir_config.storage_id,
+                dir_config.nextcloud_path,
+                self.config.excluded_mimetype_ids,
+                mimetypes=self.config.included_mimetype_ids,
+                mimeparts=self.config.included_mimepart_ids,
+            ),
+        )
+        if self.delta:
+            self._backup_directory_delta(dir_config, nc_files)
+            return
+        nc_files = self._not_journaled(dir_config, nc_files)
+        if self.workers <= 1 and not self.lanes:
+            for nc_file in nc_files:
+                self._backup_file(nc_file, dir_config)
+        else:
+            self._run_concurrently(
+                partial(self._backup_file, dir_config=dir_config),
+                nc_files,
+                size=attrgetter("size"),
+            )
+
+    def _backup_storage(
+        self, storage_id: int, dir_configs: List[NextcloudDirectoryConfig]
+    ):
+        """Backup mappings of a storage in two phases: download contents
+        missing in the repository once, then link every snapshot file.
+        """
+        plan = self.plan_storage(storage_id, dir_configs)
+        self._fetch_blobs(plan.missing_blobs())
+        self._link_plan(plan)
+
+    @timer
+    def plan_storage(
+        self, storage_id: int, dir_configs: List[NextcloudDirectoryConfig]
+    ) -> DownloadPlan:
+        """Group files of ``dir_configs`` mappings by content and tell which
+        contents are already in the repository
+        """
+        plan = DownloadPlan(storage_id)
+        logger.info(
+            "Planning storage %s (%d mappings) ...", storage_id, len(dir_configs)
+        )
+        # one query for all mappings of the storage
+        for index, nc_file in profiler.iterate(
+            "db",
+            self.dao.get_nc_subtrees(
+                [
+                    (dir_config.storage_id, dir_config.nextcloud_path)
+                    for dir_config in dir_configs
+                ],
+                self.config.excluded_mimetype_ids,
+                mimetypes=self.config.included_mimetype_ids,
+                mimeparts=self.config.included_mimepart_ids,
+            ),
         ):
-            self._backup_file(nc_file, dir_config)
+            dir_config = dir_configs[index]
+            if self._journaled(nc_file, dir_config):
+                continue
+            cached_file = None
+            if nc_file.size:
+                # set SHA1 checksum of unchanged files
+                cached_file, _ = self._repo_file_from_cache(nc_file, dir_config)
+            plan.add(dir_config, nc_file, cached_file)
+        for blob in plan.blobs.values():
+            if blob.checksum:
+                dir_config, nc_file, _ = blob.rows[0]
+                repo_file = (
+                    dir_config.backup_root_path / REPOSITORY_DIRNAME / nc_file.hash_path
+                )
+                if repo_file.exists():
+                    blob.repo_file = repo_file
+        logger.info(
+            "Storage %s plan: %d file(s) - %d link(s) (%.3f GB) to %d unique "
+            "content(s) (%.3f GB) - %d content(s) to download (%.3f GB at most)",
+            storage_id,
+            plan.rows,
+            plan.links,
+            plan.total_bytes / GB,
+            len(plan.blobs),
+            plan.unique_bytes / GB,
+            len(plan.missing_blobs()),
+            plan.bytes_to_download / GB,
+        )
+        return plan
+
+    def _fetch_blobs(self, blobs: List[Blob]):
+        if self.workers <= 1 and not self.lanes:
+            for blob in blobs:
+                self._fetch_blob(blob)
+        else:
+            self._run_concurrently(self._fetch_blob, blobs, size=attrgetter("size"))
 
     @timer
-    def _backup_file(
-        self, nc_file: NextcloudFile, dir_config: NextcloudDirectoryConfig
+    def _fetch_blob(self, blob: Blob):
+        """Download blob content from the first of its fileids found on S3"""
+        for dir_config, nc_file, _ in blob.fileid_rows():
+            repo_file = self._resolve_repo_file(
+                nc_file, dir_config, dir_config.bucket / f"urn:oid:{nc_file.fileid}"
+            )
+            if not repo_file:
+                # missing on S3, try an other copy
+                continue
+            if blob.checksum is None or nc_file.checksum.lower() == blob.checksum:
+                blob.repo_file = repo_file
+                return
+            # content doesn't match nextcloud checksum, other fileids may
+            # have the expected one
+            blob.repo_files[nc_file.fileid] = repo_file
+
+    @timer
+    def _link_plan(self, plan: DownloadPlan):
+        for dir_config, nc_file, _ in plan.empty_files:
+            self._journal_file(
+                nc_file,
+                dir_config,
+                self._touch_empty_file(self._local_file(nc_file, dir_config)),
+            )
+        for blob in plan.blobs.values():
+            self._link_blob(blob)
+
+    def _link_blob(self, blob: Blob):
+        for row in blob.rows:
+            repo_file = blob.row_repo_file(row)
+            if repo_file is None:
+                continue
+            dir_config, nc_file, cached_file = row
+            nc_file.checksum = f"SHA1:{hash_from_path(repo_file)}"
+            local_file = self._local_file(nc_file, dir_config)
+            if local_file.parent not in self._created_directories:
+                make_directory(local_file.parent)
+                self._created_directories.add(local_file.parent)
+            inode = self._link_replica(repo_file, local_file, dir_config)
+            self._snapshot_inodes.setdefault(dir_config.backup_root_path, set()).add(
+                inode
+            )
+            self._update_cache(nc_file, dir_config, cached_file)
+            self._journal_file(nc_file, dir_config, local_file)
+
+    @staticmethod
+    def _mapping_key(dir_config: NextcloudDirectoryConfig) -> str:
+        return (
+            f"{dir_config.storage_id}:{dir_config.user_name}:"
+            f"{dir_config.nextcloud_path}"
+        )
+
+    def _get_manifests(self, root_path: Path):
+        """return files manifest of the current snapshot and the one of the
+        previous snapshot if any
+        """
+        if root_path not in self._manifests:
+            snapshot_directory = self.snapshot_directory(root_path)
+            self._previous_manifests[root_path] = SnapshotManifest.latest(
+                root_path / SNAPSHOT_DIRNAME, exclude=snapshot_directory
+            )
+            self._manifests[root_path] = SnapshotManifest(snapshot_directory)
+        return self._manifests[root_path], self._previous_manifests[root_path]
+
+    def _backup_directory_delta(
+        self, dir_config: NextcloudDirectoryConfig, nc_files: Iterable[NextcloudFile]
+    ):
+        """Backup only files added or changed since the previous snapshot,
+        unchanged files are linked to the repository file they were linked
+        to in the previous snapshot without any other file system or S3
+        operation.
+        """
+        mapping = self._mapping_key(dir_config)
+        manifest, previous_manifest = self._get_manifests(dir_config.backup_root_path)
+        previous_entries = (
+            previous_manifest.entries(mapping) if previous_manifest else {}
+        )
+        stats = dict(added=0, changed=0, unchanged=0)
+        items = self._delta_items(dir_config, nc_files, previous_entries, stats)
+        backup_file = partial(
+            self._backup_file_delta,
+            dir_config=dir_config,
+            manifest=manifest,
+            mapping=mapping,
+        )
+        if self.workers <= 1 and not self.lanes:
+            for item in items:
+                backup_file(item)
+        else:
+            self._run_concurrently(backup_file, items, size=lambda item: item[0].size)
+        self._log_delta_stats(dir_config, stats, len(previous_entries))
+
+    @staticmethod
+    def _log_delta_stats(
+        dir_config: NextcloudDirectoryConfig, stats: Dict[str, int], removed: int
+    ):
+        logger.info(
+            "Delta %s - %s: %d added - %d changed - %d removed - %d unchanged",
+            dir_config.user_name,
+            dir_config.nextcloud_path,
+            stats["added"],
+            stats["changed"],
+            removed,
+            stats["unchanged"],
+        )
+
+    def _delta_items(
+        self,
+        dir_config: NextcloudDirectoryConfig,
+        nc_files: Iterable[NextcloudFile],
+        previous_entries: Dict[str, ManifestEntry],
+        stats: Dict[str, int],
+    ) -> Iterator[Tuple[NextcloudFile, Optional[ManifestEntry]]]:
+        """Files compared with the previous snapshot but the ones linked by
+        a previous run of the resumed snapshot, they are compared anyway so
+        their previous entry is not counted as removed
+        """
+        return (
+            item
+            for item in self._compare_with_manifest(nc_files, previous_entries, stats)
+            if not self._journaled(item[0], dir_config)
+        )
+
+    @staticmethod
+    def _compare_with_manifest(
+        nc_files: Iterable[NextcloudFile],
+        previous_entries: Dict[str, ManifestEntry],
+        stats: Dict[str, int],
+    ) -> Iterator[Tuple[NextcloudFile, Optional[ManifestEntry]]]:
+        """Yield files with their previous manifest entry if they didn't
+        change. Entries are consumed from ``previous_entries``, once done
+        it contains removed files. Empty files have no sha1, they are
+        unchanged if their ``oc_filecache`` information are.
+        """
+        for nc_file in nc_files:
+            entry = previous_entries.pop(nc_file.path, None)
+            if entry is None:
+                stats["added"] += 1
+            elif (
+                (entry.sha1 or entry.size == 0)
+                and entry.fileid == nc_file.fileid
+                and entry.size == nc_file.size
+                and entry.mtime == nc_file.mtime
+                and entry.etag == nc_file.etag
+                and entry.checksum == nc_file.checksum
+            ):
+                stats["unchanged"] += 1
+            else:
+                stats["changed"] += 1
+                entry = None
+            yield nc_file, entry
+
+    def _backup_file_delta(
+        self,
+        item: Tuple[NextcloudFile, Optional[ManifestEntry]],
+        dir_config: NextcloudDirectoryConfig,
+        manifest: SnapshotManifest,
+        mapping: str,
     ):
-        local_file = (
+        nc_file, previous_entry = item
+        checksum = nc_file.checksum
+        local_file = None
+        if previous_entry:
+            local_file = self._link_unchanged_file(
+                nc_file, dir_config, previous_entry.sha1
+            )
+        if not local_file:
+            local_file = self._backup_file(nc_file, dir_config)
+        if not local_file:
+            return
+        self._add_manifest_entry(manifest, mapping, nc_file, checksum)
+        return local_file
+
+    @staticmethod
+    def _add_manifest_entry(
+        manifest: SnapshotManifest, mapping: str, nc_file: NextcloudFile, checksum: str
+    ):
+        """Record a backup-ed file, ``checksum`` is the nextcloud checksum
+        as read from the database
+        """
+        sha1 = None
+        if nc_file.size and nc_file.checksum.lower().startswith("sha1:"):
+            sha1 = nc_file.checksum.split(":", 1)[1].lower()
+        manifest.add(
+            mapping,
+            nc_file.path,
+            ManifestEntry(
+                fileid=nc_file.fileid,
+                size=nc_file.size,
+                mtime=nc_file.mtime,
+                etag=nc_file.etag,
+                checksum=checksum,
+                sha1=sha1,
+            ),
+        )
+
+    @timer
+    def _link_unchanged_file(
+        self,
+        nc_file: NextcloudFile,
+        dir_config: NextcloudDirectoryConfig,
+        sha1: Optional[str],
+    ) -> Optional[Path]:
+        """Link snapshot file to a known repository file (or touch it if
+        empty), return None if the repository file is gone
+        """
+        if nc_file.size == 0:
+            return self._journal_file(
+                nc_file,
+                dir_config,
+                self._touch_empty_file(self._local_file(nc_file, dir_config)),
+            )
+        repo_file = (
             dir_config.backup_root_path
-            / SNAPSHOT_DIRNAME
-            / self.current_backup_formatted_date
+            / REPOSITORY_DIRNAME
+            / "sha1"
+            / sha1[:2]
+            / sha1[2:]
+        )
+        local_file = self._local_file(nc_file, dir_config)
+        if local_file.parent not in self._created_directories:
+            make_directory(local_file.parent)
+            self._created_directories.add(local_file.parent)
+        try:
+            inode = self._link_replica(repo_file, local_file, dir_config)
+        except FileNotFoundError:
+            return None
+        self._snapshot_inodes.setdefault(dir_config.backup_root_path, set()).add(inode)
+        nc_file.checksum = f"SHA1:{sha1}"
+        return self._journal_file(nc_file, dir_config, local_file)
+
+    def _local_file(
+        self, nc_file: NextcloudFile, dir_config: NextcloudDirectoryConfig
+    ) -> Path:
+        return (
+            self.snapshot_directory(dir_config.backup_root_path)
             / dir_config.user_name
-        ) / nc_file.path
+            / nc_file.path
+        )
+
+    def _run_concurrently(
+        self,
+        func: Callable,
+        items: Iterable,
+        size: Optional[Callable[[Any], int]] = None,
+    ):
+        """Call ``func`` for each item using ``workers`` threads, or using
+        the threads of the lane matching item ``size`` if ``lanes`` are set.
+
+        The number of submitted items is bounded so we never hold more than
+        a few items per worker in memory. The first exception raised by a
+        worker cancel pending items and is raised again here.
+        """
+        lanes = self.lanes
+        if not lanes or size is None:
+            lanes = [SizeLane(None, self.workers, None, self.workers * 2)]
+        pending = [set() for _ in lanes]
+        with ExitStack() as stack:
+            executors = [
+                stack.enter_context(
+                    ThreadPoolExecutor(
+                        max_workers=lane.workers,
+                        thread_name_prefix=f"nc-s3-backup-{index}",
+                    )
+                )
+                for index, lane in enumerate(lanes)
+            ]
+            try:
+                for item in items:
+                    index = self._lane_index(size(item)) if len(lanes) > 1 else 0
+                    if len(pending[index]) >= lanes[index].max_queued:
+                        with profiler.phase(WAIT_PHASE):
+                            done, pending[index] = wait(
+                                pending[index], return_when=FIRST_COMPLETED
+                            )
+                        for future in done:
+                            future.result()
+                    pending[index].add(executors[index].submit(func, item))
+                with profiler.phase(WAIT_PHASE):
+                    for future in chain.from_iterable(pending):
+                        future.result()
+            except BaseException:
+                for future in chain.from_iterable(pending):
+                    future.cancel()
+                raise
+
+    def _lane_index(self, size: Optional[int]) -> int:
+        for index, lane in enumerate(self.lanes):
+            if lane.max_size is None or (size or 0) <= lane.max_size:
+                return index
+        return len(self.lanes) - 1
+
+    def _lane(self, size: Optional[int]) -> Optional[SizeLane]:
+        return self.lanes[self._lane_index(size)] if self.lanes else None
+
+    def _map_concurrently(self, func: Callable, items: Iterable) -> Iterator:
+        """Like ``map`` but using ``workers`` threads, results are yield
+        in ``items`` order.
+        """
+        if self.workers <= 1:
+            yield from map(func, items)
+            return
+        with ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="nc-s3-backup"
+        ) as executor:
+            yield from executor.map(func, items)
+
+    def _start_download(
+        self, dir_config: NextcloudDirectoryConfig, downloading_path: Path
+    ):
+        """Record ``downloading_path`` in the repository index until it is
+        published, ``--resume`` cleans the recorded ones only
+        """
+        make_directory(downloading_path.parent)
+        self.get_index(dir_config.backup_root_path).add_download(downloading_path)
+
+    def _publish_repo_file(
+        self,
+        dir_config: NextcloudDirectoryConfig,
+        downloading_path: Path,
+        repo_file: Path,
+    ) -> Path:
+        """Move a downloaded file to its final repository location.
+
+        If an other worker already published the same content meanwhile
+        we keep the existing file (and so its inode) and drop ours.
+        """
+        with self._locks(("commit", repo_file)):
+            if repo_file.exists():
+                downloading_path.unlink()
+            else:
+                make_directory(repo_file.parent)
+                downloading_path.rename(repo_file)
+        self.get_index(dir_config.backup_root_path).remove_download(downloading_path)
+        return repo_file
+
+    @timer
+    def _backup_file(
+        self, nc_file: NextcloudFile, dir_config: NextcloudDirectoryConfig
+    ):
+        local_file = self._local_file(nc_file, dir_config)
         if nc_file.size == 0:
-            # mainly caused by this issue
-            # https://github.com/nextcloud/desktop/issues/4909
-            # (files with data store in resource fork only are not synced
-            # by nextcloud client) we got a lot of empty file in our nextcloud
-            # so we get the hardlink count limit maximum (~65000 links with less
-            # than 30 snapshots)
-            # In such case of empty file we leave placeholder creating new empty file
-            # instead hard links based on the nextcloud table information
-            local_file.parent.mkdir(parents=True, exist_ok=True)
-            local_file.touch()
-            return local_file
+            return self._journal_file(
+                nc_file, dir_config, self._touch_empty_file(local_file)
+            )
 
         s3_path = dir_config.bucket / f"urn:oid:{nc_file.fileid}"
         logger.debug(
@@ -214,30 +1281,244 @@ class NextcloudS3Backup:
             s3_path,
             local_file,
         )
-        if nc_file.checksum and nc_file.checksum.lower().startswith("sha1"):
-            repo_file = self._backup_file_with_sha1(nc_file, dir_config, s3_path)
-            if not repo_file:
-                return
-        else:
-            repo_file = self._backup_file_without_sha1(nc_file, dir_config, s3_path)
+        cached_file, repo_file = self._repo_file_from_cache(nc_file, dir_config)
+        if not repo_file:
+            repo_file = self._resolve_repo_file(nc_file, dir_config, s3_path)
             if not repo_file:
                 return
-        self._ensure_sha1_file_per_inode_exists(repo_file)
-        # from python 3.10 only
-        # local_file.hardlink_to(repo_file)
-        local_file.parent.mkdir(parents=True, exist_ok=True)
-        os.link(repo_file, local_file)
+            self._update_cache(nc_file, dir_config, cached_file)
+        return self._journal_file(
+            nc_file, dir_config, self._link_repo_file(repo_file, local_file, dir_config)
+        )
+
+    def _resolve_repo_file(
+        self,
+        nc_file: NextcloudFile,
+        dir_config: NextcloudDirectoryConfig,
+        s3_path: Path,
+    ) -> Optional[Path]:
+        """Repository file of ``nc_file`` content, downloaded if needed. None
+        if the S3 object is missing
+        """
+        if nc_file.checksum and nc_file.checksum.lower().startswith("sha1"):
+            return self._backup_file_with_sha1(nc_file, dir_config, s3_path)
+        return self._backup_file_without_sha1(nc_file, dir_config, s3_path)
+
+    @staticmethod
+    def _touch_empty_file(local_file: Path) -> Path:
+        # mainly caused by this issue
+        # https://github.com/nextcloud/desktop/issues/4909
+        # (files with data store in resource fork only are not synced
+        # by nextcloud client) we got a lot of empty file in our nextcloud
+        # so we get the hardlink count limit maximum (~65000 links with less
+        # than 30 snapshots)
+        # In such case of empty file we leave placeholder creating new empty file
+        # instead hard links based on the nextcloud table information
+        make_directory(local_file.parent)
+        with profiler.phase("link"):
+            local_file.touch()
         return local_file
 
+    def _link_repo_file(
+        self, repo_file: Path, local_file: Path, dir_config: NextcloudDirectoryConfig
+    ) -> Path:
+        make_directory(local_file.parent)
+        inode = self._link_replica(repo_file, local_file, dir_config)
+        self._snapshot_inodes.setdefault(dir_config.backup_root_path, set()).add(inode)
+        return local_file
+
+    def _link_replica(
+        self, repo_file: Path, link: Path, dir_config: NextcloudDirectoryConfig
+    ) -> int:
+        """Hard link ``link`` to the sha1 ``repo_file`` or to the first of its
+        replicas with spare link capacity (according ``st_nlink``), a new
+        replica is copied from ``repo_file`` once all of them are full.
+
+        Popular contents would otherwise reach the file system hard link
+        limit (``EMLINK``) after some snapshots. return the linked inode.
+        """
+        max_links = self._max_links(dir_config.backup_root_path)
+        number = self._replicas.get(repo_file, 0)
+        while True:
+            replica = replica_path(repo_file, number)
+            # workers linking the same content would see the same spare
+            # links otherwise
+            with self._locks(("link", replica)):
+                try:
+                    stat = replica.stat()
+                except FileNotFoundError:
+                    if not number:
+                        raise
+                    stat = self._create_replica(repo_file, replica, dir_config)
+                # filled by other workers, or ``max_links`` is above the file
+                # system limit if the link fails
+                if stat.st_nlink < max_links and self._hard_link(replica, link):
+                    return self._ensure_sha1_file_per_inode_exists(
+                        replica, dir_config, stat
+                    )
+            number += 1
+            self._replicas[repo_file] = number
+
+    def _hard_link(self, target: Path, link: Path) -> bool:
+        """return False if ``target`` reached the file system hard link limit"""
+        try:
+            # from python 3.10 only
+            # link.hardlink_to(target)
+            with profiler.phase("link"):
+                os.link(target, link)
+        except FileExistsError:
+            if not self.resume:
+                raise
+            # linked by the resumed run after its last journal write
+            os.unlink(link)
+            return self._hard_link(target, link)
+        except OSError as error:
+            if error.errno != errno.EMLINK:
+                raise
+            return False
+        return True
+
+    def _create_replica(
+        self, repo_file: Path, replica: Path, dir_config: NextcloudDirectoryConfig
+    ) -> os.stat_result:
+        with self._locks(("commit", replica)):
+            if not replica.exists():
+                copying_path = replica.with_name(f"{replica.name}.downloading")
+                self._start_download(dir_config, copying_path)
+                with profiler.phase("copy"):
+                    shutil.copyfile(repo_file, copying_path)
+                copying_path.rename(replica)
+                self.get_index(dir_config.backup_root_path).remove_download(
+                    copying_path
+                )
+                logger.info("Hard link limit reached, replicated %s", replica)
+        return replica.stat()
+
+    def _max_links(self, root_path: Path) -> int:
+        if self.max_links:
+            return self.max_links
+        if root_path not in self._repository_max_links:
+            try:
+                max_links = os.pathconf(root_path / REPOSITORY_DIRNAME, "PC_LINK_MAX")
+            except (OSError, ValueError):
+                max_links = DEFAULT_MAX_LINKS
+            self._repository_max_links[root_path] = max_links
+        return self._repository_max_links[root_path]
+
+    def _repo_file_from_cache(
+        self, nc_file: NextcloudFile, dir_config: NextcloudDirectoryConfig
+    ) -> Tuple[Optional[CachedFile], Optional[Path]]:
+        """Look for the repository file resolved by a previous run.
+
+        return the cached entry and the repository file if ``oc_filecache``
+        metadata didn't change since and the repository file still exists.
+        """
+        if not self.metadata_cache or nc_file.etag is None:
+            return None, None
+        cached_file = self.get_index(dir_config.backup_root_path).cached_file(
+            nc_file.fileid
+        )
+        if cached_file is None or cached_file[:3] != (
+            nc_file.etag,
+            nc_file.mtime,
+            nc_file.size,
+        ):
+            return cached_file, None
+        repo_file = (
+            dir_config.backup_root_path
+            / REPOSITORY_DIRNAME
+            / "sha1"
+            / cached_file.sha1[:2]
+            / cached_file.sha1[2:]
+        )
+        if not repo_file.exists():
+            return cached_file, None
+        nc_file.checksum = f"SHA1:{cached_file.sha1}"
+        return cached_file, repo_file
+
+    def _update_cache(
+        self,
+        nc_file: NextcloudFile,
+        dir_config: NextcloudDirectoryConfig,
+        cached_file: Optional[CachedFile],
+    ):
+        if not self.metadata_cache or nc_file.etag is None:
+            return
+        method, sha1 = nc_file.checksum.lower().split(":", 1)
+        if method != "sha1":
+            return
+        new_cached_file = CachedFile(nc_file.etag, nc_file.mtime, nc_file.size, sha1)
+        if new_cached_file != cached_file:
+            self.get_index(dir_config.backup_root_path).cache_file(
+                nc_file.fileid, new_cached_file
+            )
+
+    def _fetch_s3_file(
+        self, s3_path: Path, download_path: Path, size: Optional[int] = None
+    ) -> str:
+        """Download ``s3_path`` to ``download_path`` and return its SHA1,
+        ``size`` selects the lane transfer mode if ``lanes`` are set.
+        """
+        lane = self._lane(size)
+        if self.stream_download or (lane and lane.transfer_config is None):
+            return self._stream_s3_file(s3_path, download_path)
+        with profiler.phase("s3_get", size or 0):
+            if lane and self.s3_client is not None:
+                self._download_s3_file_multipart(
+                    s3_path, download_path, lane.transfer_config
+                )
+            else:
+                self._download_s3_file(s3_path, download_path)
+        return self._compute_sha1(download_path, buffer_size=self.hash_buffer_size)
+
+    @timer
+    def _download_s3_file_multipart(
+        self, s3_path: Path, download_path: Path, transfer_config
+    ):
+        """Download using ranged GET requests sent concurrently as configured
+        in ``transfer_config``
+        """
+        bucket, key = bucket_and_key(s3_path)
+        self.s3_client.download_file(
+            bucket, key, str(download_path), Config=transfer_config
+        )
+
     @timer
     def _download_s3_file(self, s3_path: Path, download_path: Path):
-        s3_path.copy(download_path)
+        if self.s3_client is None:
+            s3_path.copy(download_path)
+            return
+        bucket, key = bucket_and_key(s3_path)
+        self.s3_client.download_file(
+            bucket, key, str(download_path), Config=self.transfer_config
+        )
+
+    @timer
+    def _stream_s3_file(self, s3_path: Path, download_path: Path) -> str:
+        """Download S3 object body while computing its SHA1 in the same pass,
+        so the downloaded file is never read back from the disk
+        """
+        with profiler.phase("s3_get"):
+            if self.s3_client is None:
+                source = s3_path.open("rb")
+            else:
+                bucket, key = bucket_and_key(s3_path)
+                source = self.s3_client.get_object(Bucket=bucket, Key=key)["Body"]
+        with source, download_path.open("wb") as destination:
+            sha1 = sha1_stream(
+                source,
+                buffer_size=self.hash_buffer_size,
+                destination=destination,
+                read_phase="s3_get",
+            )
+        return f"SHA1:{sha1}"
 
     @classmethod
     @timer
-    def _compute_sha1(cls, file: Path) -> str:
-        # consider stream file as allowed from python 3.11
-        return f"SHA1:{hashlib.sha1(file.read_bytes()).hexdigest()}"  # nosec
+    def _compute_sha1(
+        cls, file: Path, buffer_size: int = DEFAULT_HASH_BUFFER_SIZE
+    ) -> str:
+        return f"SHA1:{sha1_file(file, buffer_size=buffer_size)}"
 
     @timer
     def _backup_file_with_sha1(
@@ -247,40 +1528,85 @@ class NextcloudS3Backup:
         s3_path: Path,
     ) -> Path:
         repo_file = dir_config.backup_root_path / REPOSITORY_DIRNAME / nc_file.hash_path
-        if not repo_file.exists():
-            if s3_path.exists():
-                downloading_path = repo_file.with_suffix(".downloading")
-                downloading_path.parent.mkdir(parents=True, exist_ok=True)
-                self._download_s3_file(s3_path, downloading_path)
-                sha1 = self._compute_sha1(downloading_path)
-                if sha1.lower() != nc_file.checksum.lower():
-                    logger.warning(
-                        "SHA1 hash mismatched on file %s (%s). "
-                        "NC table: %s - downloaded: %s. "
-                        "Use local downloaded file hash instead.",
-                        nc_file.fileid,
-                        nc_file.path,
-                        nc_file.checksum,
-                        sha1,
-                    )
-                    nc_file.checksum = sha1
-                    repo_file = (
-                        dir_config.backup_root_path
-                        / REPOSITORY_DIRNAME
-                        / nc_file.hash_path
-                    )
-                    repo_file.parent.mkdir(parents=True, exist_ok=True)
-                downloading_path.rename(repo_file)
-            else:
-                logger.warning(
-                    "Ignoring Nextcloud record DB file not found on s3. "
-                    "Storage: %s - path %s",
-                    nc_file.storage,
-                    s3_path,
-                )
-                return
+        if repo_file.exists():
+            return repo_file
+        while True:
+            flight_repo_file, shared = self._flights.do(
+                repo_file,
+                self._download_sha1_file,
+                nc_file,
+                dir_config,
+                s3_path,
+                repo_file,
+            )
+            if not shared or flight_repo_file == repo_file:
+                return flight_repo_file
+            # S3 object of the flight leader is missing or its content doesn't
+            # match nextcloud checksum, try with ours
+
+    def _download_sha1_file(
+        self,
+        nc_file: NextcloudFile,
+        dir_config: NextcloudDirectoryConfig,
+        s3_path: Path,
+        repo_file: Path,
+    ) -> Optional[Path]:
+        if repo_file.exists():
+            # published by a flight which just landed
+            return repo_file
+        if not self._s3_object_exists(nc_file, dir_config, s3_path):
+            self._warn_missing_s3_file(nc_file, s3_path)
+            return
+        downloading_path = repo_file.with_suffix(".downloading")
+        self._start_download(dir_config, downloading_path)
+        sha1 = self._fetch_s3_file(s3_path, downloading_path, nc_file.size)
+        return self._publish_repo_file(
+            dir_config,
+            downloading_path,
+            self._downloaded_repo_file(nc_file, dir_config, sha1, repo_file),
+        )
+
+    @staticmethod
+    def _shared_repo_file(nc_file: NextcloudFile, repo_file: Path) -> Path:
+        """Repository file downloaded by the flight of an other row sharing
+        the same etag, ``nc_file`` checksum is set to its SHA1
+        """
+        nc_file.checksum = f"SHA1:{hash_from_path(repo_file)}"
         return repo_file
 
+    @staticmethod
+    def _warn_missing_s3_file(nc_file: NextcloudFile, s3_path: Path):
+        logger.warning(
+            "Ignoring Nextcloud record DB file not found on s3. "
+            "Storage: %s - path %s",
+            nc_file.storage,
+            s3_path,
+        )
+
+    @staticmethod
+    def _downloaded_repo_file(
+        nc_file: NextcloudFile,
+        dir_config: NextcloudDirectoryConfig,
+        sha1: str,
+        repo_file: Path,
+    ) -> Path:
+        """Repository file of downloaded content, which is not ``repo_file``
+        if downloaded content doesn't match nextcloud checksum
+        """
+        if sha1.lower() == nc_file.checksum.lower():
+            return repo_file
+        logger.warning(
+            "SHA1 hash mismatched on file %s (%s). "
+            "NC table: %s - downloaded: %s. "
+            "Use local downloaded file hash instead.",
+            nc_file.fileid,
+            nc_file.path,
+            nc_file.checksum,
+            sha1,
+        )
+        nc_file.checksum = sha1
+        return dir_config.backup_root_path / REPOSITORY_DIRNAME / nc_file.hash_path
+
     @timer
     def _backup_file_without_sha1(
         self,
@@ -288,20 +1614,15 @@ class NextcloudS3Backup:
         dir_config: NextcloudDirectoryConfig,
         s3_path: Path,
     ):
-        if s3_path.exists():
+        if self._s3_object_exists(nc_file, dir_config, s3_path):
             return self._backup_file_with_etag(
                 nc_file,
                 dir_config,
                 s3_path,
-                f"ETAG:{s3_path.stat().etag}",
+                f"ETAG:{self._s3_object_etag(nc_file, dir_config, s3_path)}",
             )
         else:
-            logger.warning(
-                "Ignoring Nextcloud record DB file not found on s3. "
-                "Storage: %s - path %s",
-                nc_file.storage,
-                s3_path,
-            )
+            self._warn_missing_s3_file(nc_file, s3_path)
             return
 
     @timer
@@ -309,7 +1630,7 @@ class NextcloudS3Backup:
         self, dir_config: NextcloudDirectoryConfig, searched_file: Path
     ) -> Path:
         sha1_directory = dir_config.backup_root_path / REPOSITORY_DIRNAME / "sha1"
-        repo_file = self._find_files_with_same_inode_as(sha1_directory, searched_file)
+        repo_file = self._find_files_with_same_inode_as(dir_config, searched_file)
         if repo_file:
             # only the first one we shouldn't get two here
             return repo_file
@@ -322,9 +1643,19 @@ class NextcloudS3Backup:
         return repo_file
 
     def _find_files_with_same_inode_as(
-        self, root_search_directory: Path, searched_file: Path
+        self, dir_config: NextcloudDirectoryConfig, searched_file: Path
     ):
-        return self._sha1_file_per_inode.get(searched_file.stat().st_ino)
+        sha1 = self._sha1_file_per_inode[dir_config.backup_root_path].get(
+            searched_file.stat().st_ino
+        )
+        if sha1:
+            return (
+                dir_config.backup_root_path
+                / REPOSITORY_DIRNAME
+                / "sha1"
+                / sha1[:2]
+                / sha1[2:]
+            )
 
     @timer
     def _backup_file_with_etag(
@@ -338,30 +1669,93 @@ class NextcloudS3Backup:
         etag_repo_file = (
             dir_config.backup_root_path / REPOSITORY_DIRNAME / nc_file.hash_path
         )
-        repo_file = None
-        if not etag_repo_file.exists():
-            downloading_path = etag_repo_file.with_suffix(".downloading")
-            downloading_path.parent.mkdir(parents=True, exist_ok=True)
-            self._download_s3_file(s3_path, downloading_path)
-            nc_file.checksum = self._compute_sha1(downloading_path)
-            repo_file = (
-                dir_config.backup_root_path / REPOSITORY_DIRNAME / nc_file.hash_path
-            )
+        if etag_repo_file.exists():
+            return self._resolve_etag_file(nc_file, dir_config, etag_repo_file)
+        repo_file, shared = self._flights.do(
+            etag_repo_file,
+            self._fetch_etag_file,
+            nc_file,
+            dir_config,
+            s3_path,
+            etag_repo_file,
+        )
+        return self._shared_repo_file(nc_file, repo_file) if shared else repo_file
+
+    def _fetch_etag_file(
+        self,
+        nc_file: NextcloudFile,
+        dir_config: NextcloudDirectoryConfig,
+        s3_path: Path,
+        etag_repo_file: Path,
+    ) -> Path:
+        with self._locks(("fetch", etag_repo_file)):
+            if not etag_repo_file.exists():
+                return self._download_etag_file(
+                    nc_file, dir_config, s3_path, etag_repo_file
+                )
+        # published by a flight which just landed
+        return self._resolve_etag_file(nc_file, dir_config, etag_repo_file)
+
+    def _download_etag_file(
+        self,
+        nc_file: NextcloudFile,
+        dir_config: NextcloudDirectoryConfig,
+        s3_path: Path,
+        etag_repo_file: Path,
+    ) -> Path:
+        downloading_path = etag_repo_file.with_suffix(".downloading")
+        self._start_download(dir_config, downloading_path)
+        nc_file.checksum = self._fetch_s3_file(s3_path, downloading_path, nc_file.size)
+        return self._publish_etag_file(
+            nc_file, dir_config, downloading_path, etag_repo_file
+        )
+
+    def _publish_etag_file(
+        self,
+        nc_file: NextcloudFile,
+        dir_config: NextcloudDirectoryConfig,
+        downloading_path: Path,
+        etag_repo_file: Path,
+    ) -> Path:
+        """Move a downloaded file to its etag repository location and hard
+        link it to its sha1 repository location, return the latter
+        """
+        repo_file = dir_config.backup_root_path / REPOSITORY_DIRNAME / nc_file.hash_path
+        with self._locks(("commit", repo_file)):
             if repo_file.exists():
                 downloading_path.unlink()
-                os.link(repo_file, etag_repo_file)
+                self._link_replica(repo_file, etag_repo_file, dir_config)
             else:
                 downloading_path.rename(etag_repo_file)
-                repo_file.parent.mkdir(parents=True, exist_ok=True)
+                make_directory(repo_file.parent)
                 os.link(etag_repo_file, repo_file)
-        else:
+                # etag of other rows is resolved from its inode before this
+                # row is linked (ie: with download plan or workers)
+                self._ensure_sha1_file_per_inode_exists(repo_file, dir_config)
+        index = self.get_index(dir_config.backup_root_path)
+        index.remove_download(downloading_path)
+        index.add_etag(hash_from_path(etag_repo_file), hash_from_path(repo_file))
+        return repo_file
+
+    def _resolve_etag_file(
+        self,
+        nc_file: NextcloudFile,
+        dir_config: NextcloudDirectoryConfig,
+        etag_repo_file: Path,
+    ) -> Path:
+        with self._locks(("fetch", etag_repo_file)):
             repo_file = self._find_sha1_from_inode(dir_config, etag_repo_file)
-            if not repo_file or not repo_file.exists():
-                # weird case
-                nc_file.checksum = self._compute_sha1(etag_repo_file)
-                repo_file = (
-                    dir_config.backup_root_path / REPOSITORY_DIRNAME / nc_file.hash_path
-                )
+            if repo_file and repo_file.exists():
+                nc_file.checksum = f"SHA1:{hash_from_path(repo_file)}"
+                return repo_file
+            # weird case
+            nc_file.checksum = self._compute_sha1(
+                etag_repo_file, buffer_size=self.hash_buffer_size
+            )
+            repo_file = (
+                dir_config.backup_root_path / REPOSITORY_DIRNAME / nc_file.hash_path
+            )
+            with self._locks(("commit", repo_file)):
                 if repo_file.exists():
                     # assuming inconsistency data wrongly synced
                     # .data losing hardlink
@@ -369,12 +1763,12 @@ class NextcloudS3Backup:
                     # etag from sha1 as long snapshot files point to sha1 files
                     # we do not want to remove sha1
                     etag_repo_file.unlink()
-                    os.link(repo_file, etag_repo_file)
+                    self._link_replica(repo_file, etag_repo_file, dir_config)
                 else:
-                    repo_file.parent.mkdir(parents=True, exist_ok=True)
+                    make_directory(repo_file.parent)
                     os.link(etag_repo_file, repo_file)
-            else:
-                sha1 = "".join(repo_file.parts[:2])
-                nc_file.checksum = f"SHA1:{sha1}"
-
+                    self._ensure_sha1_file_per_inode_exists(repo_file, dir_config)
+            self.get_index(dir_config.backup_root_path).add_etag(
+                hash_from_path(etag_repo_file), hash_from_path(repo_file)
+            )
         return repo_file
@@ -20,4 +20,8 @@ class NextCloudS3BackupConfig:
 
     backup_date_format: str = "%y%m%d-%H%M"
     excluded_mimetype_ids: List[int] = field(default_factory=list)
+    # only backup files of these mimetypes or mimeparts (``oc_mimetypes``
+    # ids) if any
+    included_mimetype_ids: List[int] = field(default_factory=list)
+    included_mimepart_ids: List[int] = field(default_factory=list)
     mapping: List[NextcloudDirectoryConfig] = field(default_factory=list)
@@ -1,16 +1,17 @@
+import itertools
 import logging
-from dataclasses import dataclass
+import sys
 from pathlib import PurePath
-from typing import List
+from typing import Iterator, List, Optional, Sequence, Tuple
 
 import psycopg2
 from psycopg2.extensions import ISOLATION_LEVEL_SERIALIZABLE
 
 logger = logging.getLogger(__name__)
 SAVEPOINT_NAME = "nc_s3_backup_save_point"
+DEFAULT_ITERSIZE = 2000
 
 
-@dataclass
 class NextcloudFile:
     """
     used? | Field name        | info                    | data example
@@ -26,30 +27,148 @@ class NextcloudFile:
           |  mimepart         | first part mimetype id
                                 text/md => text         | 3
           |  size             |                         | 67
-          |  mtime            |                         | 1640342159
+    *     |  mtime            |                         | 1640342159
           |  storage_mtime    |                         | 1640342164
           |  encrypted        |                         | 0
           |  unencrypted_size |                         | 0
-          |  etag             |                         | 61c5a2940ccc7
+    *     |  etag             |                         | 61c5a2940ccc7
           |  permissions      |                         | 27
     *     |  checksum         | file hash               | SHA1:00dea...94d34d1623
     """
 
-    fileid: int
-    storage: int
-    path: str
-    checksum: str
-    size: int
+    # one instance is created per oc_filecache row, slots avoid a per
+    # instance ``__dict__``
+    __slots__ = (
+        "fileid",
+        "storage",
+        "path",
+        "_checksum",
+        "size",
+        "mtime",
+        "etag",
+        "_hash_path",
+    )
+
+    def __init__(
+        self,
+        fileid: int,
+        storage: int,
+        path: str,
+        checksum: str,
+        size: int,
+        mtime: int = None,
+        etag: str = None,
+    ):
+        self.fileid = fileid
+        self.storage = storage
+        self.path = path
+        self._checksum = checksum
+        self.size = size
+        self.mtime = mtime
+        self.etag = etag
+        self._hash_path = None
 
     @property
-    def hash_path(self):
+    def checksum(self) -> str:
+        return self._checksum
+
+    @checksum.setter
+    def checksum(self, value: str):
+        self._checksum = value
+        self._hash_path = None
+
+    @property
+    def hash_path(self) -> PurePath:
         """return relative path construct from file checksum
 
         in order to store data as
         hash_method / hash_begining / hash_end
+
+        The value is cached until checksum is changed.
         """
-        method, hash_value = self.checksum.lower().split(":", 1)
-        return PurePath(method, hash_value[:2], hash_value[2:])
+        if self._hash_path is None:
+            method, hash_value = self._checksum.lower().split(":", 1)
+            self._hash_path = PurePath(method, hash_value[:2], hash_value[2:])
+        return self._hash_path
+
+    def _astuple(self):
+        return (
+            self.fileid,
+            self.storage,
+            self.path,
+            self._checksum,
+            self.size,
+            self.mtime,
+            self.etag,
+        )
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self._astuple() == other._astuple()
+
+    # mutable object
+    __hash__ = None
+
+    def __repr__(self):
+        return (
+            f"{self.__class__.__name__}(fileid={self.fileid!r}, "
+            f"storage={self.storage!r}, path={self.path!r}, "
+            f"checksum={self._checksum!r}, size={self.size!r}, "
+            f"mtime={self.mtime!r}, etag={self.etag!r})"
+        )
+
+
+def path_prefix_pattern(root_path: str) -> str:
+    """Case sensitive ``LIKE`` pattern of paths starting with ``root_path``,
+    ``%`` and ``_`` in ``root_path`` are matched literally.
+
+    Unlike ``ILIKE``, postgresql can turn such pattern into an index range
+    scan (using an index on ``path text_pattern_ops`` or with C collation).
+    """
+    escaped = root_path.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return escaped + "%"
+
+
+def path_prefix_range(root_path: str) -> Tuple[str, Optional[str]]:
+    """``[lower, upper)`` bounds of paths starting with ``root_path`` in code
+    point (C collation) order, ``upper`` is None if there is no upper bound.
+    """
+    upper = root_path
+    while upper and upper[-1] == chr(sys.maxunicode):
+        upper = upper[:-1]
+    if not upper:
+        return root_path, None
+    next_char = ord(upper[-1]) + 1
+    if 0xD800 <= next_char <= 0xDFFF:
+        # surrogates can't be encoded
+        next_char = 0xE000
+    return root_path, upper[:-1] + chr(next_char)
+
+
+def mimetype_filters(
+    excluded_mimetype: Sequence[int],
+    mimetypes: Sequence[int] = (),
+    mimeparts: Sequence[int] = (),
+) -> Tuple[str, dict]:
+    """``oc_filecache f`` mimetype conditions and their query parameters:
+    files of ``mimetypes`` or ``mimeparts`` if any, except
+    ``excluded_mimetype``
+    """
+    conditions, params = [], {}
+    if excluded_mimetype:
+        conditions.append("f.mimetype NOT IN %(excluded_mimetype)s")
+        params["excluded_mimetype"] = tuple(excluded_mimetype)
+    included = []
+    if mimetypes:
+        included.append("f.mimetype IN %(mimetypes)s")
+        params["mimetypes"] = tuple(mimetypes)
+    if mimeparts:
+        included.append("f.mimepart IN %(mimeparts)s")
+        params["mimeparts"] = tuple(mimeparts)
+    if included:
+        conditions.append(f"({' OR '.join(included)})")
+    return "".join(f" AND {condition}" for condition in conditions), params
 
 
 class Dao:
@@ -116,24 +235,103 @@ class Dao:
 class DaoNextcloudFiles(Dao):
     """Method to retrieve Nextcloud database information"""
 
+    _cursor_ids = itertools.count()
+
+    def __init__(self, pg_url, schema="public", itersize=DEFAULT_ITERSIZE):
+        super().__init__(pg_url, schema=schema)
+        self.itersize = itersize
+
     def get_nc_subtree(
-        self, storage_id: int, root_path: str, excluded_mimetype: List[int]
-    ) -> List[NextcloudFile]:
-        search_path = root_path + "%"
+        self,
+        storage_id: int,
+        root_path: str,
+        excluded_mimetype: List[int],
+        mimetypes: Sequence[int] = (),
+        mimeparts: Sequence[int] = (),
+    ) -> Iterator[NextcloudFile]:
+        """Yield files under ``root_path`` as soon as they are received.
+
+        Rows are read through a server side (named) cursor, only
+        ``itersize`` rows are fetched from the database at a time.
+        """
         # TODO: manage checksum null or empty
-        query = """
-            SELECT fileid, storage, path, checksum, size
-            FROM oc_filecache
+        filters, params = mimetype_filters(excluded_mimetype, mimetypes, mimeparts)
+        query = f"""
+            SELECT fileid, storage, path, checksum, size, mtime, etag
+            FROM oc_filecache f
             WHERE storage=%(storage_id)s
-                AND path ILIKE %(path)s
-                AND mimetype NOT IN %(excluded_mimetype)s
+                AND path LIKE %(path)s
+                {filters}
         """
-        self._cr.execute(
-            query,
-            dict(
-                storage_id=storage_id,
-                path=search_path,
-                excluded_mimetype=tuple(excluded_mimetype),
-            ),
-        )
-        return [NextcloudFile(*r) for r in self._cr.fetchall()]
+        params.update(storage_id=storage_id, path=path_prefix_pattern(root_path))
+        cursor = Dao._cnx.cursor(name=f"nc_subtree_{next(self._cursor_ids)}")
+        cursor.itersize = self.itersize
+        try:
+            cursor.execute(query, params)
+            for row in cursor:
+                yield NextcloudFile(*row)
+        finally:
+            cursor.close()
+
+    def get_nc_subtrees(
+        self,
+        subtrees: Sequence[Tuple[int, str]],
+        excluded_mimetype: List[int],
+        mimetypes: Sequence[int] = (),
+        mimeparts: Sequence[int] = (),
+    ) -> Iterator[Tuple[int, NextcloudFile]]:
+        """Yield files under each ``(storage_id, root_path)`` of ``subtrees``
+        using a single query, tagged with their subtree index.
+
+        The query is a ``UNION ALL`` of one select per subtree, each one
+        bounding ``path`` to the subtree range with constants so it can be
+        an index range scan, unlike a join on ``LIKE`` patterns: the
+        constant ``LIKE`` pattern suits an index on ``path
+        text_pattern_ops``, the C collation range an index with C
+        collation. A file under several subtrees is yield once per subtree.
+        Rows are not ordered by subtree.
+        """
+        filters, params = mimetype_filters(excluded_mimetype, mimetypes, mimeparts)
+        selects = []
+        for index, (storage_id, root_path) in enumerate(subtrees):
+            lower, upper = path_prefix_range(root_path)
+            conditions = f"f.storage = %(storage_id_{index})s"
+            params[f"storage_id_{index}"] = storage_id
+            if lower:
+                conditions += (
+                    f" AND f.path LIKE %(pattern_{index})s"
+                    f' AND f.path >= %(path_{index})s COLLATE "C"'
+                )
+                params[f"pattern_{index}"] = path_prefix_pattern(root_path)
+                params[f"path_{index}"] = lower
+            if upper is not None:
+                conditions += f' AND f.path < %(path_upper_{index})s COLLATE "C"'
+                params[f"path_upper_{index}"] = upper
+            selects.append(
+                f"""
+            SELECT {index},
+                f.fileid, f.storage, f.path, f.checksum, f.size, f.mtime, f.etag
+            FROM oc_filecache f
+            WHERE {conditions}
+                {filters}
+        """
+            )
+        query = "UNION ALL".join(selects)
+        if logger.isEnabledFor(logging.DEBUG):
+            self.log_explain(query, params)
+        cursor = Dao._cnx.cursor(name=f"nc_subtrees_{next(self._cursor_ids)}")
+        cursor.itersize = self.itersize
+        try:
+            cursor.execute(query, params)
+            for index, *row in cursor:
+                yield index, NextcloudFile(*row)
+        finally:
+            cursor.close()
+
+    @classmethod
+    def log_explain(cls, query: str, params: dict):
+        """Log the plan postgresql chose for ``query`` (without running it),
+        ie: to check which ``oc_filecache`` indexes are used
+        """
+        Dao._cr.execute("EXPLAIN " + query, params)
+        logger.debug("Query plan:\n%s", "\n".join(line for line, in Dao._cr.fetchall()))
@@ -0,0 +1,300 @@
+import logging
+import os
+import sqlite3
+import threading
+from collections import namedtuple
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from nc_s3_backup.api.walk import walk_files
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILENAME = "index.sqlite"
+COMMIT_EVERY = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blob (
+    sha1 TEXT PRIMARY KEY,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS blob_inode ON blob (inode);
+CREATE TABLE IF NOT EXISTS replica (
+    inode INTEGER PRIMARY KEY,
+    sha1 TEXT NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS replica_sha1 ON replica (sha1);
+CREATE TABLE IF NOT EXISTS etag (
+    etag TEXT PRIMARY KEY,
+    sha1 TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS etag_sha1 ON etag (sha1);
+CREATE TABLE IF NOT EXISTS filecache (
+    fileid INTEGER PRIMARY KEY,
+    etag TEXT,
+    mtime INTEGER,
+    size INTEGER,
+    sha1 TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS download (
+    path TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+BLOB_INSERT = "INSERT OR REPLACE INTO blob (sha1, inode, size) VALUES (?, ?, ?)"
+REPLICA_INSERT = "INSERT OR REPLACE INTO replica (sha1, inode, size) VALUES (?, ?, ?)"
+
+CachedFile = namedtuple("CachedFile", ["etag", "mtime", "size", "sha1"])
+
+
+def hash_from_path(repo_file: Path) -> str:
+    """Return hash value from a repository file path,
+    ie: ``.data/sha1/fe/e41dea13f`` => ``fee41dea13f``, replicas share the
+    hash of the file they copy: ``.data/sha1/fe/e41dea13f.1`` => ``fee41dea13f``
+    """
+    return repo_file.parent.name + repo_file.name.split(".", 1)[0]
+
+
+def replica_number(repo_file: Path) -> int:
+    """``.data/sha1/fe/e41dea13f.2`` => ``2``, 0 if not a replica"""
+    _, _, number = repo_file.name.partition(".")
+    return int(number) if number.isdigit() else 0
+
+
+def replica_path(repo_file: Path, number: int) -> Path:
+    """Path of the replica ``number`` of a sha1 repository file.
+
+    Replicas are copies of the same content with their own inode, so a
+    content can be linked more than the file system hard link limit.
+    Replica 0 is the repository file itself.
+    """
+    if not number:
+        return repo_file
+    return repo_file.with_name(f"{repo_file.name}.{number}")
+
+
+def original_path(repo_file: Path) -> Path:
+    """``.data/sha1/fe/e41dea13f.2`` => ``.data/sha1/fe/e41dea13f``"""
+    return repo_file.with_name(repo_file.name.split(".", 1)[0])
+
+
+class RepositoryIndex:
+    """On disk index of a repository directory (``.data``) content.
+
+    Store sha1 <=> etag <=> inode <=> size relations, inodes of sha1
+    replicas are kept apart from the inode of the sha1 file itself, in a sqlite database
+    saved next to the ``sha1`` and ``etag`` directories so backup do not
+    have to walk the whole repository tree to know what it contains.
+
+    Downloads in progress (``.downloading`` files) are recorded until
+    published, so files left by an interrupted run are found without
+    walking the repository.
+
+    It also keeps ``oc_filecache`` metadata (``etag``, ``mtime``, ``size``)
+    of backup-ed files with their resolved sha1 per ``fileid``, so files
+    that didn't change can be linked without any S3 request.
+
+    Index is updated incrementally by backup and purge, in case it get out
+    of sync with the file system (ie: repository synced with an other tool)
+    it can be rebuilt from the file tree using ``rebuild``.
+
+    The connection is shared across threads, writes are serialized and
+    committed by batch of ``COMMIT_EVERY`` changes.
+    """
+
+    def __init__(self, repository_path: Path):
+        self.repository_path = repository_path
+        self.path = repository_path / INDEX_FILENAME
+        self._lock = threading.RLock()
+        self._cnx: Optional[sqlite3.Connection] = None
+        self._pending_changes = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._cnx is None:
+            self.repository_path.mkdir(parents=True, exist_ok=True)
+            self._cnx = sqlite3.connect(str(self.path), check_same_thread=False)
+            self._cnx.execute("PRAGMA journal_mode=WAL")
+            self._cnx.execute("PRAGMA synchronous=NORMAL")
+            self._cnx.executescript(SCHEMA)
+        return self._cnx
+
+    def _write(self, query: str, params: tuple):
+        with self._lock:
+            self._connect().execute(query, params)
+            self._pending_changes += 1
+            if self._pending_changes >= COMMIT_EVERY:
+                self.commit()
+
+    @property
+    def built(self) -> bool:
+        """True once the index has been built from the file tree"""
+        if not self.path.exists():
+            return False
+        with self._lock:
+            return (
+                self._connect()
+                .execute("SELECT 1 FROM meta WHERE key = 'built'")
+                .fetchone()
+                is not None
+            )
+
+    def sha1_per_inode(self) -> Dict[int, str]:
+        if not self.path.exists():
+            return {}
+        with self._lock:
+            return dict(
+                self._connect().execute(
+                    "SELECT inode, sha1 FROM blob "
+                    "UNION ALL SELECT inode, sha1 FROM replica"
+                )
+            )
+
+    def sha1_from_etag(self, etag: str) -> Optional[str]:
+        if not self.path.exists():
+            return None
+        with self._lock:
+            row = (
+                self._connect()
+                .execute("SELECT sha1 FROM etag WHERE etag = ?", (etag,))
+                .fetchone()
+            )
+        return row[0] if row else None
+
+    def cached_file(self, fileid: int) -> Optional[CachedFile]:
+        if not self.path.exists():
+            return None
+        with self._lock:
+            row = (
+                self._connect()
+                .execute(
+                    "SELECT etag, mtime, size, sha1 FROM filecache WHERE fileid = ?",
+                    (fileid,),
+                )
+                .fetchone()
+            )
+        return CachedFile(*row) if row else None
+
+    def cache_file(self, fileid: int, cached_file: CachedFile):
+        self._write(
+            "INSERT OR REPLACE INTO filecache (fileid, etag, mtime, size, sha1) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (fileid, *cached_file),
+        )
+
+    def add_blob(self, sha1: str, inode: int, size: int):
+        self._write(BLOB_INSERT, (sha1, inode, size))
+
+    def add_replica(self, sha1: str, inode: int, size: int):
+        self._write(REPLICA_INSERT, (sha1, inode, size))
+
+    def remove_blob(self, sha1: str):
+        """remove sha1 file and its replicas"""
+        self._write("DELETE FROM blob WHERE sha1 = ?", (sha1,))
+        self._write("DELETE FROM replica WHERE sha1 = ?", (sha1,))
+
+    def add_etag(self, etag: str, sha1: str):
+        self._write(
+            "INSERT OR REPLACE INTO etag (etag, sha1) VALUES (?, ?)", (etag, sha1)
+        )
+
+    def remove_etag(self, etag: str):
+        self._write("DELETE FROM etag WHERE etag = ?", (etag,))
+
+    def add_download(self, path: Path):
+        """Record a download in progress, committed right away to be known
+        by the next run if this one is interrupted
+        """
+        with self._lock:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO download (path) VALUES (?)",
+                (str(path.relative_to(self.repository_path)),),
+            )
+            self.commit()
+
+    def remove_download(self, path: Path):
+        self._write(
+            "DELETE FROM download WHERE path = ?",
+            (str(path.relative_to(self.repository_path)),),
+        )
+
+    def downloads(self) -> List[Path]:
+        """Recorded downloads, they may have been published by a run
+        interrupted before its next commit
+        """
+        if not self.path.exists():
+            return []
+        with self._lock:
+            return [
+                self.repository_path / path
+                for path, in self._connect().execute("SELECT path FROM download")
+            ]
+
+    def commit(self):
+        with self._lock:
+            if self._cnx is not None:
+                self._cnx.commit()
+            self._pending_changes = 0
+
+    def close(self):
+        with self._lock:
+            if self._cnx is not None:
+                self._cnx.commit()
+                self._cnx.close()
+                self._cnx = None
+
+    def rebuild(self) -> Tuple[int, int]:
+        """Drop index content and rebuild it from the repository tree,
+        ``.downloading`` files are recorded as downloads.
+
+        return the number of indexed sha1 and etag files.
+        """
+        sha1_per_inode = {}
+        with self._lock:
+            cnx = self._connect()
+            cnx.execute("DELETE FROM blob")
+            cnx.execute("DELETE FROM replica")
+            cnx.execute("DELETE FROM etag")
+            cnx.execute("DELETE FROM download")
+            cnx.execute("DELETE FROM meta")
+            for entry in self._walk(self.repository_path / "sha1"):
+                sha1 = hash_from_path(Path(entry.path))
+                inode = entry.inode()
+                sha1_per_inode[inode] = sha1
+                cnx.execute(
+                    (
+                        REPLICA_INSERT
+                        if replica_number(Path(entry.path))
+                        else BLOB_INSERT
+                    ),
+                    (sha1, inode, entry.stat(follow_symlinks=False).st_size),
+                )
+            etags = 0
+            for entry in self._walk(self.repository_path / "etag"):
+                sha1 = sha1_per_inode.get(entry.inode())
+                if not sha1:
+                    logger.warning("Etag file %s without sha1 hard link", entry.path)
+                    continue
+                etags += 1
+                cnx.execute(
+                    "INSERT OR REPLACE INTO etag (etag, sha1) VALUES (?, ?)",
+                    (hash_from_path(Path(entry.path)), sha1),
+                )
+            cnx.execute("INSERT INTO meta (key, value) VALUES ('built', '1')")
+            self.commit()
+        return len(sha1_per_inode), etags
+
+    def _walk(self, directory: Path) -> Iterator[os.DirEntry]:
+        for entry in walk_files(directory):
+            if entry.name.endswith(".downloading"):
+                self._connect().execute(
+                    "INSERT OR REPLACE INTO download (path) VALUES (?)",
+                    (str(Path(entry.path).relative_to(self.repository_path)),),
+                )
+            else:
+                yield entry
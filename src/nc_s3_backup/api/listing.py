@@ -0,0 +1,106 @@
+from collections import namedtuple
+from pathlib import PurePath
+from typing import Dict, Iterator, List, Optional, Tuple
+
+OID_PREFIX = "urn:oid:"
+# ListObjectsV2 maximum page size
+PAGE_SIZE = 1000
+
+ObjectInfo = namedtuple("ObjectInfo", ["size", "etag"])
+
+
+def bucket_and_prefix(bucket: PurePath) -> Tuple[str, str]:
+    """Split a mapping bucket path (ie: ``/bucket-name/optional/key``) into
+    the S3 bucket name and the key prefix of nextcloud objects.
+    """
+    _, bucket_name, *key_parts = bucket.parts
+    key = "/".join(key_parts)
+    return bucket_name, f"{key}/{OID_PREFIX}" if key else OID_PREFIX
+
+
+def bucket_and_key(s3_path: PurePath) -> Tuple[str, str]:
+    """ie: ``/bucket-name/some/key`` => ``("bucket-name", "some/key")``"""
+    _, bucket_name, *key_parts = s3_path.parts
+    return bucket_name, "/".join(key_parts)
+
+
+def fileid_prefixes(first: int, last: int) -> List[str]:
+    """Decimal prefixes of fileids from ``first`` to ``last`` (both included),
+    ie: ``fileid_prefixes(95, 120)`` =>
+    ``["10", "11", "120", "95", "96", "97", "98", "99"]``.
+
+    Keys are sorted as strings by S3, so a numeric fileid range can't be
+    listed using ``StartAfter``, it's listed prefix by prefix instead.
+    Listing a prefix also returns longer fileids starting with it, those
+    out of the range have to be filtered out.
+    """
+    prefixes = set()
+    for width in range(len(str(first)), len(str(last)) + 1):
+        fileid = max(first, 10 ** (width - 1))
+        width_last = min(last, 10**width - 1)
+        while fileid <= width_last:
+            step = 0
+            while (
+                step < width - 1
+                and fileid % 10 ** (step + 1) == 0
+                and fileid + 10 ** (step + 1) - 1 <= width_last
+            ):
+                step += 1
+            prefixes.add(str(fileid)[: width - step])
+            fileid += 10**step
+    # drop prefixes already listed by a shorter one
+    return sorted(
+        prefix
+        for prefix in prefixes
+        if not any(prefix[:length] in prefixes for length in range(1, len(prefix)))
+    )
+
+
+def list_objects(
+    client,
+    bucket_name: str,
+    prefix: str,
+    fileid_range: Optional[Tuple[int, int]] = None,
+) -> Iterator[Tuple[int, ObjectInfo]]:
+    """Yield ``(fileid, ObjectInfo)`` of nextcloud objects stored under
+    ``prefix`` using paginated ``ListObjectsV2`` requests, each page
+    returning size and etag of up to 1000 objects.
+    """
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(
+        Bucket=bucket_name,
+        Prefix=prefix,
+        PaginationConfig={"PageSize": PAGE_SIZE},
+    ):
+        for content in page.get("Contents", []):
+            try:
+                fileid = int(content["Key"].rsplit(OID_PREFIX, 1)[1])
+            except ValueError:
+                continue
+            if fileid_range and not fileid_range[0] <= fileid <= fileid_range[1]:
+                continue
+            yield fileid, ObjectInfo(content["Size"], content["ETag"].strip('"'))
+
+
+def list_bucket(
+    client,
+    bucket: PurePath,
+    fileid_range: Optional[Tuple[int, int]] = None,
+    map_func=map,
+) -> Dict[int, ObjectInfo]:
+    """List nextcloud objects of a mapping bucket, or only those in
+    ``fileid_range``, in a ``fileid => ObjectInfo`` map.
+
+    ``map_func`` is used to list fileid prefixes, it can be a concurrent
+    implementation of ``map``.
+    """
+    bucket_name, prefix = bucket_and_prefix(bucket)
+    prefixes = [prefix]
+    if fileid_range:
+        prefixes = [prefix + p for p in fileid_prefixes(*fileid_range)]
+    objects = {}
+    for listed in map_func(
+        lambda p: dict(list_objects(client, bucket_name, p, fileid_range)), prefixes
+    ):
+        objects.update(listed)
+    return objects
@@ -0,0 +1,298 @@
+import hashlib
+import mmap
+import os
+import sqlite3
+import sys
+import threading
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterable, List, Optional, Set, Tuple
+
+INODES_MANIFEST_FILENAME = ".inodes"
+FILES_MANIFEST_FILENAME = ".manifest.sqlite"
+JOURNAL_FILENAME = ".journal"
+WRITE_BATCH_SIZE = 1000
+# first item of inodes manifests, followed by the repository identifier
+INODES_MANIFEST_MAGIC = int.from_bytes(b"NCS3INO1", sys.byteorder)
+INODES_MANIFEST_HEADER_SIZE = 3
+
+FILES_MANIFEST_SCHEMA = """
+CREATE TABLE IF NOT EXISTS file (
+    mapping TEXT NOT NULL,
+    path TEXT NOT NULL,
+    fileid INTEGER,
+    size INTEGER,
+    mtime INTEGER,
+    etag TEXT,
+    checksum TEXT,
+    sha1 TEXT,
+    PRIMARY KEY (mapping, path)
+);
+"""
+
+ManifestEntry = namedtuple(
+    "ManifestEntry", ["fileid", "size", "mtime", "etag", "checksum", "sha1"]
+)
+
+
+def repository_id(repository: Path) -> Tuple[int, int]:
+    """Device and inode of the ``repository`` directory, (0, 0) if missing.
+
+    Inodes are only meaningful on the file system they were read from: a
+    copied or restored repository gets new ones, and a new directory.
+    """
+    try:
+        stat = repository.stat()
+    except FileNotFoundError:
+        return 0, 0
+    return stat.st_dev, stat.st_ino
+
+
+def write_inodes_manifest(
+    snapshot_directory: Path, inodes: Iterable[int], repository: Path
+) -> Path:
+    """Save ``repository`` inodes hard linked in a snapshot as an array of
+    unsigned 64 bits integers (native byte order): a magic number, the
+    repository identifier (see ``repository_id``) then sorted inodes.
+
+    File is written next to the snapshot users directories and renamed
+    once complete, so a manifest is either missing or complete.
+    """
+    manifest = snapshot_directory / INODES_MANIFEST_FILENAME
+    writing = manifest.with_suffix(".writing")
+    with writing.open("wb") as f:
+        array("Q", (INODES_MANIFEST_MAGIC, *repository_id(repository))).tofile(f)
+        array("Q", sorted(set(inodes))).tofile(f)
+    os.replace(writing, manifest)
+    return manifest
+
+
+def latest_completion_time(snapshots_directory: Path) -> Optional[float]:
+    """Time the latest complete snapshot (having an inodes manifest) of
+    ``snapshots_directory`` was completed, None if there is none
+    """
+    return max(
+        (
+            manifest.stat().st_mtime
+            for manifest in snapshots_directory.glob(f"*/{INODES_MANIFEST_FILENAME}")
+        ),
+        default=None,
+    )
+
+
+def remove_inodes_manifest(snapshot_directory: Path) -> bool:
+    """Remove the snapshot manifest before linking files in an existing
+    snapshot, so purge walks it until a new manifest is written. return
+    False if the snapshot had no manifest.
+    """
+    try:
+        (snapshot_directory / INODES_MANIFEST_FILENAME).unlink()
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def update_from_inodes_manifest(
+    inodes: Set[int], snapshot_directory: Path, repository: Path
+) -> bool:
+    """Add ``repository`` inodes saved in ``snapshot_directory`` manifest to
+    ``inodes``.
+
+    Manifest is memory mapped rather than loaded. return False if the
+    snapshot has no manifest or if it was written for an other repository
+    (or the same one copied or restored since, or without identifier), its
+    inodes can't be trusted then.
+    """
+    manifest = snapshot_directory / INODES_MANIFEST_FILENAME
+    try:
+        f = manifest.open("rb")
+    except FileNotFoundError:
+        return False
+    header = (INODES_MANIFEST_MAGIC, *repository_id(repository))
+    with f:
+        if os.fstat(f.fileno()).st_size < INODES_MANIFEST_HEADER_SIZE * 8:
+            return False
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped).cast("Q")
+            try:
+                if tuple(view[:INODES_MANIFEST_HEADER_SIZE]) != header:
+                    return False
+                inodes.update(view[INODES_MANIFEST_HEADER_SIZE:])
+            finally:
+                view.release()
+    return True
+
+
+class SnapshotManifest:
+    """Files backup-ed in a snapshot per mapping, saved in a sqlite
+    database at the root of the snapshot directory.
+
+    For each file we keep ``oc_filecache`` information as they were while
+    doing the backup (``fileid``, ``size``, ``mtime``, ``etag`` and
+    ``checksum``) and the ``sha1`` of the repository file it is linked to,
+    so next backup can tell which files didn't change.
+
+    Entries are added from any thread and written by batch.
+    """
+
+    def __init__(self, snapshot_directory: Path):
+        self.snapshot_directory = snapshot_directory
+        self.path = snapshot_directory / FILES_MANIFEST_FILENAME
+        self._lock = threading.Lock()
+        self._cnx: Optional[sqlite3.Connection] = None
+        self._pending: List[tuple] = []
+
+    @classmethod
+    def latest(
+        cls, snapshots_directory: Path, exclude: Path = None
+    ) -> Optional["SnapshotManifest"]:
+        """Return the manifest of the last written snapshot"""
+        manifests = [
+            manifest
+            for manifest in snapshots_directory.glob(f"*/{FILES_MANIFEST_FILENAME}")
+            if manifest.parent != exclude
+        ]
+        if not manifests:
+            return None
+        return cls(max(manifests, key=lambda m: m.stat().st_mtime).parent)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._cnx is None:
+            self.snapshot_directory.mkdir(parents=True, exist_ok=True)
+            self._cnx = sqlite3.connect(str(self.path), check_same_thread=False)
+            self._cnx.executescript(FILES_MANIFEST_SCHEMA)
+        return self._cnx
+
+    def entries(self, mapping: str) -> Dict[str, ManifestEntry]:
+        """Return manifest entries of a mapping per path"""
+        if not self.path.exists():
+            return {}
+        with self._lock:
+            return {
+                row[0]: ManifestEntry(*row[1:])
+                for row in self._connect().execute(
+                    "SELECT path, fileid, size, mtime, etag, checksum, sha1 "
+                    "FROM file WHERE mapping = ?",
+                    (mapping,),
+                )
+            }
+
+    def add(self, mapping: str, path: str, entry: ManifestEntry):
+        with self._lock:
+            self._pending.append((mapping, path, *entry))
+            if len(self._pending) >= WRITE_BATCH_SIZE:
+                self._flush()
+
+    def _flush(self):
+        if self._pending:
+            cnx = self._connect()
+            cnx.executemany(
+                "INSERT OR REPLACE INTO file "
+                "(mapping, path, fileid, size, mtime, etag, checksum, sha1) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                self._pending,
+            )
+            cnx.commit()
+            self._pending = []
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            if self._cnx is not None:
+                self._cnx.close()
+                self._cnx = None
+
+
+class SnapshotJournal:
+    """Append only journal of files linked in a snapshot, so a backup
+    interrupted before the end can be resumed without examining them again.
+
+    Each file is recorded as a 64 bits key hashed from its mapping, path
+    and fileid (native byte order). Keys are added from any thread and
+    appended to the journal by batch, a key torn by a crash is dropped
+    when the journal is opened again. The journal is removed once the
+    snapshot inodes manifest is written, a snapshot with a journal but
+    without inodes manifest is incomplete.
+    """
+
+    def __init__(self, snapshot_directory: Path):
+        self.snapshot_directory = snapshot_directory
+        self.path = snapshot_directory / JOURNAL_FILENAME
+        self._lock = threading.Lock()
+        self._file: Optional[BinaryIO] = None
+        self._pending = array("Q")
+        # sorted keys recorded by previous runs
+        self._recorded = array("Q")
+
+    @classmethod
+    def incomplete(cls, snapshots_directory: Path) -> List["SnapshotJournal"]:
+        """Return journals of incomplete snapshots"""
+        return [
+            cls(journal.parent)
+            for journal in snapshots_directory.glob(f"*/{JOURNAL_FILENAME}")
+            if not (journal.parent / INODES_MANIFEST_FILENAME).exists()
+        ]
+
+    @staticmethod
+    def key(mapping: str, path: str, fileid: int) -> int:
+        digest = hashlib.blake2b(
+            f"{mapping}\0{path}\0{fileid}".encode(), digest_size=8
+        ).digest()
+        return int.from_bytes(digest, sys.byteorder)
+
+    def open(self, load: bool = False):
+        """Create the journal or open it to append keys, keys recorded by
+        previous runs are loaded if ``load``.
+
+        Loaded keys are kept as a sorted array (8 bytes per file) rather
+        than a set.
+        """
+        self.snapshot_directory.mkdir(parents=True, exist_ok=True)
+        self._file = self.path.open("ab")
+        size = self._file.tell()
+        torn = size % self._pending.itemsize
+        if torn:
+            size -= torn
+            self._file.truncate(size)
+        if load and size:
+            with self.path.open("rb") as f:
+                recorded = array("Q")
+                recorded.fromfile(f, size // recorded.itemsize)
+            self._recorded = array("Q", sorted(recorded))
+
+    @property
+    def recorded(self) -> int:
+        """number of keys loaded from previous runs"""
+        return len(self._recorded)
+
+    def __contains__(self, key: int) -> bool:
+        index = bisect_left(self._recorded, key)
+        return index < len(self._recorded) and self._recorded[index] == key
+
+    def add(self, key: int):
+        with self._lock:
+            self._pending.append(key)
+            if len(self._pending) >= WRITE_BATCH_SIZE:
+                self._flush()
+
+    def _flush(self):
+        if self._pending:
+            self._pending.tofile(self._file)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._pending = array("Q")
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._flush()
+                self._file.close()
+                self._file = None
+
+    def remove(self):
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
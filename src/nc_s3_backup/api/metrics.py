@@ -0,0 +1,164 @@
+import json
+import math
+import os
+import threading
+from functools import wraps
+from pathlib import Path
+from time import perf_counter
+from typing import Dict, Iterator, List, Tuple
+
+# histogram buckets upper bounds grow by GROWTH from LOWEST (1µs): percentiles
+# are approximated with less than 10% relative error up to ~12 days
+LOWEST = 1e-6
+GROWTH = 2 ** (1 / 8)
+BUCKETS = 8 * 40
+QUANTILES = (0.5, 0.95, 0.99)
+PROMETHEUS_PREFIX = "nc_s3_backup_operation_duration"
+
+
+def bucket_index(value: float) -> int:
+    if value <= LOWEST:
+        return 0
+    return min(BUCKETS - 1, math.ceil(math.log(value / LOWEST, GROWTH)))
+
+
+def bucket_upper_bound(index: int) -> float:
+    return LOWEST * GROWTH**index
+
+
+class Histogram:
+    """Distribution of observed values using constant memory.
+
+    Values are counted in ``BUCKETS`` log scaled buckets, whatever the
+    number of observations only their count, sum, min, max and buckets
+    counters are kept, percentiles are read from buckets.
+    """
+
+    __slots__ = ("buckets", "count", "sum", "min", "max")
+
+    def __init__(self):
+        self.buckets: List[int] = [0] * BUCKETS
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def observe(self, value: float):
+        self.buckets[bucket_index(value)] += 1
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        """upper bound of the bucket holding the ``q`` quantile, within
+        observed min and max
+        """
+        if not self.count:
+            return 0.0
+        rank = max(1, math.ceil(q * self.count))
+        cumulative = 0
+        for index, count in enumerate(self.buckets[:-1]):
+            cumulative += count
+            if cumulative >= rank:
+                return min(max(bucket_upper_bound(index), self.min), self.max)
+        # values above the last bucket upper bound are counted in it
+        return self.max
+
+    def summary(self) -> Dict[str, float]:
+        summary = dict(
+            count=self.count,
+            sum=self.sum,
+            min=self.min if self.count else 0.0,
+            max=self.max if self.count else 0.0,
+        )
+        for q in QUANTILES:
+            summary[f"p{round(q * 100)}"] = self.quantile(q)
+        return summary
+
+
+class MetricsRegistry:
+    """Thread safe registry of histograms of operations durations
+    (in seconds) fed by the ``timer`` decorator.
+
+    Metrics can be written as a prometheus text file (ie: for the
+    node_exporter textfile collector) or as JSON.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms: Dict[str, Histogram] = {}
+
+    def observe(self, name: str, value: float):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def summaries(self) -> Iterator[Tuple[str, Dict[str, float]]]:
+        with self._lock:
+            summaries = [
+                (name, histogram.summary())
+                for name, histogram in self._histograms.items()
+            ]
+        yield from summaries
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+    def to_json(self) -> str:
+        return json.dumps(dict(self.summaries()), indent=2, sort_keys=True)
+
+    def to_prometheus(self) -> str:
+        summaries = list(self.summaries())
+        name = f"{PROMETHEUS_PREFIX}_seconds"
+        lines = [
+            f"# HELP {name} Duration of nc-s3-backup operations",
+            f"# TYPE {name} summary",
+        ]
+        for operation, summary in summaries:
+            for q in QUANTILES:
+                lines.append(_sample(name, summary[f"p{round(q * 100)}"], operation, q))
+            lines.append(_sample(f"{name}_sum", summary["sum"], operation))
+            lines.append(_sample(f"{name}_count", summary["count"], operation))
+        for key in ("min", "max"):
+            name = f"{PROMETHEUS_PREFIX}_{key}_seconds"
+            lines.append(f"# TYPE {name} gauge")
+            for operation, summary in summaries:
+                lines.append(_sample(name, summary[key], operation))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: Path):
+        """Write metrics as JSON if ``path`` ends with ``.json``, as a
+        prometheus text file otherwise. File is replaced atomically so
+        collectors never read a partial file.
+        """
+        content = self.to_json() if path.suffix == ".json" else self.to_prometheus()
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        tmp_path.write_text(content)
+        os.replace(tmp_path, path)
+
+
+def _sample(name: str, value: float, operation: str, quantile: float = None) -> str:
+    labels = 'operation="{}"'.format(operation)
+    if quantile is not None:
+        labels += ',quantile="{}"'.format(quantile)
+    return f"{name}{{{labels}}} {value!r}"
+
+
+registry = MetricsRegistry()
+
+
+def timer(func):
+    @wraps(func)
+    def wrap_func(*args, **kwargs):
+        t1 = perf_counter()
+        result = func(*args, **kwargs)
+        registry.observe(func.__name__, perf_counter() - t1)
+        return result
+
+    return wrap_func
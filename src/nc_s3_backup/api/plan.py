@@ -0,0 +1,109 @@
+from collections import namedtuple
+from pathlib import Path
+from typing import Dict, Hashable, Iterator, List, Optional
+
+from nc_s3_backup.api.config import NextcloudDirectoryConfig
+from nc_s3_backup.api.db import NextcloudFile
+from nc_s3_backup.api.index import CachedFile
+
+# one snapshot file to link, ``cached_file`` is its metadata cache entry
+PlannedFile = namedtuple("PlannedFile", ["dir_config", "nc_file", "cached_file"])
+
+
+class Blob:
+    """Unique content of a repository: rows sharing the same SHA1 checksum,
+    or the rows of a fileid if its SHA1 is unknown.
+
+    ``repo_file`` is the repository file linked by the blob rows, it is
+    known while planning if the content is already in the repository,
+    otherwise once downloaded. ``repo_files`` holds repository files of
+    fileids whose content didn't match the blob checksum.
+    """
+
+    __slots__ = ("key", "rows", "repo_file", "repo_files")
+
+    def __init__(self, key: Hashable):
+        self.key = key
+        self.rows: List[PlannedFile] = []
+        self.repo_file: Optional[Path] = None
+        self.repo_files: Dict[int, Path] = {}
+
+    @property
+    def size(self) -> int:
+        return self.rows[0].nc_file.size
+
+    @property
+    def checksum(self) -> Optional[str]:
+        """expected SHA1 checksum, None if unknown"""
+        return self.key[1] if self.key[0] == "sha1" else None
+
+    def fileid_rows(self) -> Iterator[PlannedFile]:
+        """first row of each fileid, copies of the content to download"""
+        fileids = set()
+        for row in self.rows:
+            if row.nc_file.fileid not in fileids:
+                fileids.add(row.nc_file.fileid)
+                yield row
+
+    def row_repo_file(self, row: PlannedFile) -> Optional[Path]:
+        return self.repo_files.get(row.nc_file.fileid, self.repo_file)
+
+
+class DownloadPlan:
+    """Files of all mappings of a storage grouped by content: unique blobs
+    to download first then link operations, one per row.
+
+    Blobs are grouped per ``backup_root_path`` as each one has its own
+    repository.
+    """
+
+    def __init__(self, storage_id: int):
+        self.storage_id = storage_id
+        self.blobs: Dict[Hashable, Blob] = {}
+        self.empty_files: List[PlannedFile] = []
+        self.rows = 0
+        self.total_bytes = 0
+
+    def add(
+        self,
+        dir_config: NextcloudDirectoryConfig,
+        nc_file: NextcloudFile,
+        cached_file: Optional[CachedFile] = None,
+    ):
+        row = PlannedFile(dir_config, nc_file, cached_file)
+        self.rows += 1
+        if not nc_file.size:
+            self.empty_files.append(row)
+            return
+        self.total_bytes += nc_file.size
+        key = self.blob_key(dir_config, nc_file)
+        blob = self.blobs.get(key)
+        if blob is None:
+            blob = self.blobs[key] = Blob(key)
+        blob.rows.append(row)
+
+    @staticmethod
+    def blob_key(dir_config: NextcloudDirectoryConfig, nc_file: NextcloudFile):
+        if nc_file.checksum and nc_file.checksum.lower().startswith("sha1:"):
+            return "sha1", nc_file.checksum.lower(), dir_config.backup_root_path
+        return "fileid", nc_file.fileid, dir_config.backup_root_path
+
+    def missing_blobs(self) -> List[Blob]:
+        """blobs not in the repository yet"""
+        return [blob for blob in self.blobs.values() if blob.repo_file is None]
+
+    @property
+    def unique_bytes(self) -> int:
+        """size of distinct contents, files sharing a content count once"""
+        return sum(blob.size for blob in self.blobs.values())
+
+    @property
+    def bytes_to_download(self) -> int:
+        """at most, content of fileids without SHA1 may already be in the
+        repository (known by its etag)
+        """
+        return sum(blob.size for blob in self.missing_blobs())
+
+    @property
+    def links(self) -> int:
+        return self.rows - len(self.empty_files)
@@ -0,0 +1,325 @@
+import cProfile
+import logging
+import pstats
+import sys
+import threading
+import tracemalloc
+from pathlib import Path
+from time import perf_counter
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# main thread time not spent in any phase
+OTHER_PHASE = "other"
+# main thread waiting for workers (or coroutines) to backup files
+WAIT_PHASE = "wait"
+TRACEMALLOC_TOP = 10
+_END = object()
+
+
+class _NullPhase:
+    """Phase returned while profiling is disabled, does nothing"""
+
+    __slots__ = ("nbytes",)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_PHASE = _NullPhase()
+
+
+class _Phase:
+    __slots__ = ("profiler", "name", "nbytes")
+
+    def __init__(self, profiler: "PhaseProfiler", name: str, nbytes: int):
+        self.profiler = profiler
+        self.name = name
+        # can be set once known, before leaving the phase
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self.profiler._enter(self.name)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler._exit(self.nbytes)
+        return False
+
+
+class _ThreadState:
+    __slots__ = ("generation", "stack", "stats")
+
+    def __init__(self, generation: int):
+        self.generation = generation
+        # [phase, start, elapsed before the last nested phase]
+        self.stack: List[list] = []
+        # phase => [calls, seconds, bytes]
+        self.stats: Dict[str, list] = {}
+
+
+class PhaseProfiler:
+    """Attribute wall time and bytes of a run to phases (``db``,
+    ``s3_head``, ``s3_get``, ``hash``, ``link``, ``mkdir``...).
+
+    Phases nest, a phase time excludes the time of the phases it contains,
+    so on each thread phases time add up to the time spent in phases.
+    Counters are kept per thread: entering and leaving a phase costs two
+    ``perf_counter`` calls and no lock. Time awaited by coroutines (which
+    overlaps other phases of the event loop thread) is added apart with
+    ``add``.
+
+    The critical path is the breakdown of the main thread (the one which
+    started the profiler) time: the ``wait`` phase is the time it waited
+    for workers, it is detailed by the phases of the other threads.
+
+    cProfile statistics of every thread started while profiling and a
+    tracemalloc snapshot can also be written to files.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._generation = 0
+        self._main_thread: Optional[int] = None
+        self._threads: List[Tuple[int, _ThreadState]] = []
+        self._overlapped: Dict[str, list] = {}
+        self._started = 0.0
+        self._wall_time = 0.0
+        self._cprofile_file: Optional[Path] = None
+        self._cprofiles: List[cProfile.Profile] = []
+        self._tracemalloc_file: Optional[Path] = None
+
+    def start(
+        self,
+        cprofile_file: Optional[Path] = None,
+        tracemalloc_file: Optional[Path] = None,
+        tracemalloc_frames: int = 1,
+    ):
+        with self._lock:
+            self._generation += 1
+            self._threads = []
+            self._overlapped = {}
+            self._cprofiles = []
+        self._main_thread = threading.get_ident()
+        self._cprofile_file = cprofile_file
+        self._tracemalloc_file = tracemalloc_file
+        if tracemalloc_file:
+            tracemalloc.start(tracemalloc_frames)
+        if cprofile_file:
+            threading.setprofile(self._profile_thread)
+            self._profile_thread()
+        self._started = perf_counter()
+        self._wall_time = 0.0
+        self.enabled = True
+
+    def _profile_thread(self, *args):
+        """Enable a cProfile profiler in the calling thread, installed with
+        ``threading.setprofile`` it runs first in every new thread
+        """
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # python >= 3.12: one profiler records all threads, don't call
+            # this hook for each event of this thread anymore
+            sys.setprofile(None)
+            return
+        with self._lock:
+            self._cprofiles.append(profile)
+
+    def stop(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        self._wall_time = perf_counter() - self._started
+        if self._cprofile_file and self._cprofiles:
+            threading.setprofile(None)
+            self._cprofiles[0].disable()
+            stats = pstats.Stats(self._cprofiles[0])
+            for profile in self._cprofiles[1:]:
+                stats.add(profile)
+            stats.dump_stats(str(self._cprofile_file))
+            logger.info(
+                "cProfile statistics of %d thread(s) written to %s",
+                len(self._cprofiles),
+                self._cprofile_file,
+            )
+        if self._tracemalloc_file:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            snapshot.dump(str(self._tracemalloc_file))
+            logger.info("tracemalloc snapshot written to %s", self._tracemalloc_file)
+            for stat in snapshot.statistics("lineno")[:TRACEMALLOC_TOP]:
+                logger.info("Allocated: %s", stat)
+
+    def phase(self, name: str, nbytes: int = 0):
+        """Context manager attributing the time spent in it to ``name``"""
+        if not self.enabled:
+            return NULL_PHASE
+        return _Phase(self, name, nbytes)
+
+    def iterate(self, name: str, iterable: Iterable) -> Iterable:
+        """Attribute the time spent producing ``iterable`` items (ie: rows
+        read from a database cursor) to ``name``
+        """
+        if not self.enabled:
+            return iterable
+        return self._iterate(name, iter(iterable))
+
+    def _iterate(self, name: str, iterator: Iterator) -> Iterator:
+        while True:
+            with self.phase(name):
+                item = next(iterator, _END)
+            if item is _END:
+                return
+            yield item
+
+    def add(self, name: str, seconds: float, nbytes: int = 0):
+        """Add time overlapping other phases, ie: awaited by a coroutine"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._add(self._overlapped, name, seconds, nbytes)
+
+    @staticmethod
+    def _add(stats: Dict[str, list], name: str, seconds: float, nbytes: int):
+        counters = stats.get(name)
+        if counters is None:
+            counters = stats[name] = [0, 0.0, 0]
+        counters[0] += 1
+        counters[1] += seconds
+        counters[2] += nbytes
+
+    def _state(self) -> _ThreadState:
+        state = getattr(self._local, "state", None)
+        if state is None or state.generation != self._generation:
+            state = self._local.state = _ThreadState(self._generation)
+            with self._lock:
+                self._threads.append((threading.get_ident(), state))
+        return state
+
+    def _enter(self, name: str):
+        now = perf_counter()
+        stack = self._state().stack
+        if stack:
+            parent = stack[-1]
+            parent[2] += now - parent[1]
+        stack.append([name, now, 0.0])
+
+    def _exit(self, nbytes: int):
+        now = perf_counter()
+        state = self._state()
+        if not state.stack:
+            # entered before the profiler was started again
+            return
+        name, started, elapsed = state.stack.pop()
+        self._add(state.stats, name, elapsed + now - started, nbytes)
+        if state.stack:
+            state.stack[-1][1] = now
+
+    def summary(self) -> Dict[str, Any]:
+        """Phases of all threads but ``wait`` ranked by time, the critical
+        path (main thread time per phase) and the phases of other threads
+        ranked by time
+        """
+        phases: Dict[str, list] = {}
+        main: Dict[str, list] = {}
+        workers: Dict[str, list] = {}
+        with self._lock:
+            threads = list(self._threads)
+            overlapped = {name: list(c) for name, c in self._overlapped.items()}
+        for thread, state in threads:
+            for name, (calls, seconds, nbytes) in list(state.stats.items()):
+                if name != WAIT_PHASE:
+                    # waiting overlaps the phases waited for
+                    self._merge(phases, name, calls, seconds, nbytes)
+                self._merge(
+                    main if thread == self._main_thread else workers,
+                    name,
+                    calls,
+                    seconds,
+                    nbytes,
+                )
+        for name, (calls, seconds, nbytes) in overlapped.items():
+            self._merge(phases, name, calls, seconds, nbytes)
+            self._merge(workers, name, calls, seconds, nbytes)
+        wall_time = self._wall_time or perf_counter() - self._started
+        critical_path = {name: counters[1] for name, counters in main.items()}
+        critical_path[OTHER_PHASE] = max(0.0, wall_time - sum(critical_path.values()))
+        return dict(
+            wall_time=wall_time,
+            phases=self._ranked(phases),
+            critical_path=sorted(
+                critical_path.items(), key=lambda item: item[1], reverse=True
+            ),
+            workers=self._ranked(workers),
+        )
+
+    @staticmethod
+    def _merge(
+        stats: Dict[str, list], name: str, calls: int, seconds: float, nbytes: int
+    ):
+        counters = stats.setdefault(name, [0, 0.0, 0])
+        counters[0] += calls
+        counters[1] += seconds
+        counters[2] += nbytes
+
+    @staticmethod
+    def _ranked(stats: Dict[str, list]) -> List[Dict[str, Any]]:
+        return [
+            dict(name=name, calls=calls, seconds=seconds, bytes=nbytes)
+            for name, (calls, seconds, nbytes) in sorted(
+                stats.items(), key=lambda item: item[1][1], reverse=True
+            )
+        ]
+
+    def report(self) -> List[str]:
+        """Summary as log lines"""
+        summary = self.summary()
+        wall_time = summary["wall_time"]
+        total = sum(phase["seconds"] for phase in summary["phases"])
+        lines = [
+            "Profile - Wall time: %.1fs - Phases time (all threads): %.1fs"
+            % (wall_time, total)
+        ]
+        for phase in summary["phases"]:
+            line = "Phase %s - Calls: %d - Time: %.1fs (%.1f%%)" % (
+                phase["name"],
+                phase["calls"],
+                phase["seconds"],
+                _percent(phase["seconds"], total),
+            )
+            if phase["bytes"]:
+                line += " - %.3f GB - %.1f MB/s" % (
+                    phase["bytes"] / 1024**3,
+                    phase["bytes"] / 1024**2 / phase["seconds"]
+                    if phase["seconds"]
+                    else 0.0,
+                )
+            lines.append(line)
+        workers_time = sum(phase["seconds"] for phase in summary["workers"])
+        steps = []
+        for name, seconds in summary["critical_path"]:
+            step = "%s %.1f%%" % (name, _percent(seconds, wall_time))
+            if name == WAIT_PHASE and workers_time:
+                step += " (workers: %s)" % " - ".join(
+                    "%s %.1f%%"
+                    % (phase["name"], _percent(phase["seconds"], workers_time))
+                    for phase in summary["workers"][:3]
+                )
+            steps.append(step)
+        lines.append("Critical path (main thread): " + " - ".join(steps))
+        return lines
+
+
+def _percent(value: float, total: float) -> float:
+    return 100 * value / total if total else 0.0
+
+
+profiler = PhaseProfiler()
@@ -0,0 +1,88 @@
+from collections import namedtuple
+from pathlib import PurePath
+from typing import Optional
+
+from botocore.client import Config as BotoConfig
+from botocore.exceptions import ClientError
+
+from nc_s3_backup.api.listing import bucket_and_key
+
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+RETRY_MODES = ("legacy", "standard", "adaptive")
+
+
+class ConnectionStats(namedtuple("ConnectionStats", ["requests", "opened"])):
+    __slots__ = ()
+
+    @property
+    def reused(self) -> int:
+        """Requests sent over an already opened (keep-alive) connection"""
+        return self.requests - self.opened
+
+
+def boto_config(
+    max_pool_connections: int = DEFAULT_MAX_POOL_CONNECTIONS,
+    retry_mode: str = "adaptive",
+    max_attempts: int = 5,
+    connect_timeout: float = 60,
+    read_timeout: float = 60,
+    tcp_keepalive: bool = False,
+) -> BotoConfig:
+    """botocore client configuration used by every S3 request.
+
+    ``max_pool_connections`` is the size of the urllib3 pool of each
+    endpoint, it should be greater than the number of threads sending
+    requests concurrently otherwise extra connections are closed once used
+    instead of being kept alive. ``adaptive`` retry mode also rate limits
+    client side when S3 throttles.
+    """
+    return BotoConfig(
+        signature_version="s3v4",
+        max_pool_connections=max_pool_connections,
+        retries={"mode": retry_mode, "max_attempts": max_attempts},
+        connect_timeout=connect_timeout,
+        read_timeout=read_timeout,
+        tcp_keepalive=tcp_keepalive,
+    )
+
+
+def connection_stats(client) -> ConnectionStats:
+    """Number of requests sent and connections opened by the urllib3 pools
+    of a boto3 client.
+
+    Pools are not part of the botocore public API, empty stats are returned
+    if they can't be reached.
+    """
+    http_session = getattr(getattr(client, "_endpoint", None), "http_session", None)
+    managers = [getattr(http_session, "_manager", None)]
+    managers.extend(getattr(http_session, "_proxy_managers", {}).values())
+    requests = opened = 0
+    for manager in managers:
+        pools = getattr(manager, "pools", None)
+        if pools is None:
+            continue
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            requests += pool.num_requests
+            opened += pool.num_connections
+    return ConnectionStats(requests, opened)
+
+
+def object_not_found(error: ClientError) -> bool:
+    """Whether a ``HeadObject`` or ``GetObject`` request failed because
+    the object doesn't exist
+    """
+    return error.response.get("Error", {}).get("Code") in ("404", "NoSuchKey")
+
+
+def head_object(client, s3_path: PurePath) -> Optional[dict]:
+    """``HeadObject`` response of ``s3_path``, None if it doesn't exist"""
+    bucket, key = bucket_and_key(s3_path)
+    try:
+        return client.head_object(Bucket=bucket, Key=key)
+    except ClientError as error:
+        if object_not_found(error):
+            return None
+        raise
@@ -0,0 +1,53 @@
+import os
+from pathlib import Path
+from typing import Iterator, List, Tuple
+
+
+def walk_files(directory: Path) -> Iterator[os.DirEntry]:
+    """Lazily yield ``os.DirEntry`` of every non directory entry under
+    ``directory``.
+
+    Tree is walked using ``os.scandir`` with an explicit stack instead of
+    python recursion, so deep trees are supported and only one directory
+    is opened at a time. ``DirEntry.inode()`` doesn't require any extra
+    syscall on POSIX and ``DirEntry.stat()`` result is cached, prefer them
+    over ``Path.stat()``. A missing ``directory`` is considered empty.
+    """
+    stack = [os.fspath(directory)]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    yield entry
+
+
+def split_tree(directory: Path, depth: int) -> Tuple[List[Path], List[os.DirEntry]]:
+    """Split ``directory`` tree in sub trees that can be walked separately.
+
+    return directories found at ``depth`` level under ``directory`` and
+    entries of files found above that level (that won't be walked
+    otherwise). A missing ``directory`` is considered empty.
+    """
+    directories = [Path(directory)]
+    files = []
+    for _ in range(depth):
+        sub_directories = []
+        for parent in directories:
+            try:
+                entries = os.scandir(parent)
+            except FileNotFoundError:
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        sub_directories.append(Path(entry.path))
+                    else:
+                        files.append(entry)
+        directories = sub_directories
+    return directories, files
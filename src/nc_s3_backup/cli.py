@@ -7,19 +7,27 @@ from pathlib import Path
 
 import boto3
 from boto3.s3.transfer import TransferConfig
-from botocore.client import Config as BotoConfig
 from pydantic.json import pydantic_encoder
 from s3path import PureS3Path, register_configuration_parameter
 from uri_pathlib_factory import load_pathlib_monkey_patch
 from yaml import safe_dump, safe_load
 
+from nc_s3_backup.api.aio import (
+    DEFAULT_CONCURRENCY,
+    DEFAULT_WRITE_WORKERS,
+    AsyncNextcloudS3Backup,
+)
 from nc_s3_backup.api.backup import (
+    GB,
+    MB,
     REPOSITORY_DIRNAME,
     SNAPSHOT_DIRNAME,
     NextcloudS3Backup,
+    SizeLane,
 )
 from nc_s3_backup.api.config import NextcloudDirectoryConfig, NextCloudS3BackupConfig
-from nc_s3_backup.api.db import DaoNextcloudFiles
+from nc_s3_backup.api.db import DEFAULT_ITERSIZE, DaoNextcloudFiles
+from nc_s3_backup.api.s3 import DEFAULT_MAX_POOL_CONNECTIONS, RETRY_MODES, boto_config
 
 logger = logging.getLogger(__name__)
 
@@ -42,6 +50,55 @@ def logging_params(parser):
     )
 
 
+def metrics_params(parser):
+    group = parser.add_argument_group("Metrics")
+    group.add_argument(
+        "--metrics-file",
+        dest="metrics_file",
+        type=Path,
+        help=(
+            "Write operations durations (count, sum, min, max, p50, p95, p99) "
+            "in this file once done: as JSON if it ends with .json, as a "
+            "prometheus text file (ie: for the node_exporter textfile "
+            "collector) otherwise."
+        ),
+    )
+
+
+def profile_params(parser):
+    group = parser.add_argument_group("Profiling")
+    group.add_argument(
+        "--profile",
+        dest="profile",
+        action="store_true",
+        help=(
+            "Attribute time and bytes to phases (db, s3_list, s3_head, s3_get, "
+            "read, hash, write, link, mkdir, copy, wait) across all threads "
+            "and log them ranked once done, with the critical path: the main "
+            "thread time per phase, waiting for workers detailed by their "
+            "phases. Overhead is low enough to be left on."
+        ),
+    )
+    group.add_argument(
+        "--profile-cprofile",
+        dest="profile_cprofile_file",
+        type=Path,
+        help=(
+            "Write cProfile statistics of all threads to this file (pstats "
+            "format), implies --profile. Expect a large overhead."
+        ),
+    )
+    group.add_argument(
+        "--profile-tracemalloc",
+        dest="profile_tracemalloc_file",
+        type=Path,
+        help=(
+            "Trace memory allocations and write a tracemalloc snapshot to "
+            "this file once done, implies --profile. Expect a large overhead."
+        ),
+    )
+
+
 def pg_params(parser):
     gp = parser.add_argument_group("Postgresql connection")
     gp.add_argument(
@@ -50,6 +107,27 @@ def pg_params(parser):
         default="postgresql:///nc-backup?application_name=%s" % parser.prog,
     )
     gp.add_argument("--pg-schema", help="Postgresql default schema", default="public")
+    gp.add_argument(
+        "--pg-itersize",
+        help=(
+            "Number of oc_filecache rows fetched at a time by the server side "
+            "cursor, backup start as soon the first batch is received."
+        ),
+        type=int,
+        default=DEFAULT_ITERSIZE,
+    )
+
+
+def fileid_range(value: str):
+    try:
+        first, last = (int(fileid) for fileid in value.split("-"))
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(
+            f"Expected FIRST-LAST fileids: {value}"
+        ) from error
+    if first > last:
+        raise argparse.ArgumentTypeError(f"Empty fileid range: {value}")
+    return first, last
 
 
 def s3_params(parser):
@@ -76,6 +154,77 @@ def s3_params(parser):
         "--s3-secret-key", dest="s3_secret_access_key", type=str, help="S3 secret key."
     )
 
+    group.add_argument(
+        "--s3-max-pool-connections",
+        dest="s3_max_pool_connections",
+        type=int,
+        help=(
+            "Maximum number of connections kept alive per S3 endpoint, shared "
+            "by all workers. Default to the number of S3 requests that can be "
+            f"sent concurrently (at least {DEFAULT_MAX_POOL_CONNECTIONS})."
+        ),
+    )
+    group.add_argument(
+        "--s3-retry-mode",
+        dest="s3_retry_mode",
+        default="adaptive",
+        choices=RETRY_MODES,
+        help=(
+            "botocore retry mode, adaptive mode also slow down requests "
+            "client side while S3 is throttling."
+        ),
+    )
+    group.add_argument(
+        "--s3-max-attempts",
+        dest="s3_max_attempts",
+        default=5,
+        type=int,
+        help="Maximum attempts of a S3 request, including the initial one.",
+    )
+    group.add_argument(
+        "--s3-connect-timeout",
+        dest="s3_connect_timeout",
+        default=60,
+        type=float,
+        help="Time to wait for a connection to be established. (seconds)",
+    )
+    group.add_argument(
+        "--s3-read-timeout",
+        dest="s3_read_timeout",
+        default=60,
+        type=float,
+        help="Time to wait for data on an established connection. (seconds)",
+    )
+    group.add_argument(
+        "--s3-tcp-keepalive",
+        dest="s3_tcp_keepalive",
+        action="store_true",
+        help="Enable TCP keep-alive on S3 connections.",
+    )
+    group.add_argument(
+        "--s3-list",
+        dest="s3_listing",
+        action="store_true",
+        help=(
+            "List buckets once using paginated ListObjectsV2 requests (1000 "
+            "objects per request) to know objects size and etag instead of "
+            "requesting each object metadata. Listings are kept in memory "
+            "for the whole run, about 260 bytes per object (2.6 GB for 10 "
+            "millions objects): use --s3-list-fileid-range to list part "
+            "of large buckets."
+        ),
+    )
+    group.add_argument(
+        "--s3-list-fileid-range",
+        dest="s3_listing_fileid_range",
+        type=fileid_range,
+        help=(
+            "Only list objects of fileids in this range, ie: 1000-2000. "
+            "Objects of files out of this range (or missing from the listing) "
+            "are requested one by one while --s3-list is used."
+        ),
+    )
+
     group_s3_transfer = parser.add_argument_group("S3 Transfer configuration")
 
     group_s3_transfer.add_argument(
@@ -168,6 +317,16 @@ def s3_params(parser):
             "downloaded stream as well. (MB)"
         ),
     )
+    group_s3_transfer.add_argument(
+        "--s3-stream-download",
+        dest="s3_stream_download",
+        action="store_true",
+        help=(
+            "Stream S3 objects body and compute SHA1 while writing downloaded "
+            "files instead of reading them back once downloaded. Objects are "
+            "fetched using a single GET request, multipart settings are ignored."
+        ),
+    )
     group_s3_transfer.add_argument(
         "--s3-progress",
         dest="s3_progress",
@@ -179,6 +338,158 @@ def s3_params(parser):
     )
 
 
+def backup_params(parser):
+    group = parser.add_argument_group("Backup configuration")
+    group.add_argument(
+        "-w",
+        "--workers",
+        dest="workers",
+        default=1,
+        type=int,
+        help=(
+            "Number of files backup-ed concurrently. Downloads, hash "
+            "computation and hard links of different files are overlapped, "
+            "files sharing the same content are still downloaded once."
+        ),
+    )
+    group.add_argument(
+        "--large-file-threshold",
+        dest="large_file_threshold_mb",
+        type=int,
+        help=(
+            "Split files in two lanes with their own workers: files up to this "
+            "size are downloaded by --workers using a single GET request, "
+            "larger files are downloaded by --large-file-workers using "
+            "multipart ranged GET requests (S3 Transfer configuration). "
+            "Large files never hold small files workers. (MB)"
+        ),
+    )
+    group.add_argument(
+        "--large-file-workers",
+        dest="large_file_workers",
+        default=2,
+        type=int,
+        help="Number of large files backup-ed concurrently.",
+    )
+    group.add_argument(
+        "--large-file-max-queued",
+        dest="large_file_max_queued",
+        default=1000,
+        type=int,
+        help=(
+            "Maximum number of large files waiting for a worker, small files "
+            "are no longer dispatched while this queue is full."
+        ),
+    )
+    group.add_argument(
+        "--transfer-engine",
+        dest="transfer_engine",
+        default="threads",
+        choices=("threads", "asyncio"),
+        help=(
+            "threads: files are backup-ed by --workers threads. asyncio: files "
+            "are backup-ed from one event loop keeping up to "
+            "--async-concurrency S3 requests in flight (using aiobotocore if "
+            "installed), better suited to many small files."
+        ),
+    )
+    group.add_argument(
+        "--async-concurrency",
+        dest="async_concurrency",
+        default=DEFAULT_CONCURRENCY,
+        type=int,
+        help="Maximum S3 requests in flight using asyncio transfer engine.",
+    )
+    group.add_argument(
+        "--async-write-workers",
+        dest="async_write_workers",
+        default=DEFAULT_WRITE_WORKERS,
+        type=int,
+        help=(
+            "Threads writing downloaded chunks to disk using asyncio transfer "
+            "engine, downloads wait for their chunks to be written."
+        ),
+    )
+    group.add_argument(
+        "--delta",
+        dest="delta",
+        action="store_true",
+        help=(
+            "Only backup files added or changed since the previous snapshot, "
+            "unchanged files are hard linked without any S3 request. "
+            "Files backup-ed are saved in a manifest in the snapshot "
+            "directory to be used by the next run."
+        ),
+    )
+    group.add_argument(
+        "--download-plan",
+        dest="download_plan",
+        action="store_true",
+        help=(
+            "Query files of all mappings of a storage at once and group them "
+            "by content before backup-ing them: log how many contents and "
+            "bytes have to be downloaded, download each unique content once "
+            "then link every snapshot file. Can't be used with --delta."
+        ),
+    )
+    group.add_argument(
+        "--resume",
+        dest="resume",
+        action="store_true",
+        help=(
+            "Continue the latest snapshot left incomplete by an interrupted "
+            "run instead of starting a new one: files it already linked (as "
+            "recorded in the snapshot journal) are skipped, complete "
+            "downloads it left in the repository are reused and partial "
+            "ones removed."
+        ),
+    )
+    group.add_argument(
+        "--metadata-cache",
+        action="store_true",
+        help=(
+            "Link files whose oc_filecache etag, mtime and size didn't change "
+            "since the previous run to the repository file resolved at that "
+            "time without looking them up on S3. Nextcloud metadata are "
+            "trusted: a S3 object changed without updating oc_filecache is "
+            "not backup-ed again."
+        ),
+    )
+    group.add_argument(
+        "--max-hard-links",
+        dest="max_links",
+        type=int,
+        help=(
+            "Hard links per repository file before linking snapshot files to "
+            "a replica (a local copy with its own inode, ie: <sha1>.1) of it. "
+            "Default to the file system hard link limit."
+        ),
+    )
+    group.add_argument(
+        "--hash-buffer-size",
+        dest="hash_buffer_size_kb",
+        default=1024,
+        type=int,
+        help="Size of the buffer used to compute downloaded files SHA1. (KB)",
+    )
+
+
+def purge_params(parser):
+    group = parser.add_argument_group("Purge configuration")
+    group.add_argument(
+        "-w",
+        "--workers",
+        dest="workers",
+        default=1,
+        type=int,
+        help=(
+            "Number of threads used to scan snapshots directories (one per "
+            "snapshot user directory) and purge repository directories (one "
+            "per hash two first chars directory)."
+        ),
+    )
+
+
 def parse_setup_s3(arguments):
     default_aws_s3_path = PureS3Path("/")
     params = {}
@@ -191,23 +502,25 @@ def parse_setup_s3(arguments):
     if arguments.s3_secret_access_key:
         params["aws_secret_access_key"] = arguments.s3_secret_access_key
 
-    params["config"] = BotoConfig(signature_version="s3v4")
-
-    KB = 1024
-    MB = KB**2
-    GB = KB**3
-
-    transfert_config_params = dict(
-        use_threads=not arguments.s3_no_threads,
-        multipart_threshold=arguments.s3_multipart_threshold_mb * MB,
-        multipart_chunksize=arguments.s3_multipart_chunksize_mb * MB,
-        max_bandwidth=arguments.s3_max_bandwidth_mb * MB
-        if arguments.s3_max_bandwidth_mb
-        else None,
-        max_concurrency=arguments.s3_max_concurrency,
-        num_download_attempts=arguments.s3_num_download_attempts,
-        max_io_queue=arguments.s3_max_io_queue_mb * MB,
-        io_chunksize=arguments.s3_io_chunksize_mb * MB,
+    max_pool_connections = arguments.s3_max_pool_connections
+    if not max_pool_connections:
+        workers = arguments.workers
+        if arguments.large_file_threshold_mb is not None:
+            workers += arguments.large_file_workers
+        max_pool_connections = max(
+            DEFAULT_MAX_POOL_CONNECTIONS,
+            workers * (1 if arguments.s3_no_threads else arguments.s3_max_concurrency),
+            arguments.async_concurrency
+            if arguments.transfer_engine == "asyncio"
+            else 0,
+        )
+    params["config"] = boto_config(
+        max_pool_connections=max_pool_connections,
+        retry_mode=arguments.s3_retry_mode,
+        max_attempts=arguments.s3_max_attempts,
+        connect_timeout=arguments.s3_connect_timeout,
+        read_timeout=arguments.s3_read_timeout,
+        tcp_keepalive=arguments.s3_tcp_keepalive,
     )
 
     class ProgressPercentage:
@@ -238,16 +551,58 @@ def parse_setup_s3(arguments):
                 )
                 sys.stdout.flush()
 
+    resource = None
     if params:
+        # resource is created once from the main thread, it's not thread
+        # safe: workers use its client which is thread safe
+        resource = boto3.session.Session().resource("s3", **params)
         register_configuration_parameter(
             default_aws_s3_path,
-            resource=boto3.resource("s3", **params),
+            resource=resource,
             parameters={
                 "StorageClass": "GLACIER",
-                "transfert_config": TransferConfig(**transfert_config_params),
+                "transfert_config": transfer_config(arguments),
                 "callback_class": ProgressPercentage if arguments.s3_progress else None,
             },
         )
+    return resource, params
+
+
+def transfer_config(arguments) -> TransferConfig:
+    return TransferConfig(
+        use_threads=not arguments.s3_no_threads,
+        multipart_threshold=arguments.s3_multipart_threshold_mb * MB,
+        multipart_chunksize=arguments.s3_multipart_chunksize_mb * MB,
+        max_bandwidth=arguments.s3_max_bandwidth_mb * MB
+        if arguments.s3_max_bandwidth_mb
+        else None,
+        max_concurrency=arguments.s3_max_concurrency,
+        num_download_attempts=arguments.s3_num_download_attempts,
+        max_io_queue=arguments.s3_max_io_queue_mb * MB,
+        io_chunksize=arguments.s3_io_chunksize_mb * MB,
+    )
+
+
+def size_lanes(arguments):
+    """Small files lane (single GET, --workers) and large files lane
+    (multipart, --large-file-workers) if --large-file-threshold is set
+    """
+    if arguments.large_file_threshold_mb is None:
+        return []
+    return [
+        SizeLane(
+            arguments.large_file_threshold_mb * MB,
+            arguments.workers,
+            None,
+            arguments.workers * 2,
+        ),
+        SizeLane(
+            None,
+            arguments.large_file_workers,
+            transfer_config(arguments),
+            arguments.large_file_max_queued,
+        ),
+    ]
 
 
 def parse_config(config_file):
@@ -272,9 +627,14 @@ def main(testing: bool = False):
         ),
     )
     logging_params(parser)
+    metrics_params(parser)
+    profile_params(parser)
+    backup_params(parser)
     s3_params(parser)
     pg_params(parser)
     arguments = parser.parse_args()
+    if arguments.download_plan and arguments.delta:
+        parser.error("--download-plan can't be used with --delta")
 
     logging.basicConfig(
         level=getattr(logging, arguments.logging_level.upper()),
@@ -287,11 +647,47 @@ def main(testing: bool = False):
         except json.JSONDecodeError:
             logging.config.fileConfig(arguments.logging_file.name)
 
-    parse_setup_s3(arguments)
+    s3_resource, s3_client_params = parse_setup_s3(arguments)
     config = parse_config(arguments.config)
     arguments.config.close()
-    dao = DaoNextcloudFiles(arguments.pg_dsn, schema=arguments.pg_schema)
-    nextcloud_s3_backup = NextcloudS3Backup(dao, config)
+    dao = DaoNextcloudFiles(
+        arguments.pg_dsn, schema=arguments.pg_schema, itersize=arguments.pg_itersize
+    )
+    engine_params = {}
+    backup_class = NextcloudS3Backup
+    if arguments.transfer_engine == "asyncio":
+        backup_class = AsyncNextcloudS3Backup
+        engine_params = dict(
+            concurrency=arguments.async_concurrency,
+            write_workers=arguments.async_write_workers,
+            s3_client_params=s3_client_params,
+        )
+    nextcloud_s3_backup = backup_class(
+        dao,
+        config,
+        workers=arguments.workers,
+        hash_buffer_size=arguments.hash_buffer_size_kb * 1024,
+        stream_download=arguments.s3_stream_download,
+        delta=arguments.delta,
+        metadata_cache=arguments.metadata_cache,
+        download_plan=arguments.download_plan,
+        s3_listing=arguments.s3_listing,
+        s3_listing_fileid_range=arguments.s3_listing_fileid_range,
+        s3_client=s3_resource.meta.client if s3_resource else None,
+        transfer_config=transfer_config(arguments),
+        lanes=size_lanes(arguments),
+        max_links=arguments.max_links,
+        metrics_file=arguments.metrics_file,
+        resume=arguments.resume,
+        profile=bool(
+            arguments.profile
+            or arguments.profile_cprofile_file
+            or arguments.profile_tracemalloc_file
+        ),
+        profile_cprofile_file=arguments.profile_cprofile_file,
+        profile_tracemalloc_file=arguments.profile_tracemalloc_file,
+        **engine_params,
+    )
     nextcloud_s3_backup.backup()
     if testing:
         return nextcloud_s3_backup
@@ -318,6 +714,8 @@ def purge(testing: bool = False):
         ),
     )
     logging_params(parser)
+    metrics_params(parser)
+    purge_params(parser)
     arguments = parser.parse_args()
 
     logging.basicConfig(
@@ -333,12 +731,57 @@ def purge(testing: bool = False):
 
     config = parse_config(arguments.config)
     arguments.config.close()
-    nextcloud_s3_backup = NextcloudS3Backup(None, config)
+    nextcloud_s3_backup = NextcloudS3Backup(
+        None, config, workers=arguments.workers, metrics_file=arguments.metrics_file
+    )
     nextcloud_s3_backup.purge()
     if testing:
         return nextcloud_s3_backup
 
 
+def reindex(testing: bool = False):
+    parser = argparse.ArgumentParser(
+        description=(
+            "Nextcloud S3 backup reindex\n\n"
+            "Rebuild repository index of each uniques backup_root_path present "
+            "in your config file from files present in "
+            f"the {REPOSITORY_DIRNAME} directory"
+        ),
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "config",
+        type=argparse.FileType("r"),
+        help=(
+            "Nextcloud S3 backup config file is a json/yaml file that "
+            "contains mapping of directories to backup."
+        ),
+    )
+    logging_params(parser)
+    metrics_params(parser)
+    arguments = parser.parse_args()
+
+    logging.basicConfig(
+        level=getattr(logging, arguments.logging_level.upper()),
+        format=arguments.logging_format,
+    )
+    if arguments.logging_file:
+        try:
+            json_config = json.loads(arguments.logging_file.read())
+            logging.config.dictConfig(json_config)
+        except json.JSONDecodeError:
+            logging.config.fileConfig(arguments.logging_file.name)
+
+    config = parse_config(arguments.config)
+    arguments.config.close()
+    nextcloud_s3_backup = NextcloudS3Backup(
+        None, config, metrics_file=arguments.metrics_file
+    )
+    nextcloud_s3_backup.reindex()
+    if testing:
+        return nextcloud_s3_backup
+
+
 def config_helper():
     parser = argparse.ArgumentParser(
         description="Helper to validate/convert NextCloudS3Config"
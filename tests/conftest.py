@@ -0,0 +1,125 @@
+import os
+import shutil
+import threading
+from os import stat_result
+from pathlib import Path
+from unittest import mock
+
+import pytest
+from botocore.exceptions import ClientError
+
+from nc_s3_backup.api.backup import NextcloudS3Backup
+from nc_s3_backup.api.config import NextcloudDirectoryConfig
+from nc_s3_backup.api.db import NextcloudFile
+
+
+@pytest.fixture()
+def bucket(tmpdir) -> Path:
+    """local directory standing for the S3 bucket"""
+    bucket = Path(str(tmpdir)) / "bucket-test"
+    bucket.mkdir()
+    return bucket
+
+
+@pytest.fixture()
+def dir_config(tmpdir, bucket) -> NextcloudDirectoryConfig:
+    return NextcloudDirectoryConfig(
+        storage_id=2,
+        user_name="pverkest",
+        bucket=bucket,
+        nextcloud_path="files/",
+        backup_root_path=Path(str(tmpdir)) / "backup",
+    )
+
+
+@pytest.fixture()
+def nc_subtree():
+    """Rows of ``oc_filecache``, filled by the test, returned by
+    ``get_nc_subtree`` and ``get_nc_subtrees`` as new objects on each query
+    """
+    nc_files = []
+
+    def get_nc_subtree(storage_id, path, excluded_mimetype, **filters):
+        return [
+            NextcloudFile(
+                f.fileid, f.storage, f.path, f.checksum, f.size, f.mtime, f.etag
+            )
+            for f in nc_files
+            if f.storage == storage_id and f.path.startswith(path)
+        ]
+
+    def get_nc_subtrees(subtrees, excluded_mimetype, **filters):
+        for index, (storage_id, path) in enumerate(subtrees):
+            for nc_file in get_nc_subtree(storage_id, path, excluded_mimetype):
+                yield index, nc_file
+
+    with mock.patch(
+        "nc_s3_backup.api.db.DaoNextcloudFiles.get_nc_subtree",
+        side_effect=get_nc_subtree,
+    ), mock.patch(
+        "nc_s3_backup.api.db.DaoNextcloudFiles.get_nc_subtrees",
+        side_effect=get_nc_subtrees,
+    ):
+        yield nc_files
+
+
+@pytest.fixture()
+def download_mock():
+    """S3 objects are downloaded from the local bucket directory"""
+    with mock.patch.object(
+        NextcloudS3Backup,
+        "_download_s3_file",
+        autospec=True,
+        side_effect=lambda self, src, dest: shutil.copy(src, dest),
+    ) as download_mock:
+        yield download_mock
+
+
+@pytest.fixture()
+def patch_stat_etag(request):
+    """local files stand for S3 objects, their etag is their inode"""
+
+    @property
+    def etag(self):
+        return f"{self.st_ino:032x}"
+
+    stat_result.etag = etag
+
+    def unpatch_stat_result():
+        stat_result.etag = None
+
+    request.addfinalizer(unpatch_stat_result)
+
+
+class LocalS3Client:
+    """boto3 client stand-in serving files of the local bucket directory,
+    ``Bucket`` and ``Key`` are the parts of their absolute path, etags are
+    inodes as with ``patch_stat_etag``
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.threads = set()
+
+    def _path(self, operation: str, bucket: str, key: str) -> str:
+        self.calls.append((operation, key.rsplit("/", 1)[-1]))
+        self.threads.add(threading.current_thread().name)
+        path = os.path.join("/", bucket, key)
+        if not os.path.exists(path):
+            raise ClientError({"Error": {"Code": "404"}}, operation)
+        return path
+
+    def head_object(self, Bucket, Key):
+        path = self._path("HeadObject", Bucket, Key)
+        return {"ETag": f'"{os.stat(path).st_ino:032x}"'}
+
+    def get_object(self, Bucket, Key):
+        return {"Body": open(self._path("GetObject", Bucket, Key), "rb")}
+
+    def download_file(self, Bucket, Key, Filename, Config=None):
+        shutil.copy(self._path("DownloadFile", Bucket, Key), Filename)
+
+
+@pytest.fixture()
+def local_s3_client() -> LocalS3Client:
+    return LocalS3Client()
@@ -0,0 +1,544 @@
+import asyncio
+import dataclasses
+import hashlib
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest import mock
+
+import pytest
+from botocore.exceptions import ClientError
+from freezegun import freeze_time
+
+from nc_s3_backup.api.aio import AsyncNextcloudS3Backup, AsyncSingleFlight, aio_config
+from nc_s3_backup.api.backup import REPOSITORY_DIRNAME, NextcloudS3Backup, SizeLane
+from nc_s3_backup.api.config import NextCloudS3BackupConfig
+from nc_s3_backup.api.db import DaoNextcloudFiles, NextcloudFile
+from nc_s3_backup.api.index import RepositoryIndex
+from nc_s3_backup.api.profiling import profiler
+from nc_s3_backup.api.s3 import boto_config
+
+
+def make_nc_files(bucket: Path):
+    nc_files = []
+    for fileid in range(1, 31):
+        content = f"content {fileid % 7}".encode()
+        (bucket / f"urn:oid:{fileid}").write_bytes(content)
+        checksum = f"SHA1:{hashlib.sha1(content).hexdigest()}"  # nosec
+        if fileid % 5 == 0:
+            checksum = ""
+        elif fileid % 11 == 0:
+            checksum = "SHA1:mismatch"
+        nc_files.append(
+            NextcloudFile(fileid, 2, f"files/d{fileid % 3}/f{fileid}", checksum, 9)
+        )
+    nc_files.append(NextcloudFile(40, 2, "files/empty", "", 0))
+    nc_files.append(NextcloudFile(41, 2, "files/missing-on-s3", "SHA1:abcd", 3))
+    return nc_files
+
+
+def run_backup(backup_class, dir_config, root, download_mock, **params):
+    nc_backup = backup_class(
+        DaoNextcloudFiles("postgres://test"),
+        config=NextCloudS3BackupConfig(
+            mapping=[dataclasses.replace(dir_config, backup_root_path=root)],
+            backup_date_format="%y%m%d",
+        ),
+        **params,
+    )
+    download_mock.reset_mock()
+    nc_backup.backup()
+    return download_mock.call_count
+
+
+def tree(root: Path):
+    """relative path => (content, group of files sharing the same inode),
+    index and inodes manifest depends on inodes values they are ignored
+    """
+    files = [
+        p
+        for p in root.glob("**/*")
+        if p.is_file() and "index.sqlite" not in p.name and p.name != ".inodes"
+    ]
+    paths_per_inode = {}
+    for path in files:
+        paths_per_inode.setdefault(path.stat().st_ino, set()).add(
+            str(path.relative_to(root))
+        )
+    return {
+        str(path.relative_to(root)): (
+            path.read_bytes(),
+            frozenset(paths_per_inode[path.stat().st_ino]),
+        )
+        for path in files
+    }
+
+
+def test_async_single_flight():
+    flights = AsyncSingleFlight()
+    calls = []
+
+    async def download(value):
+        calls.append(value)
+        await asyncio.sleep(0.01)
+        return value
+
+    async def main():
+        return await asyncio.gather(
+            *(flights.do("key", download, value) for value in range(5)),
+            flights.do("other-key", download, "other"),
+        )
+
+    results = asyncio.run(main())
+    assert results == [(0, False)] + [(0, True)] * 4 + [("other", False)]
+    assert calls == [0, "other"]
+    assert (flights.executed, flights.shared) == (2, 4)
+
+
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_async_backup_same_layout_as_threads(
+    dao_mock, tmpdir, bucket, dir_config, nc_subtree, download_mock, patch_stat_etag
+):
+    test_dir = Path(str(tmpdir))
+    nc_subtree.extend(make_nc_files(bucket))
+    with freeze_time("2023-01-04"):
+        run_backup(NextcloudS3Backup, dir_config, test_dir / "threads", download_mock)
+        run_backup(
+            AsyncNextcloudS3Backup,
+            dir_config,
+            test_dir / "async",
+            download_mock,
+            concurrency=8,
+        )
+    threads_tree = tree(test_dir / "threads")
+    assert threads_tree
+    assert tree(test_dir / "async") == threads_tree
+    assert not [
+        p for p in (test_dir / "async" / REPOSITORY_DIRNAME).glob("**/*.downloading")
+    ]
+
+
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_async_backup_delta(
+    dao_mock, tmpdir, bucket, dir_config, nc_subtree, download_mock, patch_stat_etag
+):
+    test_dir = Path(str(tmpdir))
+    nc_subtree.extend(make_nc_files(bucket))
+    for nc_file in nc_subtree:
+        nc_file.mtime, nc_file.etag = 1640342159, "etag"
+    with freeze_time("2023-01-04"):
+        run_backup(
+            AsyncNextcloudS3Backup,
+            dir_config,
+            test_dir / "async",
+            download_mock,
+            metadata_cache=True,
+        )
+    with freeze_time("2023-01-05"):
+        # files whose checksum mismatched are linked using the metadata cache
+        downloads = run_backup(
+            AsyncNextcloudS3Backup,
+            dir_config,
+            test_dir / "async",
+            download_mock,
+            delta=True,
+            metadata_cache=True,
+        )
+    assert downloads == 0
+    snapshots = test_dir / "async" / "snapshots"
+    for nc_file in nc_subtree[:-1]:
+        first = snapshots / "230104" / "pverkest" / nc_file.path
+        second = snapshots / "230105" / "pverkest" / nc_file.path
+        assert first.read_bytes() == second.read_bytes()
+
+
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_async_backup_bounded_requests_in_flight(
+    dao_mock, bucket, dir_config, nc_subtree, download_mock, patch_stat_etag
+):
+    for fileid in range(1, 41):
+        content = f"content {fileid}".encode()
+        (bucket / f"urn:oid:{fileid}").write_bytes(content)
+        checksum = f"SHA1:{hashlib.sha1(content).hexdigest()}"  # nosec
+        nc_subtree.append(NextcloudFile(fileid, 2, f"files/f{fileid}", checksum, 9))
+
+    lock = threading.Lock()
+    in_flight = [0, 0]
+
+    def download(self, src, dest):
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+        time.sleep(0.01)
+        shutil.copy(src, dest)
+        with lock:
+            in_flight[0] -= 1
+
+    download_mock.side_effect = download
+    nc_backup = AsyncNextcloudS3Backup(
+        DaoNextcloudFiles("postgres://test"),
+        config=NextCloudS3BackupConfig(mapping=[dir_config]),
+        concurrency=4,
+    )
+    nc_backup.backup()
+    assert 1 < in_flight[1] <= 4
+    repository = dir_config.backup_root_path / REPOSITORY_DIRNAME
+    assert len(os.listdir(repository / "sha1")) > 1
+
+
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_async_backup_size_lanes(
+    dao_mock,
+    tmpdir,
+    bucket,
+    dir_config,
+    nc_subtree,
+    download_mock,
+    patch_stat_etag,
+    local_s3_client,
+):
+    test_dir = Path(str(tmpdir))
+    nc_subtree.extend(make_nc_files(bucket))
+    for nc_file in nc_subtree[::4]:
+        nc_file.size = 1000
+    with freeze_time("2023-01-04"):
+        run_backup(NextcloudS3Backup, dir_config, test_dir / "threads", download_mock)
+        with mock.patch.object(
+            NextcloudS3Backup,
+            "_download_s3_file_multipart",
+            autospec=True,
+            side_effect=lambda self, src, dest, config: shutil.copy(src, dest),
+        ) as multipart_mock:
+            run_backup(
+                AsyncNextcloudS3Backup,
+                dir_config,
+                test_dir / "async",
+                download_mock,
+                s3_client=local_s3_client,
+                lanes=[
+                    SizeLane(100, 4, None, 8),
+                    SizeLane(None, 2, mock.sentinel.transfer_config, 100),
+                ],
+            )
+    assert multipart_mock.call_count
+    assert {call.args[3] for call in multipart_mock.mock_calls} == {
+        mock.sentinel.transfer_config
+    }
+    assert tree(test_dir / "async") == tree(test_dir / "threads")
+
+
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_async_backup_file_system_calls_out_of_loop(
+    dao_mock, tmpdir, bucket, dir_config, nc_subtree, download_mock, patch_stat_etag
+):
+    test_dir = Path(str(tmpdir))
+    nc_subtree.extend(make_nc_files(bucket))
+    threads = {}
+    get_nc_subtree = DaoNextcloudFiles.get_nc_subtree.side_effect
+
+    def rows(*args, **kwargs):
+        for row in get_nc_subtree(*args, **kwargs):
+            threads.setdefault("db", set()).add(threading.current_thread().name)
+            yield row
+
+    DaoNextcloudFiles.get_nc_subtree.side_effect = rows
+
+    def record_thread(name):
+        method = getattr(NextcloudS3Backup, name)
+
+        def call(self, *args):
+            threads.setdefault(name, set()).add(threading.current_thread().name)
+            return method(self, *args)
+
+        return mock.patch.object(NextcloudS3Backup, name, call)
+
+    with freeze_time("2023-01-04"), record_thread("_link_repo_file"), record_thread(
+        "_publish_repo_file"
+    ), record_thread("_publish_etag_file"), record_thread("_journal_file"):
+        run_backup(
+            AsyncNextcloudS3Backup, dir_config, test_dir / "async", download_mock
+        )
+    assert set(threads) == {
+        "db",
+        "_link_repo_file",
+        "_publish_repo_file",
+        "_publish_etag_file",
+        "_journal_file",
+    }
+    for names in threads.values():
+        assert all(name.startswith("nc-s3-backup-write") for name in names)
+
+
+@pytest.mark.parametrize("params", [{}, {"download_plan": True}])
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_async_backup_transfer_context_once_per_backup(
+    dao_mock, params, bucket, dir_config, nc_subtree, download_mock, patch_stat_etag
+):
+    nc_subtree.extend(make_nc_files(bucket))
+    nc_backup = AsyncNextcloudS3Backup(
+        DaoNextcloudFiles("postgres://test"),
+        config=NextCloudS3BackupConfig(
+            mapping=[
+                dataclasses.replace(dir_config, nextcloud_path="files/d1"),
+                dataclasses.replace(dir_config, nextcloud_path="files/d2"),
+            ]
+        ),
+        **params,
+    )
+    with mock.patch(
+        "nc_s3_backup.api.aio.ThreadPoolExecutor", wraps=ThreadPoolExecutor
+    ) as executor_mock:
+        nc_backup.backup()
+    # one executor for S3 operations, one for the file system
+    assert executor_mock.call_count == 2
+    assert download_mock.call_count
+
+
+def test_aio_config_same_as_boto_config():
+    config = boto_config(
+        max_pool_connections=32,
+        retry_mode="standard",
+        max_attempts=3,
+        connect_timeout=5,
+        read_timeout=7,
+        tcp_keepalive=True,
+    )
+    with mock.patch("nc_s3_backup.api.aio.AioConfig", create=True) as aio_config_mock:
+        aio_config(config)
+    aio_config_mock.assert_called_once_with(
+        signature_version="s3v4",
+        max_pool_connections=32,
+        retries={"mode": "standard", "max_attempts": 3},
+        connect_timeout=5,
+        read_timeout=7,
+        tcp_keepalive=True,
+    )
+
+
+class StubBody:
+    """aiobotocore streaming body, ``error`` is raised by the read following
+    ``fail_after`` chunks
+    """
+
+    def __init__(self, content: bytes, events: list, error=None, fail_after=0):
+        self.content = content
+        self.events = events
+        self.error = error
+        self.fail_after = fail_after
+        self.chunks = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def read(self, size: int) -> bytes:
+        if self.error is not None and self.chunks == self.fail_after:
+            raise self.error
+        chunk, self.content = self.content[:size], self.content[size:]
+        self.chunks += 1
+        self.events.append(("read", len(chunk)))
+        return chunk
+
+
+class StubS3Client:
+    """aiobotocore S3 client (and its context manager) serving objects of
+    the local bucket directory
+    """
+
+    def __init__(self, error=None, fail_after=0):
+        self.error = error
+        self.fail_after = fail_after
+        self.calls = []
+        self.events = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    def _object(self, operation: str, bucket: str, key: str) -> Path:
+        self.calls.append((operation, key.rsplit("/", 1)[-1]))
+        path = Path("/", bucket, key)
+        if not path.exists():
+            code = "404" if operation == "HeadObject" else "NoSuchKey"
+            raise ClientError({"Error": {"Code": code}}, operation)
+        return path
+
+    async def head_object(self, Bucket: str, Key: str) -> dict:
+        etag = self._object("HeadObject", Bucket, Key).stat().etag
+        # quoted as S3 does
+        return {"ETag": '"' + etag + '"'}
+
+    async def get_object(self, Bucket: str, Key: str) -> dict:
+        content = self._object("GetObject", Bucket, Key).read_bytes()
+        body = StubBody(content, self.events, self.error, self.fail_after)
+        # only the first download fails
+        self.error = None
+        return {"Body": body}
+
+
+@pytest.fixture()
+def aio_client():
+    client = StubS3Client()
+    session = mock.Mock()
+    session.create_client.return_value = client
+    with mock.patch("nc_s3_backup.api.aio.get_session", return_value=session):
+        yield client
+
+
+def aio_backup(dir_config, **params) -> AsyncNextcloudS3Backup:
+    return AsyncNextcloudS3Backup(
+        DaoNextcloudFiles("postgres://test"),
+        config=NextCloudS3BackupConfig(
+            mapping=[dir_config], backup_date_format="%y%m%d"
+        ),
+        s3_client_params={"region_name": "us-east-1"},
+        hash_buffer_size=4,
+        **params,
+    )
+
+
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_async_backup_aiobotocore_client(
+    dao_mock,
+    tmpdir,
+    bucket,
+    dir_config,
+    nc_subtree,
+    download_mock,
+    patch_stat_etag,
+    aio_client,
+):
+    test_dir = Path(str(tmpdir))
+    nc_subtree.extend(make_nc_files(bucket))
+    with freeze_time("2023-01-04"):
+        run_backup(NextcloudS3Backup, dir_config, test_dir / "threads", download_mock)
+        download_mock.reset_mock()
+        aio_backup(
+            dataclasses.replace(dir_config, backup_root_path=test_dir / "async"),
+            profile=True,
+        ).backup()
+    download_mock.assert_not_called()
+    assert tree(test_dir / "async") == tree(test_dir / "threads")
+    # contents without SHA1 are looked up by etag, missing ones are skipped
+    assert ("HeadObject", "urn:oid:5") in aio_client.calls
+    assert ("HeadObject", "urn:oid:41") in aio_client.calls
+    assert ("GetObject", "urn:oid:41") not in aio_client.calls
+    # "content N" bodies are read by 3 chunks and an empty one
+    downloaded = [nbytes for event, nbytes in aio_client.events if event == "read"]
+    assert downloaded.count(0) == len(
+        [call for call in aio_client.calls if call[0] == "GetObject"]
+    )
+    ranked = {phase["name"]: phase for phase in profiler.summary()["phases"]}
+    assert ranked["s3_get"]["bytes"] == sum(downloaded)
+    assert ranked["hash"]["bytes"] == ranked["write"]["bytes"] == sum(downloaded)
+
+
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_async_backup_aiobotocore_backpressure(
+    dao_mock, bucket, dir_config, nc_subtree, download_mock, patch_stat_etag, aio_client
+):
+    content = b"0123456789"
+    (bucket / "urn:oid:1").write_bytes(content)
+    checksum = f"SHA1:{hashlib.sha1(content).hexdigest()}"  # nosec
+    nc_subtree.append(NextcloudFile(1, 2, "files/a.txt", checksum, len(content)))
+    write_chunk = AsyncNextcloudS3Backup._write_chunk
+
+    def slow_write_chunk(sha1, destination, chunk):
+        time.sleep(0.01)
+        write_chunk(sha1, destination, chunk)
+        aio_client.events.append(("write", len(chunk)))
+
+    with mock.patch.object(
+        AsyncNextcloudS3Backup, "_write_chunk", staticmethod(slow_write_chunk)
+    ):
+        aio_backup(dir_config).backup()
+    # next chunk is read once the previous one is written
+    assert aio_client.events == [
+        ("read", 4),
+        ("write", 4),
+        ("read", 4),
+        ("write", 4),
+        ("read", 2),
+        ("write", 2),
+        ("read", 0),
+    ]
+    repo_file = dir_config.backup_root_path / REPOSITORY_DIRNAME / "sha1"
+    assert [p.read_bytes() for p in repo_file.glob("*/*")] == [content]
+
+
+@pytest.mark.parametrize(
+    "code, expected", [("404", None), ("NoSuchKey", None), ("403", ClientError)]
+)
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_async_s3_object_etag_head_errors(
+    dao_mock, code, expected, dir_config, aio_client
+):
+    nc_backup = aio_backup(dir_config)
+    nc_file = NextcloudFile(1, 2, "files/a.txt", "", 3)
+    s3_path = dir_config.bucket / "urn:oid:1"
+
+    async def head_object(Bucket, Key):
+        raise ClientError({"Error": {"Code": code}}, "HeadObject")
+
+    async def s3_object_etag():
+        async with nc_backup._transfer_context():
+            return await nc_backup._s3_object_etag_async(nc_file, dir_config, s3_path)
+
+    aio_client.head_object = head_object
+    if expected is ClientError:
+        with pytest.raises(ClientError):
+            asyncio.run(s3_object_etag())
+    else:
+        assert asyncio.run(s3_object_etag()) is expected
+
+
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_async_s3_object_etag_head_hit(
+    dao_mock, bucket, dir_config, aio_client, patch_stat_etag
+):
+    (bucket / "urn:oid:1").write_bytes(b"abc")
+    nc_backup = aio_backup(dir_config)
+    nc_file = NextcloudFile(1, 2, "files/a.txt", "", 3)
+    s3_path = dir_config.bucket / "urn:oid:1"
+
+    async def s3_object_etag():
+        async with nc_backup._transfer_context():
+            return await nc_backup._s3_object_etag_async(nc_file, dir_config, s3_path)
+
+    assert asyncio.run(s3_object_etag()) == s3_path.stat().etag
+    assert aio_client.calls == [("HeadObject", "urn:oid:1")]
+
+
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_async_backup_aiobotocore_stream_error(
+    dao_mock, bucket, dir_config, nc_subtree, download_mock, patch_stat_etag, aio_client
+):
+    content = b"0123456789"
+    (bucket / "urn:oid:1").write_bytes(content)
+    checksum = f"SHA1:{hashlib.sha1(content).hexdigest()}"  # nosec
+    nc_subtree.append(NextcloudFile(1, 2, "files/a.txt", checksum, len(content)))
+    aio_client.error = ConnectionError("connection reset")
+    aio_client.fail_after = 1
+    repository = dir_config.backup_root_path / REPOSITORY_DIRNAME
+
+    with freeze_time("2023-01-04"), pytest.raises(ConnectionError):
+        aio_backup(dir_config).backup()
+    # partial download is left to the next resumed run
+    downloading = list(repository.glob("sha1/*/*.downloading"))
+    assert [p.read_bytes() for p in downloading] == [content[:4]]
+    index = RepositoryIndex(repository)
+    assert index.downloads() == downloading
+    index.close()
+
+    with freeze_time("2023-01-05"):
+        aio_backup(dir_config, resume=True).backup()
+    assert not list(repository.glob("**/*.downloading"))
+    local_file = dir_config.backup_root_path / "snapshots" / "230104" / "pverkest"
+    assert (local_file / "files" / "a.txt").read_bytes() == content
@@ -1,4 +1,17 @@
-from nc_s3_backup.api.db import NextcloudFile
+import logging
+import re
+import sys
+from unittest import mock
+
+import pytest
+
+from nc_s3_backup.api.db import (
+    DaoNextcloudFiles,
+    NextcloudFile,
+    mimetype_filters,
+    path_prefix_pattern,
+    path_prefix_range,
+)
 
 
 def test_nc_file():
@@ -10,3 +23,207 @@ def test_nc_file():
         size=23,
     )
     assert str(nc_file.hash_path) == "sha1/00/dea5ca03e5597312d44b767b4c1394d34d1623"
+
+
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_get_nc_subtree_server_side_cursor(dao_mock):
+    cursor = dao_mock._cnx.cursor.return_value
+    cursor.__iter__.return_value = iter(
+        [
+            (1, 2, "files/a.txt", "SHA1:00dea5ca03e5597312d44b767b4c1394d34d1623", 3),
+            (2, 2, "files/b.txt", "", 5),
+        ]
+    )
+    dao = DaoNextcloudFiles("postgres://test", itersize=10)
+    nc_files = dao.get_nc_subtree(2, "files/", [15])
+    # nothing is queried until rows are consumed
+    dao_mock._cnx.cursor.assert_not_called()
+    assert next(nc_files) == NextcloudFile(
+        1, 2, "files/a.txt", "SHA1:00dea5ca03e5597312d44b767b4c1394d34d1623", 3
+    )
+    assert dao_mock._cnx.cursor.call_args.kwargs["name"].startswith("nc_subtree_")
+    assert cursor.itersize == 10
+    assert cursor.execute.call_args.args[1] == dict(
+        storage_id=2, path="files/%", excluded_mimetype=(15,)
+    )
+    assert list(nc_files) == [NextcloudFile(2, 2, "files/b.txt", "", 5)]
+    cursor.close.assert_called_once()
+
+
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_get_nc_subtrees_single_query(dao_mock, caplog):
+    cursor = dao_mock._cnx.cursor.return_value
+    cursor.__iter__.return_value = iter(
+        [
+            (1, 10, 2, "files/projects/a.txt", "", 3, 1640342159, "etag-a"),
+            (0, 11, 2, "files/b.txt", "", 5, 1640342160, "etag-b"),
+        ]
+    )
+    dao_mock._cr.fetchall.return_value = [("Nested Loop",), ("  ->  Index Scan",)]
+    dao = DaoNextcloudFiles("postgres://test")
+    with caplog.at_level(logging.DEBUG, logger="nc_s3_backup.api.db"):
+        rows = list(dao.get_nc_subtrees([(2, "files/"), (2, "files/projects/")], [15]))
+
+    assert rows == [
+        (1, NextcloudFile(10, 2, "files/projects/a.txt", "", 3, 1640342159, "etag-a")),
+        (0, NextcloudFile(11, 2, "files/b.txt", "", 5, 1640342160, "etag-b")),
+    ]
+    dao_mock._cnx.cursor.assert_called_once()
+    query, params = cursor.execute.call_args.args
+    assert params == dict(
+        storage_id_0=2,
+        pattern_0="files/%",
+        path_0="files/",
+        path_upper_0="files0",
+        storage_id_1=2,
+        pattern_1="files/projects/%",
+        path_1="files/projects/",
+        path_upper_1="files/projects0",
+        excluded_mimetype=(15,),
+    )
+    explain_query, explain_params = dao_mock._cr.execute.call_args.args
+    assert explain_query.startswith("EXPLAIN ")
+    assert explain_params == cursor.execute.call_args.args[1]
+    assert "Nested Loop\n  ->  Index Scan" in caplog.text
+    cursor.close.assert_called_once()
+
+
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_get_nc_subtrees_storage_root_and_wildcards(dao_mock):
+    cursor = dao_mock._cnx.cursor.return_value
+    cursor.__iter__.return_value = iter(
+        [(0, 12, 3, "files/c.txt", "", 7, 1640342161, "etag-c")]
+    )
+    dao = DaoNextcloudFiles("postgres://test")
+    rows = list(dao.get_nc_subtrees([(3, ""), (2, "files/50%_off/")], [15]))
+
+    assert rows == [
+        (0, NextcloudFile(12, 3, "files/c.txt", "", 7, 1640342161, "etag-c"))
+    ]
+    _, params = cursor.execute.call_args.args
+    assert params == dict(
+        storage_id_0=3,
+        storage_id_1=2,
+        pattern_1="files/50\\%\\_off/%",
+        path_1="files/50%_off/",
+        path_upper_1="files/50%_off0",
+        excluded_mimetype=(15,),
+    )
+
+
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_get_nc_subtrees_no_explain_without_debug(dao_mock, caplog):
+    dao_mock._cnx.cursor.return_value.__iter__.return_value = iter([])
+    dao = DaoNextcloudFiles("postgres://test")
+    with caplog.at_level(logging.INFO, logger="nc_s3_backup.api.db"):
+        assert list(dao.get_nc_subtrees([(2, "files/")], [15])) == []
+    dao_mock._cr.execute.assert_not_called()
+
+
+def test_nc_file_hash_path_cache_follow_checksum():
+    nc_file = NextcloudFile(
+        fileid=33,
+        storage=99,
+        path="files/file.txt",
+        checksum="ETAG:dd0a2a1748da571835f70c95340aa6a7-2",
+        size=23,
+    )
+    assert nc_file.hash_path is nc_file.hash_path
+    assert str(nc_file.hash_path) == "etag/dd/0a2a1748da571835f70c95340aa6a7-2"
+    nc_file.checksum = "SHA1:00dea5ca03e5597312d44b767b4c1394d34d1623"
+    assert str(nc_file.hash_path) == "sha1/00/dea5ca03e5597312d44b767b4c1394d34d1623"
+    assert not hasattr(nc_file, "__dict__")
+    assert "size=23" in repr(nc_file)
+
+
+FIXTURE_PATHS = [
+    "files",
+    "files/a.txt",
+    "files/projects",
+    "files/projects/plan.pdf",
+    "files/projects/2022/budget.ods",
+    "files/projects_old/notes.md",
+    "files/projectsX/notes.md",
+    "files/HR/payroll.ods",
+    "files/hr/notes.md",
+    "files_trashbin/files/projects/plan.pdf.d1640342159",
+    "appdata_oc/preview/1/2.png",
+]
+
+
+def like(pattern: str, value: str, ignore_case: bool = False) -> bool:
+    """postgresql LIKE/ILIKE semantic (backslash being the escape char)"""
+    regex = ""
+    for escaped, char in re.findall(r"(\\?)(.)", pattern, flags=re.S):
+        if escaped:
+            regex += re.escape(char)
+        elif char == "%":
+            regex += ".*"
+        elif char == "_":
+            regex += "."
+        else:
+            regex += re.escape(char)
+    return bool(re.fullmatch(regex, value, flags=re.S | (re.I if ignore_case else 0)))
+
+
+@pytest.mark.parametrize(
+    "root_path", ["", "files/", "files/projects/", "files/a.txt", "appdata_oc/"]
+)
+def test_path_prefix_pattern_same_rows_as_ilike(root_path):
+    assert [p for p in FIXTURE_PATHS if like(path_prefix_pattern(root_path), p)] == [
+        p for p in FIXTURE_PATHS if like(root_path + "%", p, ignore_case=True)
+    ]
+
+
+@pytest.mark.parametrize(
+    "root_path", ["", "files/", "files/projects/", "files/a.txt", "appdata_oc/"]
+)
+def test_path_prefix_range_same_rows_as_pattern(root_path):
+    lower, upper = path_prefix_range(root_path)
+    assert [
+        p for p in FIXTURE_PATHS if lower <= p and (upper is None or p < upper)
+    ] == [p for p in FIXTURE_PATHS if like(path_prefix_pattern(root_path), p)]
+
+
+def test_path_prefix_range_upper_bound():
+    assert path_prefix_range("files/") == ("files/", "files0")
+    assert path_prefix_range("") == ("", None)
+    assert path_prefix_range("a" + chr(sys.maxunicode)) == (
+        "a" + chr(sys.maxunicode),
+        "b",
+    )
+    assert path_prefix_range(chr(sys.maxunicode)) == (chr(sys.maxunicode), None)
+    assert path_prefix_range("a\ud7ff") == ("a\ud7ff", "a\ue000")
+
+
+def test_path_prefix_pattern_case_sensitive_and_literal():
+    assert path_prefix_pattern("files/my_dir%/a\\b/") == "files/my\\_dir\\%/a\\\\b/%"
+    # ILIKE matched other users directories and ``_`` any char
+    assert like("files/HR/%", "files/hr/notes.md", ignore_case=True)
+    assert not like(path_prefix_pattern("files/HR/"), "files/hr/notes.md")
+    assert like("files/projects_%", "files/projectsX/notes.md")
+    assert not like(path_prefix_pattern("files/projects_"), "files/projectsX/notes.md")
+    assert like(path_prefix_pattern("files/projects_"), "files/projects_old/notes.md")
+
+
+def test_mimetype_filters():
+    assert mimetype_filters([]) == ("", {})
+    filters, params = mimetype_filters([15, 84], mimetypes=[3], mimeparts=[7, 8])
+    assert filters == (
+        " AND f.mimetype NOT IN %(excluded_mimetype)s"
+        " AND (f.mimetype IN %(mimetypes)s OR f.mimepart IN %(mimeparts)s)"
+    )
+    assert params == dict(excluded_mimetype=(15, 84), mimetypes=(3,), mimeparts=(7, 8))
+
+
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_get_nc_subtree_mimetype_restrictions(dao_mock):
+    cursor = dao_mock._cnx.cursor.return_value
+    cursor.__iter__.return_value = iter([])
+    dao = DaoNextcloudFiles("postgres://test")
+    assert list(dao.get_nc_subtree(2, "files/my_dir/", [], mimeparts=[7])) == []
+    query, params = cursor.execute.call_args.args
+    assert "ILIKE" not in query
+    assert "NOT IN" not in query
+    assert "f.mimepart IN %(mimeparts)s" in query
+    assert params == dict(storage_id=2, path="files/my\\_dir/%", mimeparts=(7,))
@@ -1,6 +1,9 @@
 import hashlib
+import logging
 import os
 import shutil
+import threading
+import time
 from datetime import datetime
 from os import stat_result
 from pathlib import Path
@@ -13,9 +16,13 @@ from nc_s3_backup.api.backup import (
     REPOSITORY_DIRNAME,
     SNAPSHOT_DIRNAME,
     NextcloudS3Backup,
+    SingleFlight,
+    SizeLane,
 )
 from nc_s3_backup.api.config import NextcloudDirectoryConfig, NextCloudS3BackupConfig
 from nc_s3_backup.api.db import DaoNextcloudFiles, NextcloudFile
+from nc_s3_backup.api.index import RepositoryIndex
+from nc_s3_backup.api.manifest import JOURNAL_FILENAME, update_from_inodes_manifest
 
 
 @pytest.fixture()
@@ -100,6 +107,7 @@ def _test_backup_file(
     etag="ETAG:dd0a2a1748da571835f70c95340aa6a7-2",
     checksum="SHA1:ba8607f049f59aeadcff2adb9fae48d0cf16b4ad",
     content=b"Binary file contents",
+    stream_download=False,
 ):
     bucket = test_dir / "bucket-test"
     bucket.mkdir(parents=True, exist_ok=True)
@@ -147,6 +155,7 @@ def _test_backup_file(
     nc_backup = NextcloudS3Backup(
         DaoNextcloudFiles("postgres://test"),
         config=NextCloudS3BackupConfig(mapping=[nc_dir_conf], backup_date_format="%y"),
+        stream_download=stream_download,
     )
     nc_backup.populate_sha1_file_per_inode(nc_dir_conf)
     local_file = (
@@ -198,6 +207,35 @@ def test_backup_present_file_create_link(dao_mock, tmpdir, patch_path_get):
     assert repo.stat().st_ino == local.stat().st_ino
 
 
+@pytest.mark.parametrize(
+    "checksum", ["SHA1:ba8607f049f59aeadcff2adb9fae48d0cf16b4ad", ""]
+)
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_backup_new_file_stream_download(dao_mock, tmpdir, checksum, patch_stat_result):
+    """Streamed download doesn't rely on s3path copy and hash downloaded
+    content without reading it again"""
+    patch_stat_result("dd0a2a1748da571835f70c95340aa6a7-2")
+    with mock.patch(
+        "nc_s3_backup.api.backup.sha1_file", side_effect=AssertionError
+    ), mock.patch.object(
+        NextcloudS3Backup,
+        "_download_s3_file",
+        side_effect=AssertionError,
+    ):
+        res, s3, sha1_repo, local, etag_repo = _test_backup_file(
+            Path(str(tmpdir)),
+            s3_present=True,
+            repo_present=False,
+            checksum=checksum,
+            stream_download=True,
+        )
+    assert res == local
+    assert sha1_repo.read_bytes() == b"Binary file contents"
+    assert sha1_repo.stat().st_ino == local.stat().st_ino
+    assert etag_repo.exists() == (not checksum)
+    assert not list(sha1_repo.parent.glob("*.downloading"))
+
+
 @mock.patch("nc_s3_backup.api.db.Dao")
 def test_ignore_missing_s3_file_data_exists(dao_mock, tmpdir, patch_path_get):
     res, s3, repo, local, etag_repo = _test_backup_file(
@@ -420,3 +458,761 @@ def test_current_backup_formatted_date(dao_mock):
     # next call should keep first time
     with freeze_time("1985-07-16 15:19"):
         assert nc_backup.current_backup_formatted_date == "15 at 14:18"
+
+
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_backup_directory_concurrently(
+    dao_mock, bucket, dir_config, nc_subtree, download_mock
+):
+    """Rows sharing the same checksum are downloaded once and every
+    snapshot file is linked to the same repository file"""
+    root_backup = dir_config.backup_root_path
+    for fileid in range(1, 41):
+        content = f"content {fileid % 4}".encode()
+        (bucket / f"urn:oid:{fileid}").write_bytes(content)
+        nc_subtree.append(
+            NextcloudFile(
+                fileid=fileid,
+                storage=2,
+                path=f"files/dir-{fileid % 3}/file-{fileid}.txt",
+                checksum=f"SHA1:{hashlib.sha1(content).hexdigest()}",  # nosec
+                size=len(content),
+            )
+        )
+    nc_backup = NextcloudS3Backup(
+        DaoNextcloudFiles("postgres://test"),
+        config=NextCloudS3BackupConfig(mapping=[dir_config], backup_date_format="%y"),
+        workers=8,
+    )
+    nc_backup.backup()
+
+    assert download_mock.call_count == 4
+    repo_files = [
+        f
+        for f in (root_backup / REPOSITORY_DIRNAME / "sha1").glob("**/*")
+        if f.is_file()
+    ]
+    assert len(repo_files) == 4
+    assert not [f for f in repo_files if f.suffix == ".downloading"]
+    snapshot = root_backup / SNAPSHOT_DIRNAME / datetime.now().strftime("%y")
+    for nc_file in nc_subtree:
+        local_file = snapshot / "pverkest" / nc_file.path
+        repo_file = root_backup / REPOSITORY_DIRNAME / nc_file.hash_path
+        assert local_file.stat().st_ino == repo_file.stat().st_ino
+    inodes = set()
+    assert update_from_inodes_manifest(
+        inodes, snapshot, dir_config.backup_root_path / REPOSITORY_DIRNAME
+    )
+    assert inodes == {f.stat().st_ino for f in repo_files}
+
+
+def test_single_flight_shares_in_flight_call():
+    flights = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+
+    def download(value):
+        started.set()
+        release.wait(5)
+        return value
+
+    results = []
+    leader = threading.Thread(
+        target=lambda: results.append(flights.do("key", download, "leader"))
+    )
+    leader.start()
+    started.wait(5)
+    followers = [
+        threading.Thread(
+            target=lambda: results.append(flights.do("key", download, "follower"))
+        )
+        for _ in range(4)
+    ]
+    for follower in followers:
+        follower.start()
+    while flights.shared < 4:
+        time.sleep(0.001)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join()
+    assert sorted(results) == [("leader", False)] + [("leader", True)] * 4
+    assert flights.executed == 1
+    # calls are forgotten once landed
+    assert flights.do("key", download, "next") == ("next", False)
+    assert flights.executed == 2
+
+
+def test_single_flight_shares_exception():
+    flights = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    errors = []
+
+    def fail():
+        started.set()
+        release.wait(5)
+        raise ValueError("S3 error")
+
+    def call():
+        with pytest.raises(ValueError) as error:
+            flights.do("key", fail)
+        errors.append(error.value)
+
+    threads = [threading.Thread(target=call)]
+    threads[0].start()
+    started.wait(5)
+    threads.append(threading.Thread(target=call))
+    threads[1].start()
+    while not flights.shared:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 2
+    assert errors[0] is errors[1]
+
+
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_backup_same_wrong_checksum_not_shared(
+    dao_mock, bucket, dir_config, nc_subtree, download_mock
+):
+    """Rows sharing a wrong nextcloud checksum have different contents, they
+    can't share the same download"""
+    for fileid in range(1, 5):
+        (bucket / f"urn:oid:{fileid}").write_bytes(f"content {fileid}".encode())
+        nc_subtree.append(
+            NextcloudFile(fileid, 2, f"files/file-{fileid}.txt", "SHA1:wrong", 9)
+        )
+    nc_backup = NextcloudS3Backup(
+        DaoNextcloudFiles("postgres://test"),
+        config=NextCloudS3BackupConfig(mapping=[dir_config], backup_date_format="%y"),
+        workers=4,
+    )
+
+    def download(self, src, dest):
+        time.sleep(0.05)
+        shutil.copy(src, dest)
+
+    download_mock.side_effect = download
+    nc_backup.backup()
+
+    assert download_mock.call_count == 4
+    snapshot = (
+        dir_config.backup_root_path / SNAPSHOT_DIRNAME / datetime.now().strftime("%y")
+    )
+    for nc_file in nc_subtree:
+        assert (snapshot / "pverkest" / nc_file.path).read_bytes() == (
+            f"content {nc_file.fileid}".encode()
+        )
+
+
+@pytest.mark.parametrize("stream_download", [False, True])
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_backup_workers_share_s3_client(
+    dao_mock, bucket, dir_config, nc_subtree, local_s3_client, stream_download
+):
+    """Workers request S3 objects using the shared (thread safe) client,
+    never through s3path and its boto3 resource which is not thread safe"""
+    for fileid in range(1, 13):
+        content = f"content {fileid}".encode()
+        (bucket / f"urn:oid:{fileid}").write_bytes(content)
+        checksum = f"SHA1:{hashlib.sha1(content).hexdigest()}"  # nosec
+        nc_subtree.append(
+            NextcloudFile(
+                fileid=fileid,
+                storage=2,
+                path=f"files/file-{fileid}.txt",
+                checksum=checksum if fileid % 2 else "",
+                size=len(content),
+            )
+        )
+    nc_subtree.append(NextcloudFile(13, 2, "files/missing.txt", "", 9))
+    nc_backup = NextcloudS3Backup(
+        DaoNextcloudFiles("postgres://test"),
+        config=NextCloudS3BackupConfig(mapping=[dir_config], backup_date_format="%y"),
+        workers=4,
+        stream_download=stream_download,
+        s3_client=local_s3_client,
+    )
+    path_exists, path_stat, path_open = Path.exists, Path.stat, Path.open
+
+    def not_in_bucket(method):
+        def call(path, *args, **kwargs):
+            assert bucket not in path.parents, f"{path} requested using s3path"
+            return method(path, *args, **kwargs)
+
+        return call
+
+    with mock.patch.object(
+        Path, "exists", not_in_bucket(path_exists)
+    ), mock.patch.object(Path, "stat", not_in_bucket(path_stat)), mock.patch.object(
+        Path, "open", not_in_bucket(path_open)
+    ):
+        nc_backup.backup()
+
+    assert all(name.startswith("nc-s3-backup") for name in local_s3_client.threads)
+    assert ("HeadObject", "urn:oid:13") in local_s3_client.calls
+    download = "GetObject" if stream_download else "DownloadFile"
+    assert {
+        name for operation, name in local_s3_client.calls if operation == download
+    } == {f"urn:oid:{fileid}" for fileid in range(1, 13)}
+    snapshot = (
+        dir_config.backup_root_path / SNAPSHOT_DIRNAME / datetime.now().strftime("%y")
+    )
+    for fileid in range(1, 13):
+        assert (snapshot / f"pverkest/files/file-{fileid}.txt").read_bytes() == (
+            f"content {fileid}".encode()
+        )
+    assert not (snapshot / "pverkest/files/missing.txt").exists()
+
+
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_backup_directory_size_lanes(
+    dao_mock, bucket, dir_config, nc_subtree, local_s3_client
+):
+    """Small files are streamed by the first lane threads, large files are
+    downloaded by the second lane threads using its transfer config"""
+    for fileid in range(1, 21):
+        content = f"content {fileid}".encode() * (20 if fileid % 4 == 0 else 1)
+        (bucket / f"urn:oid:{fileid}").write_bytes(content)
+        nc_subtree.append(
+            NextcloudFile(
+                fileid=fileid,
+                storage=2,
+                path=f"files/file-{fileid}.txt",
+                checksum=f"SHA1:{hashlib.sha1(content).hexdigest()}",  # nosec
+                size=len(content),
+            )
+        )
+    transfer_config = mock.sentinel.transfer_config
+    nc_backup = NextcloudS3Backup(
+        DaoNextcloudFiles("postgres://test"),
+        config=NextCloudS3BackupConfig(mapping=[dir_config], backup_date_format="%y"),
+        s3_client=local_s3_client,
+        lanes=[
+            SizeLane(100, 4, None, 8),
+            SizeLane(None, 2, transfer_config, 100),
+        ],
+    )
+    threads = {}
+
+    def stream(self, src, dest):
+        threads[int(src.name.split(":")[-1])] = threading.current_thread().name
+        return stream_s3_file(self, src, dest)
+
+    def multipart(self, src, dest, config):
+        assert config is transfer_config
+        threads[int(src.name.split(":")[-1])] = threading.current_thread().name
+        shutil.copy(src, dest)
+
+    stream_s3_file = NextcloudS3Backup._stream_s3_file
+    with mock.patch.object(
+        NextcloudS3Backup, "_stream_s3_file", autospec=True, side_effect=stream
+    ), mock.patch.object(
+        NextcloudS3Backup,
+        "_download_s3_file_multipart",
+        autospec=True,
+        side_effect=multipart,
+    ):
+        nc_backup.backup()
+
+    assert len(threads) == 20
+    for fileid, thread_name in threads.items():
+        lane = 1 if fileid % 4 == 0 else 0
+        assert thread_name.startswith(f"nc-s3-backup-{lane}_")
+    snapshot = (
+        dir_config.backup_root_path / SNAPSHOT_DIRNAME / datetime.now().strftime("%y")
+    )
+    for nc_file in nc_subtree:
+        assert (snapshot / "pverkest" / nc_file.path).read_bytes() == (
+            bucket / f"urn:oid:{nc_file.fileid}"
+        ).read_bytes()
+
+
+@pytest.mark.parametrize("buffer_size", [1, 7, 1024, 1024 * 1024])
+def test_compute_sha1_by_chunks(tmpdir, buffer_size):
+    content = os.urandom(10 * 1024 + 3)
+    file = Path(str(tmpdir)) / "file"
+    file.write_bytes(content)
+    assert NextcloudS3Backup._compute_sha1(file, buffer_size=buffer_size) == (
+        f"SHA1:{hashlib.sha1(content).hexdigest()}"  # nosec
+    )
+
+
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_sha1_file_per_inode_loaded_once_per_backup_root_path(dao_mock, tmpdir):
+    test_dir = Path(str(tmpdir))
+    mapping = [
+        NextcloudDirectoryConfig(
+            storage_id=storage_id,
+            user_name=user_name,
+            bucket=test_dir / "bucket",
+            nextcloud_path="files/",
+            backup_root_path=test_dir / root,
+        )
+        for storage_id, user_name, root in [
+            (2, "pverkest", "data"),
+            (3, "mc", "data"),
+            (3, "mc", "sensitive_data"),
+        ]
+    ]
+    nc_backup = NextcloudS3Backup(
+        DaoNextcloudFiles("postgres://test"),
+        config=NextCloudS3BackupConfig(mapping=mapping),
+    )
+    with mock.patch(
+        "nc_s3_backup.api.db.DaoNextcloudFiles.get_nc_subtree", return_value=[]
+    ), mock.patch(
+        "nc_s3_backup.api.index.RepositoryIndex.sha1_per_inode", return_value={}
+    ) as sha1_per_inode_mock:
+        nc_backup.backup()
+    assert sha1_per_inode_mock.call_count == 2
+    assert sorted(nc_backup._sha1_file_per_inode) == [
+        test_dir / "data",
+        test_dir / "sensitive_data",
+    ]
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_backup_delta(dao_mock, bucket, dir_config, nc_subtree, download_mock, workers):
+    root_backup = dir_config.backup_root_path
+
+    def nc_file(fileid, content, mtime=1640342159):
+        (bucket / f"urn:oid:{fileid}").write_bytes(content)
+        return NextcloudFile(
+            fileid=fileid,
+            storage=2,
+            path=f"files/dir-{fileid % 2}/file-{fileid}.txt",
+            checksum=f"SHA1:{hashlib.sha1(content).hexdigest()}",  # nosec
+            size=len(content),
+            mtime=mtime,
+            etag=f"etag{mtime}",
+        )
+
+    def run_backup(date, nc_files):
+        nc_subtree[:] = nc_files
+        nc_backup = NextcloudS3Backup(
+            DaoNextcloudFiles("postgres://test"),
+            config=NextCloudS3BackupConfig(
+                mapping=[dir_config], backup_date_format="%y%m%d"
+            ),
+            workers=workers,
+            delta=True,
+        )
+        with freeze_time(date), mock.patch.object(
+            NextcloudS3Backup,
+            "_backup_file",
+            autospec=True,
+            side_effect=NextcloudS3Backup._backup_file,
+        ) as backup_file_mock:
+            nc_backup.backup()
+        return sorted(call.args[1].fileid for call in backup_file_mock.mock_calls)
+
+    first_files = [nc_file(fileid, f"content {fileid}".encode()) for fileid in range(6)]
+    first_files.append(nc_file(10, b""))
+    assert run_backup("2023-01-04", first_files) == [0, 1, 2, 3, 4, 5, 10]
+
+    second_files = [
+        nc_file(0, b"content 0"),
+        nc_file(1, b"content 1"),
+        # updated
+        nc_file(2, b"new content 2", mtime=1640342999),
+        # removed 3
+        nc_file(4, b"content 4"),
+        nc_file(5, b"content 5"),
+        # added
+        nc_file(6, b"content 6"),
+        nc_file(10, b""),
+    ]
+    # unchanged empty file 10 is touched again
+    assert run_backup("2023-01-05", second_files) == [2, 6]
+
+    snapshots = root_backup / SNAPSHOT_DIRNAME
+    for nc_file in second_files:
+        local_file = snapshots / "230105" / "pverkest" / nc_file.path
+        assert (
+            local_file.read_bytes()
+            == (bucket / f"urn:oid:{nc_file.fileid}").read_bytes()
+        )
+        if nc_file.size:
+            repo_file = root_backup / REPOSITORY_DIRNAME / nc_file.hash_path
+            assert local_file.stat().st_ino == repo_file.stat().st_ino
+    assert not (snapshots / "230105" / "pverkest" / "files/dir-1/file-3.txt").exists()
+    assert (snapshots / "230104" / "pverkest" / "files/dir-1/file-3.txt").exists()
+    inodes = set()
+    assert update_from_inodes_manifest(
+        inodes, snapshots / "230105", dir_config.backup_root_path / REPOSITORY_DIRNAME
+    )
+    assert len(inodes) == 6
+
+
+@pytest.mark.parametrize("metadata_cache", [True, False])
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_backup_metadata_cache(
+    dao_mock, bucket, dir_config, nc_subtree, download_mock, metadata_cache
+):
+    """Unchanged oc_filecache rows are linked to the repository file
+    resolved by the previous run without any S3 request"""
+    root_backup = dir_config.backup_root_path
+    content = b"cached content"
+    (bucket / "urn:oid:7").write_bytes(content)
+
+    def run_backup(date, etag):
+        nc_backup = NextcloudS3Backup(
+            DaoNextcloudFiles("postgres://test"),
+            config=NextCloudS3BackupConfig(
+                mapping=[dir_config], backup_date_format="%Y-%m-%d"
+            ),
+            metadata_cache=metadata_cache,
+        )
+        nc_subtree[:] = [
+            NextcloudFile(
+                fileid=7,
+                storage=2,
+                path="files/file.txt",
+                checksum="",
+                size=len(content),
+                mtime=1640342159,
+                etag=etag,
+            )
+        ]
+        download_mock.reset_mock()
+        with freeze_time(date):
+            nc_backup.backup()
+        local_file = (
+            root_backup / SNAPSHOT_DIRNAME / date / "pverkest" / "files" / "file.txt"
+        )
+        return download_mock.call_count, local_file
+
+    calls, local_file = run_backup("2023-01-04", "etag1")
+    assert calls == 1
+    assert local_file.read_bytes() == content
+
+    (bucket / "urn:oid:7").unlink()
+    calls, local_file = run_backup("2023-01-05", "etag1")
+    assert calls == 0
+    assert local_file.exists() is metadata_cache
+    if metadata_cache:
+        sha1 = hashlib.sha1(content).hexdigest()  # nosec
+        repo_file = root_backup / REPOSITORY_DIRNAME / "sha1" / sha1[:2] / sha1[2:]
+        assert local_file.stat().st_ino == repo_file.stat().st_ino
+
+    # etag changed, file is looked up on S3 again
+    calls, local_file = run_backup("2023-01-06", "etag2")
+    assert calls == 0
+    assert not local_file.exists()
+
+
+@pytest.mark.parametrize(
+    "params", [{}, {"workers": 4}, {"download_plan": True}, {"delta": True}]
+)
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_backup_replicas_past_max_links(
+    dao_mock, bucket, dir_config, nc_subtree, download_mock, patch_stat_result, params
+):
+    """Popular contents are linked to replicas once their repository file
+    reached ``max_links``, purge keeps replicas numbered from 0"""
+    patch_stat_result("dd0a2a1748da571835f70c95340aa6a7-2")
+    root_backup = dir_config.backup_root_path
+    content = b"company logo"
+    sha1 = hashlib.sha1(content).hexdigest()  # nosec
+    for fileid in range(1, 8):
+        (bucket / f"urn:oid:{fileid}").write_bytes(content)
+        nc_subtree.append(
+            NextcloudFile(
+                fileid=fileid,
+                storage=2,
+                path=f"files/dir-{fileid % 2}/logo-{fileid}.png",
+                # last one without sha1 is linked through its etag
+                checksum=f"SHA1:{sha1}" if fileid < 7 else "",
+                size=len(content),
+                mtime=1640342159,
+                etag="etag",
+            )
+        )
+    config = NextCloudS3BackupConfig(mapping=[dir_config], backup_date_format="%d")
+
+    def run_backup(date):
+        nc_backup = NextcloudS3Backup(
+            DaoNextcloudFiles("postgres://test"), config=config, max_links=3, **params
+        )
+        download_mock.reset_mock()
+        with freeze_time(date):
+            nc_backup.backup()
+        return download_mock.call_count
+
+    repo_dir = root_backup / REPOSITORY_DIRNAME / "sha1" / sha1[:2]
+    snapshots = root_backup / SNAPSHOT_DIRNAME
+    assert run_backup("2023-01-04") >= 1
+    assert run_backup("2023-01-05") == 0
+    for date in ["04", "05"]:
+        for nc_file in nc_subtree:
+            local_file = snapshots / date / "pverkest" / nc_file.path
+            assert local_file.read_bytes() == content
+            assert local_file.stat().st_nlink <= 3
+    replicas = sorted(path.name for path in repo_dir.iterdir())
+    assert replicas == [sha1[2:]] + [f"{sha1[2:]}.{n}" for n in range(1, len(replicas))]
+    assert len(replicas) >= 7
+    inodes = set()
+    assert update_from_inodes_manifest(
+        inodes, snapshots / "05", dir_config.backup_root_path / REPOSITORY_DIRNAME
+    )
+    assert {
+        (snapshots / "05" / "pverkest" / nc_file.path).stat().st_ino
+        for nc_file in nc_subtree
+    } <= inodes
+
+    shutil.rmtree(snapshots / "04")
+    NextcloudS3Backup(dao=None, config=config).purge()
+    kept = sorted(path.name for path in repo_dir.iterdir())
+    assert len(kept) < len(replicas)
+    assert kept == [sha1[2:]] + [f"{sha1[2:]}.{n}" for n in range(1, len(kept))]
+    index = RepositoryIndex(root_backup / REPOSITORY_DIRNAME)
+    assert index.sha1_per_inode() == {
+        (repo_dir / name).stat().st_ino: sha1 for name in kept
+    }
+    index.close()
+    for nc_file in nc_subtree:
+        local_file = snapshots / "05" / "pverkest" / nc_file.path
+        assert local_file.read_bytes() == content
+
+    run_backup("2023-01-06")
+    for nc_file in nc_subtree:
+        assert (snapshots / "06" / "pverkest" / nc_file.path).read_bytes() == content
+
+
+@pytest.mark.parametrize(
+    "params", [{}, dict(workers=4), dict(download_plan=True), dict(delta=True)]
+)
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_backup_resume(dao_mock, bucket, dir_config, nc_subtree, download_mock, params):
+    """An interrupted backup is resumed in the same snapshot without
+    linking again files it journaled, stale downloads are reused or removed
+    """
+    root_backup = dir_config.backup_root_path
+    nc_subtree.append(NextcloudFile(11, 2, "files/empty.txt", "", 0))
+    for fileid in range(1, 11):
+        content = f"content {fileid}".encode()
+        (bucket / f"urn:oid:{fileid}").write_bytes(content)
+        nc_subtree.append(
+            NextcloudFile(
+                fileid,
+                2,
+                f"files/dir-{fileid % 2}/{fileid}.txt",
+                f"SHA1:{hashlib.sha1(content).hexdigest()}",  # nosec
+                len(content),
+            )
+        )
+    config = NextCloudS3BackupConfig(mapping=[dir_config], backup_date_format="%d")
+    downloads = []
+
+    def download(self, src, dest):
+        if len(downloads) == 2 and not self.resume:
+            raise ConnectionError("network is gone")
+        downloads.append(src)
+        shutil.copy(src, dest)
+
+    download_mock.side_effect = download
+
+    def run_backup(date, resume):
+        nc_backup = NextcloudS3Backup(
+            DaoNextcloudFiles("postgres://test"), config=config, resume=resume, **params
+        )
+        with freeze_time(date):
+            nc_backup.backup()
+
+    with pytest.raises(ConnectionError):
+        run_backup("2023-01-04", False)
+    snapshot = root_backup / SNAPSHOT_DIRNAME / "04"
+    journal = snapshot / JOURNAL_FILENAME
+    assert journal.exists()
+    assert not (snapshot / ".inodes").exists()
+    # last journal batch lost while its files were linked
+    if journal.stat().st_size:
+        os.truncate(journal, journal.stat().st_size - 8)
+    sha1_dir = root_backup / REPOSITORY_DIRNAME / "sha1"
+    # complete download of the last file, a partial one and one published
+    # after the last index commit recorded by the interrupted run
+    last_sha1 = nc_subtree[-1].checksum[5:]
+    complete = sha1_dir / last_sha1[:2] / f"{last_sha1[2:]}.downloading"
+    complete.parent.mkdir(parents=True, exist_ok=True)
+    complete.write_bytes(b"content 10")
+    partial = sha1_dir / "ab" / "cdef.downloading"
+    partial.parent.mkdir(exist_ok=True)
+    partial.write_bytes(b"cont")
+    index = RepositoryIndex(root_backup / REPOSITORY_DIRNAME)
+    index.add_download(complete)
+    index.add_download(partial)
+    index.add_download(sha1_dir / "ef" / "published.downloading")
+    index.close()
+
+    downloads.clear()
+    run_backup("2023-01-05", True)
+    assert [path.name for path in (root_backup / SNAPSHOT_DIRNAME).iterdir()] == ["04"]
+    if not params.get("workers"):
+        # 2 contents downloaded before the crash, 1 stale download reused
+        assert len(downloads) == 7
+    assert not journal.exists()
+    assert not list(sha1_dir.glob("**/*.downloading"))
+    index = RepositoryIndex(root_backup / REPOSITORY_DIRNAME)
+    assert index.downloads() == []
+    index.close()
+    inodes = set()
+    assert update_from_inodes_manifest(
+        inodes, snapshot, dir_config.backup_root_path / REPOSITORY_DIRNAME
+    )
+    for nc_file in nc_subtree:
+        local_file = snapshot / "pverkest" / nc_file.path
+        if nc_file.size:
+            assert (
+                local_file.read_bytes()
+                == (bucket / f"urn:oid:{nc_file.fileid}").read_bytes()
+            )
+            assert local_file.stat().st_ino in inodes
+        else:
+            assert local_file.read_bytes() == b""
+
+
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_backup_existing_snapshot_removes_inodes_manifest(
+    dao_mock, bucket, dir_config, nc_subtree, download_mock, patch_stat_etag
+):
+    """A run linking files in an existing snapshot removes its manifest
+    first so purge can't trust it if the run dies before writing a new one
+    """
+    for fileid in range(1, 3):
+        content = f"content {fileid}".encode()
+        (bucket / f"urn:oid:{fileid}").write_bytes(content)
+        nc_subtree.append(
+            NextcloudFile(
+                fileid,
+                2,
+                f"files/{fileid}.txt",
+                f"SHA1:{hashlib.sha1(content).hexdigest()}",  # nosec
+                len(content),
+            )
+        )
+    config = NextCloudS3BackupConfig(mapping=[dir_config], backup_date_format="%d")
+    snapshot = dir_config.backup_root_path / SNAPSHOT_DIRNAME / "04"
+
+    def run_backup(resume=False):
+        nc_backup = NextcloudS3Backup(
+            DaoNextcloudFiles("postgres://test"), config=config, resume=resume
+        )
+        with freeze_time("2023-01-04"):
+            nc_backup.backup()
+
+    run_backup()
+    assert update_from_inodes_manifest(
+        set(), snapshot, dir_config.backup_root_path / REPOSITORY_DIRNAME
+    )
+
+    (bucket / "urn:oid:3").write_bytes(b"content 3")
+    nc_subtree.insert(0, NextcloudFile(3, 2, "files/3.txt", "", 9))
+    download_mock.side_effect = ConnectionError("network is gone")
+    with pytest.raises(ConnectionError):
+        run_backup()
+    assert not (snapshot / ".inodes").exists()
+
+    download_mock.side_effect = lambda self, src, dest: shutil.copy(src, dest)
+    run_backup(resume=True)
+    inodes = set()
+    assert update_from_inodes_manifest(
+        inodes, snapshot, dir_config.backup_root_path / REPOSITORY_DIRNAME
+    )
+    assert {
+        (snapshot / "pverkest" / nc_file.path).stat().st_ino for nc_file in nc_subtree
+    } <= inodes
+
+
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_backup_resume_delta_removed(
+    dao_mock, bucket, dir_config, nc_subtree, download_mock, caplog
+):
+    """Files linked by the interrupted run are not counted as removed from
+    the previous snapshot once resumed"""
+    for fileid in range(1, 5):
+        content = f"content {fileid}".encode()
+        (bucket / f"urn:oid:{fileid}").write_bytes(content)
+        nc_subtree.append(
+            NextcloudFile(
+                fileid,
+                2,
+                f"files/{fileid}.txt",
+                f"SHA1:{hashlib.sha1(content).hexdigest()}",  # nosec
+                len(content),
+                mtime=1640342159,
+                etag=f"etag{fileid}",
+            )
+        )
+    config = NextCloudS3BackupConfig(mapping=[dir_config], backup_date_format="%d")
+
+    def run_backup(date, resume=False):
+        nc_backup = NextcloudS3Backup(
+            DaoNextcloudFiles("postgres://test"),
+            config=config,
+            delta=True,
+            resume=resume,
+        )
+        with freeze_time(date):
+            nc_backup.backup()
+
+    run_backup("2023-01-04")
+    # fileid 3 changed, the run is interrupted while downloading it
+    (bucket / "urn:oid:3").write_bytes(b"new content 3")
+    nc_subtree[2].checksum = f"SHA1:{hashlib.sha1(b'new content 3').hexdigest()}"
+    nc_subtree[2].mtime = 1640342999
+    download_mock.side_effect = ConnectionError("network is gone")
+    with pytest.raises(ConnectionError):
+        run_backup("2023-01-05")
+
+    download_mock.side_effect = lambda self, src, dest: shutil.copy(src, dest)
+    caplog.clear()
+    with caplog.at_level(logging.INFO):
+        run_backup("2023-01-06", resume=True)
+    assert "1 changed - 0 removed - 3 unchanged" in caplog.text
+    snapshot = dir_config.backup_root_path / SNAPSHOT_DIRNAME / "05"
+    assert (snapshot / "pverkest/files/3.txt").read_bytes() == b"new content 3"
+
+
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_backup_resume_skips_snapshot_older_than_complete_one(
+    dao_mock, bucket, dir_config, nc_subtree, download_mock, caplog
+):
+    """An interrupted snapshot followed by a complete one isn't resumed"""
+    for fileid in range(1, 3):
+        content = f"content {fileid}".encode()
+        (bucket / f"urn:oid:{fileid}").write_bytes(content)
+        nc_subtree.append(
+            NextcloudFile(
+                fileid,
+                2,
+                f"files/{fileid}.txt",
+                f"SHA1:{hashlib.sha1(content).hexdigest()}",  # nosec
+                len(content),
+            )
+        )
+    config = NextCloudS3BackupConfig(mapping=[dir_config], backup_date_format="%d")
+
+    def run_backup(date, resume=False):
+        nc_backup = NextcloudS3Backup(
+            DaoNextcloudFiles("postgres://test"), config=config, resume=resume
+        )
+        with freeze_time(date):
+            nc_backup.backup()
+
+    download_mock.side_effect = ConnectionError("network is gone")
+    with pytest.raises(ConnectionError):
+        run_backup("2023-01-01")
+    download_mock.side_effect = lambda self, src, dest: shutil.copy(src, dest)
+    run_backup("2023-01-02")
+    nc_subtree.append(NextcloudFile(3, 2, "files/empty.txt", "", 0))
+    with caplog.at_level(logging.INFO):
+        run_backup("2023-01-03", resume=True)
+
+    assert "Incomplete snapshot 01 is older than the latest complete" in caplog.text
+    snapshots = dir_config.backup_root_path / SNAPSHOT_DIRNAME
+    # the stale snapshot is left untouched
+    assert (snapshots / "01" / JOURNAL_FILENAME).exists()
+    assert not (snapshots / "01" / "pverkest" / "files" / "empty.txt").exists()
+    assert (snapshots / "03" / ".inodes").exists()
+    assert (snapshots / "03" / "pverkest" / "files" / "empty.txt").exists()
@@ -1,8 +1,11 @@
-from pathlib import PosixPath
+from pathlib import Path, PosixPath
 from unittest import mock
 
+import pytest
+
+from nc_s3_backup.api.aio import AsyncNextcloudS3Backup
 from nc_s3_backup.api.backup import NextcloudS3Backup
-from nc_s3_backup.cli import main, purge
+from nc_s3_backup.cli import main, purge, reindex
 
 
 @mock.patch("nc_s3_backup.api.backup.NextcloudS3Backup.backup")
@@ -24,6 +27,24 @@ def test_main_cli(dao_mock, backup_mock):
             "https://my-s3-endpoint.test",
             "--pg-dsn",
             "postgresql:///testdb",
+            "--pg-itersize",
+            "500",
+            "--workers",
+            "8",
+            "--hash-buffer-size",
+            "64",
+            "--s3-stream-download",
+            "--delta",
+            "--metadata-cache",
+            "--s3-max-pool-connections",
+            "64",
+            "--s3-retry-mode",
+            "standard",
+            "--s3-read-timeout",
+            "30",
+            "--s3-list",
+            "--s3-list-fileid-range",
+            "1000-2000",
             "tests/config.yaml",
         ],
     ):
@@ -31,6 +52,18 @@ def test_main_cli(dao_mock, backup_mock):
 
     assert isinstance(nc_s3_backup, NextcloudS3Backup)
     backup_mock.assert_called_once()
+    assert nc_s3_backup.workers == 8
+    assert nc_s3_backup.dao.itersize == 500
+    assert nc_s3_backup.hash_buffer_size == 64 * 1024
+    assert nc_s3_backup.stream_download is True
+    assert nc_s3_backup.delta is True
+    assert nc_s3_backup.metadata_cache is True
+    assert nc_s3_backup.s3_listing is True
+    assert nc_s3_backup.s3_listing_fileid_range == (1000, 2000)
+    assert nc_s3_backup.s3_client is not None
+    assert nc_s3_backup.s3_client.meta.config.max_pool_connections == 64
+    assert nc_s3_backup.s3_client.meta.config.retries["mode"] == "standard"
+    assert nc_s3_backup.s3_client.meta.config.read_timeout == 30
     assert nc_s3_backup.config.backup_date_format == "%y%m"
     assert nc_s3_backup.config.excluded_mimetype_ids == [15, 84]
     assert len(nc_s3_backup.config.mapping) == 3
@@ -42,12 +75,97 @@ def test_main_cli(dao_mock, backup_mock):
     assert nc_s3_backup.config.mapping[1].nextcloud_path == "files/projects/"
 
 
+@mock.patch("nc_s3_backup.api.backup.NextcloudS3Backup.backup")
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_main_cli_asyncio_transfer_engine(dao_mock, backup_mock):
+    with mock.patch(
+        "sys.argv",
+        [
+            "nextcloud-s3-backup-prog",
+            "--s3-access-key",
+            "s3-access-test",
+            "--s3-secret-key",
+            "s3-secret-test",
+            "--transfer-engine",
+            "asyncio",
+            "--async-concurrency",
+            "128",
+            "--async-write-workers",
+            "2",
+            "--download-plan",
+            "--max-hard-links",
+            "1000",
+            "--resume",
+            "--profile-cprofile",
+            "backup.prof",
+            "tests/config.yaml",
+        ],
+    ):
+        nc_s3_backup = main(testing=True)
+
+    assert isinstance(nc_s3_backup, AsyncNextcloudS3Backup)
+    backup_mock.assert_called_once()
+    assert nc_s3_backup.concurrency == 128
+    assert nc_s3_backup.download_plan is True
+    assert nc_s3_backup.max_links == 1000
+    assert nc_s3_backup.resume is True
+    assert nc_s3_backup.profile is True
+    assert nc_s3_backup.profile_cprofile_file == Path("backup.prof")
+    assert nc_s3_backup.profile_tracemalloc_file is None
+    assert nc_s3_backup.write_workers == 2
+    assert nc_s3_backup.s3_client_params["aws_access_key_id"] == "s3-access-test"
+    assert nc_s3_backup.s3_client_params["config"].max_pool_connections == 128
+
+
+@mock.patch("nc_s3_backup.api.backup.NextcloudS3Backup.backup")
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_main_cli_size_lanes(dao_mock, backup_mock):
+    with mock.patch(
+        "sys.argv",
+        [
+            "nextcloud-s3-backup-prog",
+            "--s3-access-key",
+            "s3-access-test",
+            "--s3-secret-key",
+            "s3-secret-test",
+            "--workers",
+            "16",
+            "--large-file-threshold",
+            "64",
+            "--large-file-workers",
+            "3",
+            "--s3-multipart-chunksize",
+            "16",
+            "--s3-max-concurrency",
+            "4",
+            "tests/config.yaml",
+        ],
+    ):
+        nc_s3_backup = main(testing=True)
+
+    small, large = nc_s3_backup.lanes
+    assert small.max_size == 64 * 1024 * 1024
+    assert small.workers == 16
+    assert small.transfer_config is None
+    assert small.max_queued == 32
+    assert large.max_size is None
+    assert large.workers == 3
+    assert large.transfer_config.multipart_chunksize == 16 * 1024 * 1024
+    assert large.transfer_config.max_concurrency == 4
+    assert large.max_queued == 1000
+    assert nc_s3_backup.s3_client.meta.config.max_pool_connections == (16 + 3) * 4
+
+
 @mock.patch("nc_s3_backup.api.backup.NextcloudS3Backup.purge")
 def test_purge_cli(purge_mock):
     with mock.patch(
         "sys.argv",
         [
             "nextcloud-s3-backup-purge-prog",
+            "--workers",
+            "16",
+            "--metrics-file",
+            "/var/lib/node_exporter/nc_s3_backup_purge.prom",
             "tests/config.yaml",
         ],
     ):
@@ -55,7 +173,38 @@ def test_purge_cli(purge_mock):
 
     assert isinstance(nc_s3_backup, NextcloudS3Backup)
     purge_mock.assert_called_once()
+    assert nc_s3_backup.workers == 16
+    assert nc_s3_backup.metrics_file == PosixPath(
+        "/var/lib/node_exporter/nc_s3_backup_purge.prom"
+    )
     assert len(nc_s3_backup.config.mapping) == 3
     assert sorted(nc_s3_backup.distinct_backup_root_paths) == sorted(
         [PosixPath("./backup/data"), PosixPath("./backup/sensitive_data")]
     )
+
+
+@mock.patch("nc_s3_backup.api.backup.NextcloudS3Backup.reindex")
+def test_reindex_cli(reindex_mock):
+    with mock.patch(
+        "sys.argv",
+        [
+            "nextcloud-s3-backup-reindex-prog",
+            "tests/config.yaml",
+        ],
+    ):
+        nc_s3_backup = reindex(testing=True)
+
+    assert isinstance(nc_s3_backup, NextcloudS3Backup)
+    reindex_mock.assert_called_once()
+
+
+# config file opened by argparse is left to the garbage collector
+@pytest.mark.filterwarnings("ignore::ResourceWarning")
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_main_cli_download_plan_delta(dao_mock, capsys):
+    with mock.patch(
+        "sys.argv",
+        ["nextcloud-s3-backup-prog", "--download-plan", "--delta", "tests/config.yaml"],
+    ), pytest.raises(SystemExit):
+        main(testing=True)
+    assert "--download-plan can't be used with --delta" in capsys.readouterr().err
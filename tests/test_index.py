@@ -0,0 +1,67 @@
+import os
+from pathlib import Path
+
+from nc_s3_backup.api.index import (
+    RepositoryIndex,
+    hash_from_path,
+    original_path,
+    replica_number,
+    replica_path,
+)
+
+
+def test_hash_from_path():
+    assert hash_from_path(Path(".data/sha1/fe/e41dea13f")) == "fee41dea13f"
+    assert hash_from_path(Path(".data/sha1/fe/e41dea13f.12")) == "fee41dea13f"
+
+
+def test_replica_path():
+    repo_file = Path(".data/sha1/fe/e41dea13f")
+    assert replica_path(repo_file, 0) == repo_file
+    assert replica_path(repo_file, 2) == Path(".data/sha1/fe/e41dea13f.2")
+    assert replica_number(replica_path(repo_file, 2)) == 2
+    assert replica_number(repo_file) == 0
+    assert original_path(replica_path(repo_file, 2)) == repo_file
+
+
+def test_rebuild_index(tmpdir):
+    repository = Path(str(tmpdir)) / ".data"
+    sha1_file = repository / "sha1" / "fe" / "e41dea13f"
+    sha1_file.parent.mkdir(parents=True)
+    sha1_file.write_bytes(b"content")
+    etag_file = repository / "etag" / "dd" / "0a2a1748da5-2"
+    etag_file.parent.mkdir(parents=True)
+    os.link(sha1_file, etag_file)
+    (repository / "sha1" / "fe" / "abc.downloading").write_bytes(b"partial")
+    replica = repository / "sha1" / "fe" / "e41dea13f.1"
+    replica.write_bytes(b"content")
+
+    index = RepositoryIndex(repository)
+    assert not index.built
+    assert index.sha1_per_inode() == {}
+    assert index.rebuild() == (2, 1)
+    index.close()
+
+    index = RepositoryIndex(repository)
+    assert index.built
+    assert index.sha1_per_inode() == {
+        sha1_file.stat().st_ino: "fee41dea13f",
+        replica.stat().st_ino: "fee41dea13f",
+    }
+    assert index.sha1_from_etag("dd0a2a1748da5-2") == "fee41dea13f"
+    assert index.downloads() == [repository / "sha1" / "fe" / "abc.downloading"]
+
+
+def test_incremental_updates(tmpdir):
+    index = RepositoryIndex(Path(str(tmpdir)) / ".data")
+    index.add_blob("fee41dea13f", 12, 7)
+    index.add_replica("fee41dea13f", 13, 7)
+    index.add_etag("dd0a2a1748da5-2", "fee41dea13f")
+    index.close()
+    index = RepositoryIndex(Path(str(tmpdir)) / ".data")
+    assert index.sha1_per_inode() == {12: "fee41dea13f", 13: "fee41dea13f"}
+    index.remove_blob("fee41dea13f")
+    index.remove_etag("dd0a2a1748da5-2")
+    index.close()
+    assert index.sha1_per_inode() == {}
+    assert index.sha1_from_etag("dd0a2a1748da5-2") is None
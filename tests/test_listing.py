@@ -0,0 +1,189 @@
+import dataclasses
+import hashlib
+from datetime import datetime
+from pathlib import Path
+from unittest import mock
+
+import boto3
+import pytest
+from moto import mock_aws
+
+from nc_s3_backup.api import listing
+from nc_s3_backup.api.aio import AsyncNextcloudS3Backup
+from nc_s3_backup.api.backup import (
+    REPOSITORY_DIRNAME,
+    SNAPSHOT_DIRNAME,
+    NextcloudS3Backup,
+)
+from nc_s3_backup.api.config import NextCloudS3BackupConfig
+from nc_s3_backup.api.db import DaoNextcloudFiles, NextcloudFile
+from nc_s3_backup.api.listing import (
+    ObjectInfo,
+    bucket_and_key,
+    bucket_and_prefix,
+    fileid_prefixes,
+    list_bucket,
+)
+
+
+@pytest.fixture()
+def s3_client():
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="bucket-test")
+        yield client
+
+
+def put_objects(client, fileids, prefix=""):
+    etags = {}
+    for fileid in fileids:
+        response = client.put_object(
+            Bucket="bucket-test",
+            Key=f"{prefix}urn:oid:{fileid}",
+            Body=f"content {fileid}".encode(),
+        )
+        etags[fileid] = response["ETag"].strip('"')
+    return etags
+
+
+def test_bucket_and_prefix():
+    assert bucket_and_prefix(Path("/bucket-test")) == ("bucket-test", "urn:oid:")
+    assert bucket_and_prefix(Path("/bucket-test/nc/data")) == (
+        "bucket-test",
+        "nc/data/urn:oid:",
+    )
+
+
+def test_bucket_and_key():
+    assert bucket_and_key(Path("/bucket/some/urn:oid:3")) == (
+        "bucket",
+        "some/urn:oid:3",
+    )
+
+
+@pytest.mark.parametrize(
+    "first,last,expected",
+    [
+        (7, 7, ["7"]),
+        (95, 120, ["10", "11", "120", "95", "96", "97", "98", "99"]),
+        (1, 10000000, ["1", "2", "3", "4", "5", "6", "7", "8", "9"]),
+        (4000000, 4999999, ["4"]),
+    ],
+)
+def test_fileid_prefixes(first, last, expected):
+    assert fileid_prefixes(first, last) == expected
+
+
+def test_list_bucket(s3_client):
+    # more than one page
+    etags = put_objects(s3_client, range(1, 1201))
+    s3_client.put_object(Bucket="bucket-test", Key="urn:oid:not-a-fileid", Body=b"")
+    s3_client.put_object(Bucket="bucket-test", Key="other/urn:oid:1", Body=b"")
+
+    objects = list_bucket(s3_client, Path("/bucket-test"))
+    assert len(objects) == 1200
+    assert objects[1] == ObjectInfo(len(b"content 1"), etags[1])
+    assert objects[1200] == ObjectInfo(len(b"content 1200"), etags[1200])
+
+
+def test_list_bucket_fileid_range(s3_client):
+    put_objects(s3_client, range(1, 300), prefix="nc/")
+    with mock.patch(
+        "nc_s3_backup.api.listing.list_objects",
+        wraps=listing.list_objects,
+    ) as list_objects_mock:
+        objects = list_bucket(
+            s3_client, Path("/bucket-test/nc"), fileid_range=(95, 120)
+        )
+    assert sorted(objects) == list(range(95, 121))
+    assert sorted(call.args[2] for call in list_objects_mock.mock_calls) == [
+        f"nc/urn:oid:{prefix}" for prefix in fileid_prefixes(95, 120)
+    ]
+
+
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_backup_using_bucket_listing(
+    dao_mock, dir_config, nc_subtree, download_mock, s3_client
+):
+    """Objects existence and etags are read from the bucket listing, only
+    objects missing from it are requested one by one"""
+    etags = put_objects(s3_client, [1, 2, 3])
+    root_backup = dir_config.backup_root_path
+    nc_dir_conf = dataclasses.replace(dir_config, bucket=Path("/bucket-test"))
+    sha1 = hashlib.sha1(b"content 1").hexdigest()  # nosec
+    nc_subtree[:] = [
+        NextcloudFile(1, 2, "files/with-sha1.txt", f"SHA1:{sha1}", 9),
+        NextcloudFile(2, 2, "files/without-sha1.txt", "", 9),
+        # missing on S3
+        NextcloudFile(4, 2, "files/missing.txt", "", 9),
+    ]
+    nc_backup = NextcloudS3Backup(
+        DaoNextcloudFiles("postgres://test"),
+        config=NextCloudS3BackupConfig(mapping=[nc_dir_conf], backup_date_format="%y"),
+        s3_listing=True,
+        s3_client=s3_client,
+    )
+    download_mock.side_effect = lambda self, src, dest: dest.write_bytes(
+        s3_client.get_object(Bucket="bucket-test", Key=src.name)["Body"].read()
+    )
+    with mock.patch.object(
+        s3_client, "head_object", wraps=s3_client.head_object
+    ) as head_mock:
+        nc_backup.backup()
+
+    assert download_mock.call_count == 2
+    assert [call.kwargs["Key"] for call in head_mock.mock_calls] == ["urn:oid:4"]
+    snapshot = root_backup / SNAPSHOT_DIRNAME / datetime.now().strftime("%y")
+    assert (snapshot / "pverkest/files/with-sha1.txt").read_bytes() == b"content 1"
+    assert (snapshot / "pverkest/files/without-sha1.txt").read_bytes() == b"content 2"
+    assert not (snapshot / "pverkest/files/missing.txt").exists()
+    etag_file = root_backup / REPOSITORY_DIRNAME / "etag" / etags[2][:2] / etags[2][2:]
+    assert etag_file.exists()
+
+
+@pytest.mark.parametrize("backup_class", [NextcloudS3Backup, AsyncNextcloudS3Backup])
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_backup_listing_miss_requests_object(
+    dao_mock, dir_config, nc_subtree, download_mock, s3_client, backup_class
+):
+    """Objects out of the listed fileid range (or uploaded once listed) are
+    requested one by one instead of being left out of the snapshot"""
+    put_objects(s3_client, [1, 3])
+    root_backup = dir_config.backup_root_path
+    nc_dir_conf = dataclasses.replace(dir_config, bucket=Path("/bucket-test"))
+    for fileid in (1, 3):
+        sha1 = hashlib.sha1(f"content {fileid}".encode()).hexdigest()  # nosec
+        nc_subtree.append(
+            NextcloudFile(fileid, 2, f"files/{fileid}.txt", f"SHA1:{sha1}", 9)
+        )
+    nc_backup = backup_class(
+        DaoNextcloudFiles("postgres://test"),
+        config=NextCloudS3BackupConfig(mapping=[nc_dir_conf], backup_date_format="%y"),
+        s3_listing=True,
+        s3_listing_fileid_range=(1, 2),
+        s3_client=s3_client,
+    )
+    download_mock.side_effect = lambda self, src, dest: dest.write_bytes(
+        s3_client.get_object(Bucket="bucket-test", Key=src.name)["Body"].read()
+    )
+    with mock.patch.object(
+        s3_client, "head_object", wraps=s3_client.head_object
+    ) as head_mock:
+        nc_backup.backup()
+
+    assert {call.kwargs["Key"] for call in head_mock.mock_calls} == {"urn:oid:3"}
+    snapshot = root_backup / SNAPSHOT_DIRNAME / datetime.now().strftime("%y")
+    for fileid in (1, 3):
+        assert (snapshot / f"pverkest/files/{fileid}.txt").read_bytes() == (
+            f"content {fileid}".encode()
+        )
+
+
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_backup_listing_requires_s3_client(dao_mock, dir_config):
+    with pytest.raises(ValueError, match="s3_listing requires the s3_client"):
+        NextcloudS3Backup(
+            DaoNextcloudFiles("postgres://test"),
+            config=NextCloudS3BackupConfig(mapping=[dir_config]),
+            s3_listing=True,
+        )
@@ -0,0 +1,128 @@
+import os
+from array import array
+from pathlib import Path
+
+from nc_s3_backup.api.manifest import (
+    FILES_MANIFEST_FILENAME,
+    INODES_MANIFEST_FILENAME,
+    JOURNAL_FILENAME,
+    WRITE_BATCH_SIZE,
+    ManifestEntry,
+    SnapshotJournal,
+    SnapshotManifest,
+    update_from_inodes_manifest,
+    write_inodes_manifest,
+)
+
+
+def test_inodes_manifest(tmpdir):
+    snapshot = Path(str(tmpdir))
+    manifest = write_inodes_manifest(snapshot, [5, 2**63 + 1, 3, 5], snapshot)
+    assert manifest == snapshot / INODES_MANIFEST_FILENAME
+    assert manifest.stat().st_size == (3 + 3) * 8
+    inodes = {1}
+    assert update_from_inodes_manifest(inodes, snapshot, snapshot)
+    assert inodes == {1, 3, 5, 2**63 + 1}
+
+
+def test_empty_inodes_manifest(tmpdir):
+    snapshot = Path(str(tmpdir))
+    write_inodes_manifest(snapshot, [], snapshot)
+    inodes = set()
+    assert update_from_inodes_manifest(inodes, snapshot, snapshot)
+    assert inodes == set()
+
+
+def test_missing_inodes_manifest(tmpdir):
+    assert not update_from_inodes_manifest(set(), Path(str(tmpdir)), Path(str(tmpdir)))
+
+
+def test_inodes_manifest_of_other_repository(tmpdir):
+    """Inodes of a copied or restored repository are not the saved ones"""
+    snapshot = Path(str(tmpdir)) / "snapshot"
+    repository = Path(str(tmpdir)) / "repository"
+    snapshot.mkdir()
+    repository.mkdir()
+    write_inodes_manifest(snapshot, [3, 5], repository)
+    repository.rename(Path(str(tmpdir)) / "old-repository")
+    repository.mkdir()
+    inodes = set()
+    assert not update_from_inodes_manifest(inodes, snapshot, repository)
+    assert inodes == set()
+
+
+def test_inodes_manifest_without_repository_identifier(tmpdir):
+    """Manifests written before the repository identifier was saved"""
+    snapshot = Path(str(tmpdir))
+    with (snapshot / INODES_MANIFEST_FILENAME).open("wb") as f:
+        array("Q", [3, 5]).tofile(f)
+    assert not update_from_inodes_manifest(set(), snapshot, snapshot)
+    (snapshot / INODES_MANIFEST_FILENAME).write_bytes(b"")
+    assert not update_from_inodes_manifest(set(), snapshot, snapshot)
+
+
+def test_snapshot_manifest(tmpdir):
+    snapshots = Path(str(tmpdir))
+    assert SnapshotManifest.latest(snapshots) is None
+    entry = ManifestEntry(
+        fileid=33,
+        size=23,
+        mtime=1640342159,
+        etag="61c5a2940ccc7",
+        checksum="",
+        sha1="00dea5ca03e5597312d44b767b4c1394d34d1623",
+    )
+    for snapshot in ["20230104", "20230105"]:
+        manifest = SnapshotManifest(snapshots / snapshot)
+        manifest.add("2:pverkest:files/", "files/a.txt", entry)
+        manifest.add("3:mc:files/", "files/b.txt", entry._replace(fileid=34))
+        manifest.close()
+    os.utime(snapshots / "20230104" / FILES_MANIFEST_FILENAME, (0, 0))
+
+    latest = SnapshotManifest.latest(snapshots)
+    assert latest.snapshot_directory == snapshots / "20230105"
+    assert latest.entries("2:pverkest:files/") == {"files/a.txt": entry}
+    assert latest.entries("unknown") == {}
+    assert (
+        SnapshotManifest.latest(
+            snapshots, exclude=snapshots / "20230105"
+        ).snapshot_directory
+        == snapshots / "20230104"
+    )
+
+
+def test_snapshot_journal(tmpdir):
+    snapshots = Path(str(tmpdir))
+    journal = SnapshotJournal(snapshots / "20230104")
+    journal.open()
+    assert journal.path.exists()
+    keys = [
+        SnapshotJournal.key("2:pverkest:files/", f"files/{n}.txt", n)
+        for n in range(WRITE_BATCH_SIZE + 2)
+    ]
+    for key in keys:
+        journal.add(key)
+    # first batch written, last keys are pending until closed
+    assert journal.path.stat().st_size == WRITE_BATCH_SIZE * 8
+    journal.close()
+    assert journal.path.stat().st_size == len(keys) * 8
+    # torn key written by a crash
+    with journal.path.open("ab") as f:
+        f.write(b"\x01\x02\x03")
+
+    assert [j.snapshot_directory for j in SnapshotJournal.incomplete(snapshots)] == [
+        snapshots / "20230104"
+    ]
+    resumed = SnapshotJournal(snapshots / "20230104")
+    resumed.open(load=True)
+    assert resumed.recorded == len(keys)
+    assert all(key in resumed for key in keys)
+    assert SnapshotJournal.key("2:pverkest:files/", "files/0.txt", 1) not in resumed
+    resumed.add(keys[0])
+    resumed.close()
+    assert resumed.path.stat().st_size == (len(keys) + 1) * 8
+
+    write_inodes_manifest(snapshots / "20230104", [], snapshots)
+    assert SnapshotJournal.incomplete(snapshots) == []
+    resumed.remove()
+    assert not (snapshots / "20230104" / JOURNAL_FILENAME).exists()
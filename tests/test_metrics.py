@@ -0,0 +1,104 @@
+import json
+import random
+import threading
+from pathlib import Path
+
+import pytest
+
+from nc_s3_backup.api.backup import NextcloudS3Backup
+from nc_s3_backup.api.config import NextCloudS3BackupConfig
+from nc_s3_backup.api.metrics import (
+    BUCKETS,
+    GROWTH,
+    LOWEST,
+    Histogram,
+    MetricsRegistry,
+    registry,
+    timer,
+)
+
+
+def test_histogram_quantiles():
+    histogram = Histogram()
+    values = [random.uniform(0.0001, 2) for _ in range(20000)]  # nosec
+    for value in values:
+        histogram.observe(value)
+    assert len(histogram.buckets) == BUCKETS
+    values.sort()
+    summary = histogram.summary()
+    assert summary["count"] == 20000
+    assert summary["sum"] == pytest.approx(sum(values))
+    assert (summary["min"], summary["max"]) == (values[0], values[-1])
+    for key, q in [("p50", 0.5), ("p95", 0.95), ("p99", 0.99)]:
+        exact = values[int(q * len(values)) - 1]
+        assert exact <= summary[key] <= exact * GROWTH
+
+
+def test_histogram_bounds():
+    histogram = Histogram()
+    assert histogram.summary()["p99"] == 0.0
+    histogram.observe(0)
+    histogram.observe(1e9)
+    assert histogram.summary() == dict(
+        count=2, sum=1e9, min=0, max=1e9, p50=LOWEST, p95=1e9, p99=1e9
+    )
+
+
+def test_registry_thread_safe():
+    metrics = MetricsRegistry()
+
+    def observe():
+        for _ in range(5000):
+            metrics.observe("op", 0.01)
+
+    threads = [threading.Thread(target=observe) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert dict(metrics.summaries())["op"]["count"] == 40000
+
+
+def test_registry_export(tmpdir):
+    metrics = MetricsRegistry()
+    metrics.observe("_backup_file", 0.5)
+    metrics.observe("_backup_file", 1.5)
+    metrics.observe("purge", 3)
+    json_file = Path(str(tmpdir)) / "metrics.json"
+    metrics.write(json_file)
+    assert json.loads(json_file.read_text())["_backup_file"]["count"] == 2
+
+    prom_file = Path(str(tmpdir)) / "metrics.prom"
+    metrics.write(prom_file)
+    lines = prom_file.read_text().splitlines()
+    assert "# TYPE nc_s3_backup_operation_duration_seconds summary" in lines
+    assert (
+        'nc_s3_backup_operation_duration_seconds_count{operation="_backup_file"} 2'
+        in lines
+    )
+    assert (
+        'nc_s3_backup_operation_duration_seconds_sum{operation="_backup_file"} 2.0'
+        in lines
+    )
+    assert 'nc_s3_backup_operation_duration_max_seconds{operation="purge"} 3' in lines
+    assert sorted(p.name for p in Path(str(tmpdir)).iterdir()) == [
+        "metrics.json",
+        "metrics.prom",
+    ]
+
+
+def test_timer():
+    @timer
+    def timed_operation(value):
+        return value
+
+    assert timed_operation.__name__ == "timed_operation"
+    assert timed_operation(3) == 3
+    assert dict(registry.summaries())["timed_operation"]["count"] >= 1
+
+
+def test_purge_write_metrics_file(tmpdir, dir_config):
+    config = NextCloudS3BackupConfig(mapping=[dir_config])
+    metrics_file = Path(str(tmpdir)) / "purge.json"
+    NextcloudS3Backup(dao=None, config=config, metrics_file=metrics_file).purge()
+    assert json.loads(metrics_file.read_text())["_purge_repository"]["count"] >= 2
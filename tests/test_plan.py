@@ -0,0 +1,122 @@
+import dataclasses
+import hashlib
+from datetime import datetime
+from pathlib import Path
+from unittest import mock
+
+from nc_s3_backup.api.aio import AsyncNextcloudS3Backup
+from nc_s3_backup.api.backup import (
+    REPOSITORY_DIRNAME,
+    SNAPSHOT_DIRNAME,
+    NextcloudS3Backup,
+)
+from nc_s3_backup.api.config import NextCloudS3BackupConfig
+from nc_s3_backup.api.db import DaoNextcloudFiles, NextcloudFile
+from nc_s3_backup.api.plan import DownloadPlan
+
+
+def sha1(content: bytes) -> str:
+    return f"SHA1:{hashlib.sha1(content).hexdigest()}"  # nosec
+
+
+def test_download_plan_groups_rows_by_content(tmpdir, dir_config):
+    root = Path(str(tmpdir))
+    conf = dir_config
+    other_root_conf = dataclasses.replace(dir_config, backup_root_path=root / "other")
+    plan = DownloadPlan(2)
+    plan.add(conf, NextcloudFile(1, 2, "files/a", sha1(b"a"), 10))
+    plan.add(conf, NextcloudFile(2, 2, "files/a-copy", sha1(b"a").upper(), 10))
+    plan.add(conf, NextcloudFile(3, 2, "files/b", sha1(b"b"), 20))
+    # other repository
+    plan.add(other_root_conf, NextcloudFile(1, 2, "files/a", sha1(b"a"), 10))
+    # without sha1 grouped by fileid
+    plan.add(conf, NextcloudFile(4, 2, "files/c", "", 30))
+    plan.add(conf, NextcloudFile(4, 2, "files/c", "", 30))
+    plan.add(conf, NextcloudFile(5, 2, "files/empty", "", 0))
+
+    assert plan.rows == 7
+    assert plan.links == 6
+    assert len(plan.empty_files) == 1
+    assert plan.total_bytes == 110
+    assert plan.unique_bytes == 70
+    assert [len(blob.rows) for blob in plan.blobs.values()] == [2, 1, 1, 2]
+    blob_a = next(iter(plan.blobs.values()))
+    assert blob_a.checksum == sha1(b"a").lower()
+    assert [row.nc_file.fileid for row in blob_a.fileid_rows()] == [1, 2]
+    assert plan.bytes_to_download == 70
+    blob_a.repo_file = root / "repo-file"
+    assert plan.bytes_to_download == 60
+    assert len(plan.missing_blobs()) == 3
+
+
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_backup_download_plan(
+    dao_mock, tmpdir, bucket, dir_config, nc_subtree, download_mock, patch_stat_etag
+):
+    """Unique contents are downloaded once for all mappings of a storage,
+    snapshots are the same as backup-ing mapping by mapping"""
+    test_dir = Path(str(tmpdir))
+    for fileid in range(1, 13):
+        content = f"content {fileid % 3}".encode()
+        (bucket / f"urn:oid:{fileid}").write_bytes(content)
+        checksum = sha1(content)
+        if fileid % 4 == 0:
+            checksum = ""
+        elif fileid in (5, 7):
+            # different contents sharing the same wrong checksum
+            checksum = "SHA1:wrong"
+        nc_subtree.append(
+            NextcloudFile(fileid, 2, f"files/d{fileid % 2}/f{fileid}", checksum, 9)
+        )
+    nc_subtree.append(NextcloudFile(20, 2, "files/d0/empty", "", 0))
+    nc_subtree.append(NextcloudFile(21, 2, "files/d0/missing", sha1(b"missing"), 7))
+
+    def backup(
+        root: Path, download_plan: bool, backup_class=NextcloudS3Backup, **params
+    ) -> int:
+        mappings = [
+            dataclasses.replace(dir_config, backup_root_path=root),
+            dataclasses.replace(
+                dir_config,
+                backup_root_path=root,
+                nextcloud_path="files/d0/",
+                user_name="d0",
+            ),
+        ]
+        nc_backup = backup_class(
+            DaoNextcloudFiles("postgres://test"),
+            config=NextCloudS3BackupConfig(mapping=mappings, backup_date_format="%y"),
+            download_plan=download_plan,
+            **params,
+        )
+        get_nc_subtrees_mock = DaoNextcloudFiles.get_nc_subtrees
+        get_nc_subtrees_mock.reset_mock()
+        download_mock.reset_mock()
+        nc_backup.backup()
+        # one query for both mappings of the storage
+        assert get_nc_subtrees_mock.call_count == (1 if download_plan else 0)
+        return download_mock.call_count
+
+    assert backup(test_dir / "mapping-by-mapping", False) > 5
+    # 3 sha1 contents, 3 fileids without sha1, 2 fileids sharing a wrong
+    # checksum
+    assert backup(test_dir / "plan", True) == 8
+    assert backup(test_dir / "plan-workers", True, workers=4) == 8
+    assert backup(test_dir / "plan-async", True, AsyncNextcloudS3Backup) == 8
+
+    def snapshot_files(root: Path):
+        snapshot = root / SNAPSHOT_DIRNAME / datetime.now().strftime("%y")
+        return {
+            str(path.relative_to(snapshot)): path.read_bytes()
+            for path in snapshot.glob("**/*")
+            if path.is_file() and path.name != ".inodes"
+        }
+
+    expected = snapshot_files(test_dir / "mapping-by-mapping")
+    assert expected["pverkest/files/d1/f5"] == b"content 2"
+    assert expected["pverkest/files/d1/f7"] == b"content 1"
+    assert "pverkest/files/d0/missing" not in expected
+    assert snapshot_files(test_dir / "plan") == expected
+    assert snapshot_files(test_dir / "plan-workers") == expected
+    assert snapshot_files(test_dir / "plan-async") == expected
+    assert not list((test_dir / "plan" / REPOSITORY_DIRNAME).glob("**/*.downloading"))
@@ -0,0 +1,183 @@
+import hashlib
+import logging
+import pstats
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+from unittest import mock
+
+import pytest
+
+from nc_s3_backup.api.backup import NextcloudS3Backup
+from nc_s3_backup.api.config import NextCloudS3BackupConfig
+from nc_s3_backup.api.db import DaoNextcloudFiles, NextcloudFile
+from nc_s3_backup.api.profiling import (
+    NULL_PHASE,
+    OTHER_PHASE,
+    WAIT_PHASE,
+    PhaseProfiler,
+    profiler,
+)
+
+
+def phases(summary, key="phases"):
+    return {phase["name"]: phase for phase in summary[key]}
+
+
+def test_disabled_profiler():
+    phase_profiler = PhaseProfiler()
+    assert phase_profiler.phase("db") is NULL_PHASE
+    rows = [1, 2]
+    assert phase_profiler.iterate("db", rows) is rows
+    phase_profiler.add("s3_get", 1.0)
+    assert phase_profiler.summary()["phases"] == []
+
+
+def test_nested_phases_exclusive_time():
+    clock = [0.0]
+
+    def sleep(seconds):
+        clock[0] += seconds
+
+    def rows():
+        for row in (1, 2, 3):
+            sleep(0.01)
+            yield row
+
+    phase_profiler = PhaseProfiler()
+    # deterministic clock: nested time is checked exactly, not against
+    # bounds a loaded machine would break
+    with mock.patch(
+        "nc_s3_backup.api.profiling.perf_counter", side_effect=lambda: clock[0]
+    ):
+        phase_profiler.start()
+        with phase_profiler.phase("s3_get") as phase:
+            sleep(0.02)
+            with phase_profiler.phase("hash", 10):
+                sleep(0.05)
+            phase.nbytes = 20
+        assert list(phase_profiler.iterate("db", rows())) == [1, 2, 3]
+        sleep(0.001)
+        phase_profiler.stop()
+        summary = phase_profiler.summary()
+
+    ranked = phases(summary)
+    assert [phase["name"] for phase in summary["phases"]] == ["hash", "db", "s3_get"]
+    # the nested hash phase is excluded from s3_get time
+    assert ranked["s3_get"]["seconds"] == pytest.approx(0.02)
+    assert ranked["hash"]["seconds"] == pytest.approx(0.05)
+    assert ranked["db"]["seconds"] == pytest.approx(0.03)
+    assert (ranked["s3_get"]["bytes"], ranked["hash"]["bytes"]) == (20, 10)
+    # last call tells the end of the iterable
+    assert ranked["db"]["calls"] == 4
+    critical_path = dict(summary["critical_path"])
+    assert set(critical_path) == {"s3_get", "hash", "db", OTHER_PHASE}
+    assert sum(critical_path.values()) == pytest.approx(summary["wall_time"])
+    assert summary["wall_time"] == pytest.approx(0.101)
+
+
+def test_nested_phases_exclusive_time_real_clock():
+    phase_profiler = PhaseProfiler()
+    phase_profiler.start()
+    with phase_profiler.phase("s3_get"):
+        time.sleep(0.02)
+        with phase_profiler.phase("hash"):
+            time.sleep(0.05)
+    phase_profiler.stop()
+
+    ranked = phases(phase_profiler.summary())
+    assert ranked["s3_get"]["seconds"] >= 0.02
+    assert ranked["hash"]["seconds"] >= 0.05
+    # exclusive: the nested phase isn't counted twice
+    total = ranked["s3_get"]["seconds"] + ranked["hash"]["seconds"]
+    assert total <= phase_profiler.summary()["wall_time"]
+
+
+def test_worker_threads_detail_wait():
+    phase_profiler = PhaseProfiler()
+    phase_profiler.start()
+
+    def work():
+        for _ in range(100):
+            with phase_profiler.phase("link"):
+                pass
+        with phase_profiler.phase("s3_get", 5):
+            time.sleep(0.01)
+
+    with phase_profiler.phase(WAIT_PHASE):
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    phase_profiler.add("s3_head", 0.5)
+    phase_profiler.stop()
+
+    summary = phase_profiler.summary()
+    assert dict(summary["critical_path"]).keys() == {WAIT_PHASE, OTHER_PHASE}
+    assert WAIT_PHASE not in phases(summary)
+    workers = phases(summary, "workers")
+    assert workers["link"]["calls"] == 400
+    assert workers["s3_get"]["bytes"] == 20
+    assert workers["s3_head"]["seconds"] == 0.5
+    report = phase_profiler.report()
+    assert report[0].startswith("Profile - Wall time: ")
+    assert report[-1].startswith("Critical path (main thread): wait ")
+    assert "(workers: s3_head " in report[-1]
+
+
+def test_profile_files(tmpdir):
+    test_dir = Path(str(tmpdir))
+    phase_profiler = PhaseProfiler()
+    phase_profiler.start(
+        cprofile_file=test_dir / "run.prof",
+        tracemalloc_file=test_dir / "run.tracemalloc",
+    )
+    thread = threading.Thread(target=lambda: sorted(range(1000)))
+    thread.start()
+    thread.join()
+    phase_profiler.stop()
+    assert not tracemalloc.is_tracing()
+    assert pstats.Stats(str(test_dir / "run.prof")).total_calls > 0
+    assert tracemalloc.Snapshot.load(str(test_dir / "run.tracemalloc")).traces
+
+
+@pytest.mark.parametrize("params", [{}, dict(workers=4), dict(stream_download=True)])
+@mock.patch("nc_s3_backup.api.db.Dao")
+def test_backup_profile(
+    dao_mock, bucket, dir_config, nc_subtree, download_mock, caplog, params
+):
+    nc_subtree.append(NextcloudFile(20, 2, "files/empty.txt", "", 0))
+    for fileid in range(1, 9):
+        content = f"content {fileid}".encode()
+        (bucket / f"urn:oid:{fileid}").write_bytes(content)
+        nc_subtree.append(
+            NextcloudFile(
+                fileid,
+                2,
+                f"files/dir-{fileid % 2}/{fileid}.txt",
+                f"SHA1:{hashlib.sha1(content).hexdigest()}",  # nosec
+                len(content),
+            )
+        )
+    nc_backup = NextcloudS3Backup(
+        DaoNextcloudFiles("postgres://test"),
+        config=NextCloudS3BackupConfig(mapping=[dir_config]),
+        profile=True,
+        **params,
+    )
+    with caplog.at_level(logging.INFO):
+        nc_backup.backup()
+    assert not profiler.enabled
+    assert "Critical path (main thread): " in caplog.text
+
+    summary = profiler.summary()
+    ranked = phases(summary)
+    assert ranked["db"]["calls"] == len(nc_subtree) + 1
+    assert ranked["link"]["calls"] == len(nc_subtree)
+    assert ranked["s3_get"]["bytes"] == sum(nc_file.size for nc_file in nc_subtree)
+    assert ranked["hash"]["bytes"] == ranked["s3_get"]["bytes"]
+    assert ranked["mkdir"]["calls"] >= 2
+    critical_path = dict(summary["critical_path"])
+    assert (WAIT_PHASE in critical_path) == bool(params.get("workers"))
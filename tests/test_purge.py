@@ -1,6 +1,7 @@
 import os
 import shutil
 from pathlib import Path
+from unittest import mock
 
 import pytest
 
@@ -10,6 +11,8 @@ from nc_s3_backup.api.backup import (
     NextcloudS3Backup,
 )
 from nc_s3_backup.api.db import NextcloudFile
+from nc_s3_backup.api.index import RepositoryIndex, hash_from_path
+from nc_s3_backup.api.manifest import write_inodes_manifest
 from nc_s3_backup.cli import parse_config
 
 
@@ -246,6 +249,7 @@ def prepare_repo_and_snapshots(tmpdir, config):
         ),
     ],
 )
+@pytest.mark.parametrize("workers", [1, 4])
 def test_purge_sha1(
     tmpdir,
     config,
@@ -253,6 +257,7 @@ def test_purge_sha1(
     remove_directories,
     expected_existing_files,
     expected_missing_files,
+    workers,
 ):
     tmp = Path(str(tmpdir))
     for rm_dir in remove_directories:
@@ -260,6 +265,7 @@ def test_purge_sha1(
     backup = NextcloudS3Backup(
         dao=None,
         config=config,
+        workers=workers,
     )
     backup.purge()
     _assert_repo_state(
@@ -341,3 +347,84 @@ def test_purge_etag(
     ), "Following file is present but expected missing: {!r}".format(
         [f for f in expected_missing_files if (tmp / f).exists()],
     )
+
+
+def test_purge_update_index(tmpdir, config, sha1_files):
+    tmp = Path(str(tmpdir))
+    backup = NextcloudS3Backup(dao=None, config=config)
+    backup.reindex()
+    shutil.rmtree(tmp / "backup/data/snapshots/20230103")
+    shutil.rmtree(tmp / "backup/data/snapshots/20230104")
+    backup.purge()
+    index = RepositoryIndex(tmp / "backup/data" / REPOSITORY_DIRNAME)
+    assert sorted(index.sha1_per_inode().values()) == sorted(
+        hash_from_path(sha1_files[f]) for f in ["abc", "def"]
+    )
+    assert index.sha1_from_etag(hash_from_path(tmp / "fe/abc")) == hash_from_path(
+        sha1_files["abc"]
+    )
+    index = RepositoryIndex(tmp / "backup/sensitive_data" / REPOSITORY_DIRNAME)
+    assert sorted(index.sha1_per_inode().values()) == sorted(
+        hash_from_path(sha1_files[f]) for f in ["rst", "xyz"]
+    )
+
+
+def test_purge_use_snapshots_inodes_manifest(tmpdir, config, sha1_files):
+    tmp = Path(str(tmpdir))
+    backup = NextcloudS3Backup(dao=None, config=config)
+    for snapshot in ["20230103", "20230104"]:
+        snapshot_directory = tmp / "backup/data/snapshots" / snapshot
+        write_inodes_manifest(
+            snapshot_directory,
+            backup._get_inodes(snapshot_directory),
+            tmp / "backup/data" / REPOSITORY_DIRNAME,
+        )
+    # manifest is trusted: files removed from a snapshot that have a
+    # manifest are kept until the whole snapshot is removed
+    shutil.rmtree(tmp / "backup/data/snapshots/20230104/mc")
+    shutil.rmtree(tmp / "backup/data/snapshots/20230105")
+    with mock.patch.object(
+        NextcloudS3Backup, "_get_inodes", wraps=backup._get_inodes
+    ) as get_inodes_mock:
+        backup.purge()
+    # only backup/sensitive_data/snapshots/20230105/mc is walked
+    get_inodes_mock.assert_called_once_with(
+        tmp / "backup/sensitive_data/snapshots/20230105/mc"
+    )
+    _assert_repo_state(
+        sha1_files,
+        expected_existing_files=["abc", "def", "ghi", "rst", "xyz"],
+        expected_missing_files=["opq", "uvw"],
+    )
+    shutil.rmtree(tmp / "backup/data/snapshots/20230104")
+    backup.purge()
+    _assert_repo_state(
+        sha1_files,
+        expected_existing_files=["def", "ghi", "rst", "xyz"],
+        expected_missing_files=["abc", "opq", "uvw"],
+    )
+
+
+def test_purge_walks_snapshots_of_restored_repository(tmpdir, config, sha1_files):
+    """Inodes saved before the repository was copied or restored are stale,
+    snapshots are walked instead of purging files they still use"""
+    tmp = Path(str(tmpdir))
+    backup = NextcloudS3Backup(dao=None, config=config)
+    repository = tmp / "backup/data" / REPOSITORY_DIRNAME
+    for snapshot in ["20230103", "20230104", "20230105"]:
+        write_inodes_manifest(tmp / "backup/data/snapshots" / snapshot, [], repository)
+    restored = tmp / "restored"
+    shutil.copytree(repository, restored, copy_function=os.link)
+    shutil.rmtree(repository)
+    restored.rename(repository)
+    with mock.patch.object(
+        NextcloudS3Backup, "_get_inodes", wraps=backup._get_inodes
+    ) as get_inodes_mock:
+        backup.purge()
+    walked = {call.args[0] for call in get_inodes_mock.mock_calls}
+    assert tmp / "backup/data/snapshots/20230104/mc" in walked
+    _assert_repo_state(
+        sha1_files,
+        expected_existing_files=["abc", "def", "ghi", "rst", "xyz"],
+        expected_missing_files=["opq", "uvw"],
+    )
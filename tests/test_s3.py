@@ -0,0 +1,107 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import PurePath
+from unittest import mock
+
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+
+from nc_s3_backup.api.s3 import (
+    ConnectionStats,
+    boto_config,
+    connection_stats,
+    head_object,
+)
+
+
+class ListBucketsHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = (
+            b'<?xml version="1.0" encoding="UTF-8"?>'
+            b"<ListAllMyBucketsResult><Buckets/></ListAllMyBucketsResult>"
+        )
+        self.send_response(200)
+        self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture()
+def s3_endpoint():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ListBucketsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def s3_client(endpoint_url, **config):
+    return boto3.session.Session().client(
+        "s3",
+        endpoint_url=endpoint_url,
+        region_name="us-east-1",
+        aws_access_key_id="access",
+        aws_secret_access_key="secret",
+        config=boto_config(**config),
+    )
+
+
+def test_boto_config():
+    config = boto_config(
+        max_pool_connections=32,
+        retry_mode="standard",
+        max_attempts=3,
+        connect_timeout=5,
+        read_timeout=30,
+        tcp_keepalive=True,
+    )
+    assert config.max_pool_connections == 32
+    assert config.retries == {"mode": "standard", "max_attempts": 3}
+    assert config.connect_timeout == 5
+    assert config.read_timeout == 30
+    assert config.tcp_keepalive is True
+    assert config.signature_version == "s3v4"
+
+
+def test_connection_stats_no_request(s3_endpoint):
+    assert connection_stats(s3_client(s3_endpoint)) == ConnectionStats(0, 0)
+
+
+def test_connection_stats_shared_client(s3_endpoint):
+    client = s3_client(s3_endpoint, max_pool_connections=4)
+    with ThreadPoolExecutor(4) as executor:
+        list(executor.map(lambda _: client.list_buckets(), range(40)))
+    stats = connection_stats(client)
+    assert stats.requests == 40
+    assert 1 <= stats.opened <= 4
+    assert stats.reused == 40 - stats.opened
+
+
+def test_head_object():
+    client = mock.Mock(spec=["head_object"])
+    client.head_object.return_value = {"ETag": '"abc"'}
+    assert head_object(client, PurePath("/bucket/nc/urn:oid:1")) == {"ETag": '"abc"'}
+    client.head_object.assert_called_once_with(Bucket="bucket", Key="nc/urn:oid:1")
+
+
+@pytest.mark.parametrize("code", ["404", "NoSuchKey"])
+def test_head_object_missing(code):
+    client = mock.Mock(spec=["head_object"])
+    client.head_object.side_effect = ClientError({"Error": {"Code": code}}, "Head")
+    assert head_object(client, PurePath("/bucket/urn:oid:1")) is None
+
+
+def test_head_object_error():
+    client = mock.Mock(spec=["head_object"])
+    client.head_object.side_effect = ClientError({"Error": {"Code": "403"}}, "Head")
+    with pytest.raises(ClientError):
+        head_object(client, PurePath("/bucket/urn:oid:1"))
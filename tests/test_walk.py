@@ -0,0 +1,53 @@
+import os
+from pathlib import Path
+
+from nc_s3_backup.api.walk import split_tree, walk_files
+
+
+def test_walk_files(tmpdir):
+    root = Path(str(tmpdir))
+    deep = root.joinpath(*[f"d{i}" for i in range(50)])
+    deep.mkdir(parents=True)
+    (deep / "deep.txt").write_text("deep")
+    (root / "a.txt").write_text("a")
+    (root / "d0" / "b.txt").write_text("b")
+    os.link(root / "a.txt", root / "d0" / "a-link.txt")
+    os.mkdir(root / "empty")
+
+    entries = {Path(entry.path).relative_to(root): entry for entry in walk_files(root)}
+    assert sorted(entries) == sorted(
+        [
+            Path("a.txt"),
+            Path("d0/b.txt"),
+            Path("d0/a-link.txt"),
+            deep.relative_to(root) / "deep.txt",
+        ]
+    )
+    assert entries[Path("a.txt")].inode() == entries[Path("d0/a-link.txt")].inode()
+    assert entries[Path("a.txt")].inode() == (root / "a.txt").stat().st_ino
+
+
+def test_walk_missing_directory(tmpdir):
+    assert list(walk_files(Path(str(tmpdir)) / "missing")) == []
+
+
+def test_split_tree(tmpdir):
+    root = Path(str(tmpdir))
+    (root / "20230105" / "pverkest" / "files").mkdir(parents=True)
+    (root / "20230105" / "mc").mkdir(parents=True)
+    (root / "20230104" / "mc").mkdir(parents=True)
+    (root / "20230104" / "unexpected.txt").write_text("unexpected")
+    (root / "unexpected.txt").write_text("unexpected")
+
+    directories, files = split_tree(root, 2)
+    assert sorted(directories) == sorted(
+        [
+            root / "20230105" / "pverkest",
+            root / "20230105" / "mc",
+            root / "20230104" / "mc",
+        ]
+    )
+    assert sorted(entry.path for entry in files) == sorted(
+        [str(root / "20230104" / "unexpected.txt"), str(root / "unexpected.txt")]
+    )
+    assert split_tree(root / "missing", 2) == ([], [])